@@ -1,172 +1,621 @@
 # -*- coding: utf-8 -*-
+import gc
+import importlib
+import json
 import os
 import pathlib
-import secrets
 
-from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory
+from flask import Blueprint, Flask, current_app, render_template, request, redirect, url_for, flash, \
+    send_file, jsonify, abort, make_response, session, stream_with_context
+from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
 
-from .utils.File import get_uploads_files, purge_file, full_paths, \
-    create_dir_if_dont_exist as create_dir, zip_files, add_to_list_file, get_items_from_file, \
-    save_items_as_json, validate_file_dg, get_validated_files
-
-from .utils.dg_allocation_tool import run_dg_analysis
-from .utils.node_map_tool import run_nm_analysis
-
-app = Flask(__name__)
-app.secret_key = secrets.token_bytes()
-app.config['ROOT_DIR'] = pathlib.Path(__file__)
-
-app.config['MAX_CONTENT_LENGTH'] = 3072 * 3072
-app.config['UPLOAD_EXTENSIONS'] = ['.csv', '.xlsx', '.xls']
-app.config['UPLOAD_PATH'] = create_dir('uploads')
-app.config['UPLOAD_PATH_DG'] = create_dir('uploads/dg_allocation')
-app.config['GENERATED_PATH_DG'] = create_dir('generated/dg_allocation')
-app.config['UPLOAD_PATH_NM'] = create_dir('uploads/node_map')
-app.config['GENERATED_PATH_NM'] = create_dir('generated/node_map')
-app.config['GENERATED_PATH'] = create_dir(r'generated')
-app.config['FILES_DG'] = {
+from .utils.File import get_uploads_files, create_dir_if_dont_exist as create_dir, validate_file_dg, \
+    get_validated_files, convert_upload
+
+from .utils.archive import bundle_entries, gzip_stream, output_entries, zip_stream
+from .utils.jobs import JobManager, JobQueueFullError, DONE, ERROR, INDEXED_ANALYSES, QUEUED, RUNNING
+from .utils.cache import ResultCache
+from .utils.metrics import MetricsStore, Profile
+from .utils.uploads import UploadOffsetError, cancel_upload, finish_upload, list_uploads, set_upload_job, \
+    start_upload, upload_lock, upload_status, write_chunk
+from .utils.workspace import Workspace, WorkspaceStore, new_workspace_id, shared_secret_key
+
+# files needed by each application
+FILES_DG = {
     "network_file": False,
     "source_file": False,
     "open_file": False,
     "limit_file": False
 }
 
-app.config['FILES_NM'] = {
+FILES_NM = {
     "network_file": False,
     "source_file": False,
     "open_file": False
 }
 
-app.config['CURRENT_OUTPUT_FILE'] = ''
+APPS = {'dg_allocation': 'FILES_DG', 'node_map': 'FILES_NM'}
+
+# modules of the analyses and of the queries: pandas, openpyxl and the engines are only imported on
+# the first upload, validation or query of a web worker, or once in the master with preload_engines
+ENGINE_MODULES = ('numpy', 'pandas', 'openpyxl', 'app.utils.validation', 'app.utils.query',
+                  'app.utils.dg_allocation_tool', 'app.utils.node_map_tool')
+
+views = Blueprint('views', __name__)
+
+
+def default_config():
+    """
+    :return: The configuration of the application, read from the environment
+    """
+    max_content_length = 3072 * 3072
+    return {
+        'ROOT_DIR': pathlib.Path(__file__),
+        'MAX_CONTENT_LENGTH': max_content_length,
+        # larger files are sent in chunks of UPLOAD_CHUNK_BYTES, up to UPLOAD_MAX_BYTES per file
+        'UPLOAD_CHUNK_BYTES': min(int(os.environ.get('UPLOAD_CHUNK_BYTES', 8 * 1024 ** 2)), max_content_length),
+        'UPLOAD_MAX_BYTES': int(os.environ.get('UPLOAD_MAX_BYTES', 8 * 1024 ** 3)),
+        'UPLOAD_EXTENSIONS': ['.csv', '.xlsx', '.xls'],
+        'UPLOAD_PATH': pathlib.Path(os.environ.get('UPLOAD_PATH', 'uploads')),
+        'GENERATED_PATH': pathlib.Path(os.environ.get('GENERATED_PATH', 'generated')),
+        # in GENERATED_PATH when not given
+        'JOBS_PATH': os.environ.get('JOBS_PATH'),
+        # analyses running at the same time, and accepted (running or waiting) before new ones are refused,
+        # counted across all the web workers sharing JOBS_PATH
+        'MAX_CONCURRENT_JOBS': int(os.environ.get('MAX_CONCURRENT_JOBS', 2)),
+        'MAX_QUEUED_JOBS': int(os.environ.get('MAX_QUEUED_JOBS', 8)),
+        # processes of each analysis splitting a large network into its connected parts
+        'PARTITION_WORKERS': int(os.environ.get('PARTITION_WORKERS', 1)),
+        # results already computed for the same files and options are served from this cache
+        'CACHE_PATH': os.environ.get('CACHE_PATH'),
+        'CACHE_MAX_BYTES': int(os.environ.get('CACHE_MAX_BYTES', 2 * 1024 ** 3)),
+        # /jobs/<id>/events sends the status once and closes, so that a sync web worker is never held by a
+        # page; the browser reconnects after EVENTS_RETRY_MS milliseconds
+        'EVENTS_RETRY_MS': int(os.environ.get('EVENTS_RETRY_MS', 2000)),
+        # networks of finished jobs kept in memory by each web worker to answer the /query routes
+        'QUERY_MAX_NETWORKS': int(os.environ.get('QUERY_MAX_NETWORKS', 4)),
+        # import the engines in create_app, for gunicorn --preload
+        'PRELOAD_ENGINES': os.environ.get('PRELOAD_ENGINES', '') not in ('', '0'),
+        'FILES_DG': FILES_DG,
+        'FILES_NM': FILES_NM,
+    }
+
+
+def preload_engines():
+    """
+    Import the analysis engines and their libraries now rather than on the first request. Called
+    in the gunicorn master (--preload), the forked workers share these modules copy-on-write.
+    """
+    for name in ENGINE_MODULES:
+        importlib.import_module(name)
+    # objects created so far are never freed: keep the collector from writing to their pages in
+    # every worker, which would copy them
+    gc.freeze()
+
+
+def create_app(config=None):
+    """
+    Build the web application: the directories, stores and job manager are created from the
+    configuration here, nothing is done when the module is imported.
+
+    :param config: Values overriding default_config()
+    :type config: dict
+    :rtype: Flask
+    """
+    app = Flask(__name__)
+    app.config.update(default_config())
+    app.config.update(config or {})
+
+    app.config['JOBS_PATH'] = app.config['JOBS_PATH'] or pathlib.Path(app.config['GENERATED_PATH']) / 'jobs'
+    app.config['CACHE_PATH'] = app.config['CACHE_PATH'] or pathlib.Path(app.config['GENERATED_PATH']) / 'cache'
+    for path in ('UPLOAD_PATH', 'GENERATED_PATH', 'JOBS_PATH', 'CACHE_PATH'):
+        app.config[path] = create_dir(app.config[path])
+    # sessions and workspaces are shared by every web worker
+    app.secret_key = shared_secret_key(app.config['GENERATED_PATH'] / '.secret_key')
+    app.config['WORKSPACE_STORE'] = WorkspaceStore(app.config['GENERATED_PATH'] / 'workspaces.sqlite3')
+    # time, rows and memory of the stages of the uploads and analyses, served by /metrics
+    app.config['METRICS_STORE'] = MetricsStore(app.config['GENERATED_PATH'] / 'metrics.sqlite3')
+    # the worker processes are only started by the first analysis
+    app.config['JOB_MANAGER'] = JobManager(app.config['JOBS_PATH'], max_workers=app.config['MAX_CONCURRENT_JOBS'],
+                                           max_queued=app.config['MAX_QUEUED_JOBS'],
+                                           cache_dir=app.config['CACHE_PATH'],
+                                           cache_max_bytes=app.config['CACHE_MAX_BYTES'],
+                                           metrics_db=app.config['METRICS_STORE'].db_path,
+                                           partition_workers=app.config['PARTITION_WORKERS'])
+    app.register_blueprint(views)
+
+    if app.config['PRELOAD_ENGINES']:
+        preload_engines()
+    return app
+
+
+def query_indexes():
+    """
+    :return: The networks of finished jobs kept in memory by this web worker, created on the first query
+    :rtype: IndexCache
+    """
+    from .utils.query import IndexCache
+    if 'query_indexes' not in current_app.extensions:
+        current_app.extensions.setdefault('query_indexes', IndexCache(current_app.config['QUERY_MAX_NETWORKS']))
+    return current_app.extensions['query_indexes']
+
+
+def current_workspace():
+    """
+    :return: The workspace of the session, created on the first visit
+    :rtype: Workspace
+    """
+    if 'workspace' not in session:
+        session['workspace'] = new_workspace_id()
+    return Workspace(current_app.config['WORKSPACE_STORE'], session['workspace'], current_app.config['UPLOAD_PATH'],
+                     current_app.config['GENERATED_PATH'])
+
+
+def accept_upload(workspace, app_name, file_type, path_to_file, profile):
+    """
+    Validate an uploaded file and make it the file_type file of the workspace. The file is removed
+    and ValueError raised if it is not valid.
+    """
+    # valide en ouvrant les fichiers si le contenu est bon
+    try:
+        with profile.stage('upload_validate'):
+            validate_file_dg(path_to_file, file_type)
+        # parsed once here, the analyses load the converted file
+        with profile.stage('upload_convert'):
+            workspace.set_file(app_name, file_type, convert_upload(path_to_file))
+    except ValueError:
+        os.remove(path_to_file)
+        raise
+
+
+def convert_received_upload(workspace, upload_dir, state):
+    """
+    Queue the conversion of a complete upload in the job pool, under its upload_lock. When the queue
+    is full, the conversion is queued by a later call.
+
+    :return: The state of the upload, with the 'job' converting it once queued
+    """
+    if state['offset'] != state['size'] or state.get('job'):
+        return state
+    path = finish_upload(upload_dir, state['id'])
+    try:
+        job_id = current_app.config['JOB_MANAGER'].submit('convert_upload', {'upload_file': path}, path.parent,
+                                                          owner=workspace.id, file_type=state['file_type'])
+    except JobQueueFullError:
+        return upload_status(upload_dir, state['id'])
+    return set_upload_job(upload_dir, state['id'], job_id)
+
+
+def collect_upload(workspace, app_name, upload_dir, upload_id):
+    """
+    Follow an upload, under its upload_lock: queue its conversion once complete, and add the
+    converted file to the workspace once the job is done. The upload is forgotten once its file is
+    converted or refused.
+
+    :return: The state of the upload, with 'complete' once the file is in the workspace, None if
+     there is no such upload. Raise ValueError if the file is refused
+    """
+    if upload_status(upload_dir, upload_id) is None:
+        return None
+    with upload_lock(upload_dir, upload_id):
+        state = upload_status(upload_dir, upload_id)
+        if state is None:
+            return None
+        state = convert_received_upload(workspace, upload_dir, state)
+        job = current_app.config['JOB_MANAGER'].status(state['job']) if state.get('job') else None
+        if job is not None and job['state'] == DONE:
+            workspace.set_file(app_name, state['file_type'], job['result'])
+            cancel_upload(upload_dir, upload_id)
+            state['complete'] = True
+        elif job is not None and job['state'] == ERROR:
+            pathlib.Path(state['path']).unlink(missing_ok=True)
+            cancel_upload(upload_dir, upload_id)
+            raise ValueError(job['message'])
+        return state
+
+
+def collect_uploads(workspace, app_name):
+    """
+    Add to the workspace the uploads of app_name converted since the last visit, such as those of a
+    page closed while the conversion was running.
+    """
+    upload_dir = workspace.upload_dir(app_name)
+    for state in list_uploads(upload_dir):
+        if state.get('job'):
+            try:
+                collect_upload(workspace, app_name, upload_dir, state['id'])
+            except ValueError as e:
+                flash("{0}".format(e), 'warning')
+
+
+def validate_before_analysis(app_name, files):
+    """
+    Check the files of the workspace together and flash the problems found.
+
+    :return: True if the analysis can be queued
+    """
+    # imported on the first analysis of the web worker, see ENGINE_MODULES
+    from .utils.validation import validate_study
+    profile = Profile()
+    errors, warnings = validate_study(files, profile, required=tuple(current_app.config[APPS[app_name]]))
+    current_app.config['METRICS_STORE'].record(app_name, profile)
+    for message in errors + warnings:
+        flash(message, 'error' if message in errors else 'warning')
+    return not errors
+
 
+def analysis_in_progress(job):
+    """
+    A workspace runs one analysis per application at a time: a second submit, such as a double
+    click, is refused while its current job is queued or running.
 
-@app.route('/')
+    :param job: Status of the current job of the workspace, None if there is none
+    """
+    if job is not None and job['state'] in (QUEUED, RUNNING):
+        flash("Une analyse est déjà en cours, veuillez attendre qu'elle se termine", 'error')
+        return True
+    return False
+
+
+@views.route('/')
 def index():
     return render_template('accueil.html')
 
 
-@app.route('/dg_allocation', methods=['GET', 'POST'])
+@views.route('/dg_allocation', methods=['GET', 'POST'])
 def dg_allocation():
     app_name ='dg_allocation'
-    uploaded_files = get_uploads_files(app.config['UPLOAD_PATH_DG'])
-    validated_files = get_validated_files(app.config['FILES_DG'])
-    file_dg_ready = False
+    workspace = current_workspace()
+    collect_uploads(workspace, app_name)
+    files = workspace.files(app_name, current_app.config['FILES_DG'])
+    uploaded_files = get_uploads_files(workspace.upload_dir(app_name))
+    validated_files = get_validated_files(files)
+    job_id = workspace.current_job(app_name)
+    job = current_app.config['JOB_MANAGER'].status(job_id) if job_id else None
+    file_dg_ready = job is not None and job['state'] == DONE
     error_messages = []
 
     if request.method == 'POST':
         # ajout de fichier pour analyse
         if request.form['btn_id'] == 'soumettre_fichier':
             submittted_files = request.files
+            profile = Profile()
             for uploaded_file_name, uploaded_file in submittted_files.items():
                 file = pathlib.Path(secure_filename(uploaded_file.filename))
                 if file.name != '':
                     # valide si l'extension des fichiers est bonne
-                    if file.suffix not in app.config['UPLOAD_EXTENSIONS']:
+                    if file.suffix not in current_app.config['UPLOAD_EXTENSIONS']:
                         flash("Les fichiers reçus ne sont des fichiers .csv ou .xlsx", 'error')
-                    path_to_file = pathlib.Path(app.config['UPLOAD_PATH_DG']) / file
-                    uploaded_file.save(path_to_file)
-                    # valide en ouvrant les fichiers si le contenu est bon
+                        continue
+                    path_to_file = workspace.upload_dir(app_name) / file
+                    with profile.stage('upload_save'):
+                        uploaded_file.save(path_to_file)
                     try:
-                        validate_file_dg(path_to_file, uploaded_file_name)
-                        app.config['FILES_DG'][uploaded_file_name] = path_to_file
+                        accept_upload(workspace, app_name, uploaded_file_name, path_to_file, profile)
                     except ValueError as e:
-                        os.remove(path_to_file)
                         error_messages.append("{0}".format(e))
+            current_app.config['METRICS_STORE'].record(app_name, profile)
 
             flash("\n".join(error_messages), 'warning')
-            return redirect(url_for('dg_allocation'))
+            return redirect(url_for('.dg_allocation'))
 
         elif request.form['btn_id'] == 'purger' or request.form['btn_id'] == 'terminer':
-            return redirect(url_for('purge', app_name=app_name))
-
-        elif request.form['btn_id'] == 'analyser':
+            return redirect(url_for('.purge', app_name=app_name))
+
+        elif request.form['btn_id'] in ('analyser', 'analyser_tout'):
+            # 'analyser_tout' also produces the node map from the same topology, both in a zip
+            table_format = request.form.get('table_format', 'csv')
+            if request.form['btn_id'] == 'analyser':
+                analysis, options = app_name, {'output_format': table_format}
+            else:
+                analysis, options = 'all_analyses', {'table_format': table_format}
+            if analysis_in_progress(job) or not validate_before_analysis(app_name, files):
+                return redirect(url_for('.dg_allocation'))
             try:
-                dg = run_dg_analysis(app.config['FILES_DG'], pathlib.Path(app.config['GENERATED_PATH']/app_name))
-                app.config['CURRENT_OUTPUT_FILE'] = dg
-                file_dg_ready = True
-            except Exception as e:
-                error_messages.append("{0}".format(e))
-                flash("\n".join(error_messages), 'error')
+                job_id = current_app.config['JOB_MANAGER'].submit(analysis, files, workspace.generated_dir(app_name),
+                                                                  owner=workspace.id, **options)
+                workspace.set_current_job(app_name, job_id)
+            except JobQueueFullError as e:
+                flash("{0}".format(e), 'error')
 
-            return render_template('dg_allocation.html', uploaded_files=uploaded_files, validated_files=validated_files,
-                                   file_ready=file_dg_ready)
+            return redirect(url_for('.dg_allocation'))
 
-        elif request.form['btn_id'] == 'telecharger':
-            return redirect(url_for('download', app_name=app_name, filename=app.config['CURRENT_OUTPUT_FILE']))
+        elif request.form['btn_id'] == 'telecharger' and file_dg_ready:
+            return redirect(url_for('.job_result', job_id=job_id))
 
     return render_template('dg_allocation.html', uploaded_files=uploaded_files, validated_files=validated_files,
-                           file_ready=file_dg_ready)
+                           file_ready=file_dg_ready, job=job)
 
 
-@app.route('/node_map', methods=['GET', 'POST'])
+@views.route('/node_map', methods=['GET', 'POST'])
 def node_map():
     app_name ='node_map'
-    uploaded_files = get_uploads_files(app.config['UPLOAD_PATH_NM'])
-    validated_nm_files = get_validated_files(app.config['FILES_NM'])
-    file_nm_ready = False
+    workspace = current_workspace()
+    collect_uploads(workspace, app_name)
+    files = workspace.files(app_name, current_app.config['FILES_NM'])
+    uploaded_files = get_uploads_files(workspace.upload_dir(app_name))
+    validated_nm_files = get_validated_files(files)
+    job_id = workspace.current_job(app_name)
+    job = current_app.config['JOB_MANAGER'].status(job_id) if job_id else None
+    file_nm_ready = job is not None and job['state'] == DONE
     error_messages = []
 
     if request.method == 'POST':
         # ajout de fichier pour analyse
         if request.form['btn_id'] == 'soumettre_fichier':
             submittted_files = request.files
+            profile = Profile()
             for uploaded_file_name, uploaded_file in submittted_files.items():
                 file = pathlib.Path(secure_filename(uploaded_file.filename))
                 if file.name != '':
                     # valide si l'extension des fichiers est bonne
-                    if file.suffix not in app.config['UPLOAD_EXTENSIONS']:
+                    if file.suffix not in current_app.config['UPLOAD_EXTENSIONS']:
                         flash("Les fichiers reçus ne sont des fichiers .csv ou .xlsx", 'error')
-                    path_to_file = pathlib.Path(app.config['UPLOAD_PATH_NM']) / file
-                    uploaded_file.save(path_to_file)
-                    # valide en ouvrant les fichiers si le contenu est bon
+                        continue
+                    path_to_file = workspace.upload_dir(app_name) / file
+                    with profile.stage('upload_save'):
+                        uploaded_file.save(path_to_file)
                     try:
-                        validate_file_dg(path_to_file, uploaded_file_name)
-                        app.config['FILES_NM'][uploaded_file_name] = path_to_file
+                        accept_upload(workspace, app_name, uploaded_file_name, path_to_file, profile)
                     except ValueError as e:
-                        os.remove(path_to_file)
                         error_messages.append("{0}".format(e))
+            current_app.config['METRICS_STORE'].record(app_name, profile)
 
             flash("\n".join(error_messages), 'warning')
-            return redirect(url_for('node_map'))
+            return redirect(url_for('.node_map'))
 
         elif request.form['btn_id'] == 'purger' or request.form['btn_id'] == 'terminer':
-            return redirect(url_for('purge', app_name=app_name))
+            return redirect(url_for('.purge', app_name=app_name))
 
         elif request.form['btn_id'] == 'analyser':
+            if analysis_in_progress(job) or not validate_before_analysis(app_name, files):
+                return redirect(url_for('.node_map'))
+            output_format = request.form.get('output_format', 'csv')
             try:
-                nm = run_nm_analysis(app.config['FILES_NM'], pathlib.Path(app.config['GENERATED_PATH']/app_name))
-                app.config['CURRENT_OUTPUT_FILE'] = nm
-                file_nm_ready = True
-            except Exception as e:
-                error_messages.append("{0}".format(e))
-                flash("\n".join(error_messages), 'error')
+                job_id = current_app.config['JOB_MANAGER'].submit(app_name, files, workspace.generated_dir(app_name),
+                                                                  owner=workspace.id, output_format=output_format)
+                workspace.set_current_job(app_name, job_id)
+            except JobQueueFullError as e:
+                flash("{0}".format(e), 'error')
 
-            return render_template('node_map.html', uploaded_files=uploaded_files, validated_files=validated_nm_files,
-                                   file_ready=file_nm_ready)
+            return redirect(url_for('.node_map'))
 
-        elif request.form['btn_id'] == 'telecharger':
-            return redirect(url_for('download', app_name=app_name, file=app.config['CURRENT_OUTPUT_FILE']))
+        elif request.form['btn_id'] == 'telecharger' and file_nm_ready:
+            return redirect(url_for('.job_result', job_id=job_id))
 
     return render_template('node_map.html', uploaded_files=uploaded_files, validated_files=validated_nm_files,
-                           file_ready=file_nm_ready)
-
-@app.route('/<app_name>/<file>/', methods=['GET', 'POST'])
+                           file_ready=file_nm_ready, job=job)
+
+
+def send_output(path, download_name=None):
+    """
+    Send a generated file. Range requests are answered from the file as is, otherwise a .csv is
+    compressed on the fly when the client accepts gzip.
+    """
+    path = pathlib.Path(path).absolute()
+    download_name = download_name or path.name
+    if path.suffix == '.csv' and 'Range' not in request.headers and 'gzip' in request.accept_encodings:
+        response = current_app.response_class(stream_with_context(gzip_stream(path)), mimetype='text/csv')
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers['Content-Disposition'] = 'attachment; filename="{0}"'.format(download_name)
+        response.vary.add('Accept-Encoding')
+        return response
+    return send_file(path, as_attachment=True, download_name=download_name, conditional=True)
+
+
+def send_stream(chunks, download_name, mimetype):
+    response = current_app.response_class(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename="{0}"'.format(download_name)
+    return response
+
+
+@views.route('/uploads/<app_name>/<file_type>', methods=['POST'])
+def upload_start(app_name, file_type):
+    """
+    Start, or resume, the upload of a file sent in chunks. The JSON body gives the 'filename' and
+    the 'size' of the file, the response the 'id' of the upload and the 'offset' to send from.
+    """
+    if app_name not in APPS or file_type not in current_app.config[APPS[app_name]]:
+        abort(404)
+    body = request.get_json(silent=True) or {}
+    try:
+        state = start_upload(current_workspace().upload_dir(app_name), file_type,
+                             secure_filename(str(body.get('filename', ''))), int(body.get('size', 0)),
+                             current_app.config['UPLOAD_MAX_BYTES'], current_app.config['UPLOAD_EXTENSIONS'])
+    except ValueError as e:
+        return jsonify({'message': "{0}".format(e)}), 400
+    state['chunk_size'] = current_app.config['UPLOAD_CHUNK_BYTES']
+    return jsonify(state)
+
+
+@views.route('/uploads/<app_name>/<file_type>/<upload_id>', methods=['GET', 'PATCH'])
+def upload_chunk(app_name, file_type, upload_id):
+    """
+    GET gives the state of an upload, polled once it is complete until 'complete' is set: the file is
+    validated and converted by a job, then added to the workspace. PATCH appends the body to the
+    file, at the position given by the Upload-Offset header, and queues the job after the last chunk.
+    """
+    if app_name not in APPS or file_type not in current_app.config[APPS[app_name]]:
+        abort(404)
+    workspace = current_workspace()
+    upload_dir = workspace.upload_dir(app_name)
+    try:
+        if request.method == 'GET':
+            state = collect_upload(workspace, app_name, upload_dir, upload_id)
+            if state is None:
+                return jsonify({'message': "Ce téléversement n'existe pas ou a expiré"}), 404
+            return jsonify(state)
+
+        profile = Profile()
+        with upload_lock(upload_dir, upload_id):
+            with profile.stage('upload_save', rows=request.content_length):
+                state = write_chunk(upload_dir, upload_id, int(request.headers.get('Upload-Offset', -1)),
+                                    request.stream)
+            state = convert_received_upload(workspace, upload_dir, state)
+        current_app.config['METRICS_STORE'].record(app_name, profile)
+    except UploadOffsetError as e:
+        return jsonify({'message': "{0}".format(e), 'offset': e.offset}), 409
+    except ValueError as e:
+        return jsonify({'message': "{0}".format(e)}), 400
+    return jsonify(state)
+
+
+@views.route('/<app_name>/<file>/', methods=['GET', 'POST'])
 def download(app_name, file):
-    directory = os.path.abspath(os.path.join(app.config['GENERATED_PATH'], app_name))
-    filename = pathlib.Path(file).name
-    return send_from_directory(directory=directory, path=filename,
-                               as_attachment=True)
-
-
-@app.route('/purge/<app_name>', methods=['GET', 'POST'])
+    if app_name not in APPS:
+        abort(404)
+    path = current_workspace().generated_dir(app_name) / pathlib.Path(file).name
+    if not path.is_file():
+        abort(404)
+    return send_output(path)
+
+
+def workspace_job(job_id):
+    """
+    :return: The status of a job of the session workspace, None if there is no such job
+    """
+    status = current_app.config['JOB_MANAGER'].status(job_id)
+    if status is None or status.get('owner') != session.get('workspace'):
+        return None
+    return status
+
+
+@views.route('/jobs/<job_id>')
+def job_status(job_id):
+    status = workspace_job(job_id)
+    if status is None:
+        return jsonify({'id': job_id, 'state': 'unknown'}), 404
+    status.pop('traceback', None)
+    return jsonify(status)
+
+
+@views.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """
+    Status of a job as server-sent events. A single event is sent and the stream closed at once:
+    the browser reconnects after the retry delay, and a sync web worker is only held for the time of
+    reading the status file.
+    """
+    status = workspace_job(job_id)
+    if status is None:
+        abort(404)
+    status.pop('traceback', None)
+
+    body = 'retry: {0}\n\ndata: {1}\n\n'.format(current_app.config['EVENTS_RETRY_MS'], json.dumps(status))
+    response = current_app.response_class(body, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def finished_job(job_id):
+    status = workspace_job(job_id)
+    if status is None or status['state'] != DONE:
+        abort(404)
+    return status
+
+
+@views.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    return send_output(finished_job(job_id)['result'])
+
+
+@views.route('/jobs/<job_id>/result.gz')
+def job_result_gzip(job_id):
+    result = pathlib.Path(finished_job(job_id)['result'])
+    return send_stream(gzip_stream(result), result.name + '.gz', 'application/gzip')
+
+
+@views.route('/jobs/<job_id>/result.zip')
+def job_result_zip(job_id):
+    result = pathlib.Path(finished_job(job_id)['result'])
+    return send_stream(zip_stream(output_entries(result)), result.stem + '.zip', 'application/zip')
+
+
+@views.route('/jobs/<job_id>/bundle.zip')
+def job_bundle(job_id):
+    status = finished_job(job_id)
+    return send_stream(zip_stream(bundle_entries(status)), '{0}_{1}.zip'.format(status['app_name'], job_id),
+                       'application/zip')
+
+
+def network_index(job_id):
+    """
+    :return: The index of the network of a finished job of the session, published by the job and
+     loaded on the first query
+    :rtype: NetworkIndex
+    """
+    status = finished_job(job_id)
+    if status['app_name'] not in INDEXED_ANALYSES:
+        message = "L'analyse '{0}' n'a pas de réseau à interroger".format(status['app_name'])
+        abort(make_response(jsonify({'message': message}), 404))
+    files = {k: pathlib.Path(v) for k, v in status['files'].items() if v}
+    cache = ResultCache(current_app.config['CACHE_PATH'], max_bytes=current_app.config['CACHE_MAX_BYTES'])
+    from .utils.query import load_network_index
+    index = query_indexes().get(job_id, lambda: load_network_index(files, cache))
+    if index is None:
+        message = "L'index du réseau n'est plus disponible, veuillez relancer l'analyse"
+        abort(make_response(jsonify({'message': message}), 404))
+    return index
+
+
+@views.route('/query/<job_id>/<kind>/<node>')
+def query_node(job_id, kind, node):
+    """
+    Answer a query on one node: 'downstream' (nodes downstream of it), 'upstream' (path to its
+    source) or 'limiting' (node limiting its DG).
+    """
+    from .utils.query import QUERIES
+    if kind not in QUERIES:
+        abort(404)
+    index = network_index(job_id)
+    try:
+        return jsonify({'query': kind, 'node': node, 'result': getattr(index, kind)(node)})
+    except KeyError as e:
+        return jsonify({'message': e.args[0]}), 404
+    except ValueError as e:
+        return jsonify({'message': "{0}".format(e)}), 400
+
+
+@views.route('/query/<job_id>/<kind>', methods=['POST'])
+def query_nodes(job_id, kind):
+    """
+    Answer a query on many nodes, given as {"nodes": [...]} in the JSON body.
+    """
+    from .utils.query import QUERIES
+    if kind not in QUERIES:
+        abort(404)
+    body = request.get_json(silent=True) or {}
+    nodes = body.get('nodes')
+    if not isinstance(nodes, list):
+        return jsonify({'message': "Le corps de la requête doit donner la liste 'nodes'"}), 400
+    index = network_index(job_id)
+    try:
+        results, errors = index.query(kind, nodes)
+    except ValueError as e:
+        return jsonify({'message': "{0}".format(e)}), 400
+    return jsonify({'query': kind, 'results': results, 'errors': errors})
+
+
+@views.route('/metrics')
+def metrics():
+    return current_app.response_class(current_app.config['METRICS_STORE'].prometheus(),
+                                      mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+@views.route('/purge/<app_name>', methods=['GET', 'POST'])
 def purge(app_name):
-    purge_file(os.path.join(app.config['UPLOAD_PATH'], app_name))
-    purge_file(os.path.join(app.config['GENERATED_PATH'], app_name))
-    return redirect(url_for(app_name))
+    if app_name not in APPS:
+        abort(404)
+    current_workspace().purge(app_name)
+    return redirect(url_for('.' + app_name))
 
 
-@app.errorhandler(Exception)
+@views.app_errorhandler(Exception)
 def basic_error(e):
-    return "an error occured: " + str(e)
+    # the HTTP errors, such as abort(404), keep their status for the pages polling the jobs
+    if isinstance(e, HTTPException):
+        return e
+    return "an error occured: " + str(e), 500
 
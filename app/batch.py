@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Run the DG allocation and node map analyses on many studies without the web interface.
+
+A study is a directory holding network, source, open and limit files (.csv or .xlsx), or a line
+of a manifest (.json list of objects or .csv table) giving the path of each file:
+
+    name,network_file,source_file,open_file,limit_file
+    feeder_01,feeders/01/network.csv,feeders/01/source.csv,feeders/01/open.csv,feeders/01/limit.csv
+
+A study may also hold a scenarios file (scenario and section columns) listing the open sections of
+other switching configurations, compared with the open file by the dg_scenarios analysis
+(-a dg_scenarios), and a profiles file (scenario, node, limit and dg columns) giving the limit and
+DG of the nodes for many scenarios, such as seasons or hours of the year, allocated together by the
+dg_profiles analysis (-a dg_profiles).
+
+Usage:
+    python -m app.batch <studies directory or manifest> <output directory> [--workers 4]
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from .utils.cache import ResultCache, run_cached
+from .utils.engines import DEFAULT_ENGINE, ENGINES
+from .utils.jobs import get_analysis
+
+
+ANALYSES = ('dg_allocation', 'node_map')
+# analyses only run when asked for
+OPTIONAL_ANALYSES = ('all_analyses', 'dg_scenarios', 'dg_profiles')
+
+# analyses run by the engine given with --engine, the other ones by the default engine
+ENGINE_ANALYSES = ('dg_allocation', 'node_map', 'all_analyses')
+
+# file type: base name of the file in a study directory
+STUDY_FILES = {
+    'network_file': 'network',
+    'source_file': 'source',
+    'open_file': 'open',
+    'limit_file': 'limit',
+    'scenario_file': 'scenarios',
+    'profile_file': 'profiles',
+}
+
+# files needed by each analysis
+ANALYSIS_FILES = {
+    'dg_allocation': ('network_file', 'source_file', 'open_file', 'limit_file'),
+    'node_map': ('network_file', 'source_file', 'open_file'),
+    'all_analyses': ('network_file', 'source_file', 'open_file', 'limit_file'),
+    'dg_scenarios': ('network_file', 'source_file', 'open_file', 'limit_file', 'scenario_file'),
+    'dg_profiles': ('network_file', 'source_file', 'open_file', 'profile_file'),
+}
+
+SUMMARY_COLUMNS = ['study', 'analysis', 'status', 'seconds', 'output', 'message']
+
+
+def find_studies(directory):
+    """
+    :param directory: Directory holding one sub-directory per study
+    :return: The studies found, [{'name':..., 'network_file': Path, ...}]
+    """
+    studies = []
+    for study_dir in sorted(Path(directory).iterdir()):
+        if not study_dir.is_dir():
+            continue
+        study = {'name': study_dir.name}
+        for file_type, base_name in STUDY_FILES.items():
+            candidates = [f for f in study_dir.glob(base_name + '.*') if f.suffix in ('.csv', '.xlsx', '.xls')]
+            if candidates:
+                study[file_type] = sorted(candidates)[0]
+        studies.append(study)
+    return studies
+
+
+def load_manifest(manifest):
+    """
+    :param manifest: .json or .csv file listing the studies, relative paths are from its directory
+    :return: The studies of the manifest, [{'name':..., 'network_file': Path, ...}]
+    :raises ValueError: When two studies have the same name, they would share their output directory
+    """
+    manifest = Path(manifest)
+    if manifest.suffix == '.json':
+        with open(manifest) as file:
+            rows = json.load(file)
+    else:
+        with open(manifest, newline='') as file:
+            rows = list(csv.DictReader(file))
+
+    studies = []
+    names = set()
+    for idx, row in enumerate(rows):
+        study = {'name': row.get('name') or 'study_{0}'.format(idx)}
+        if study['name'] in names:
+            raise ValueError("L'étude '{0}' apparaît plusieurs fois dans le manifeste {1}".format(
+                study['name'], manifest))
+        names.add(study['name'])
+        for file_type in STUDY_FILES:
+            if row.get(file_type):
+                study[file_type] = manifest.parent / row[file_type]
+        studies.append(study)
+    return studies
+
+
+def output_name(analysis, output_format='csv', table_format='csv'):
+    from .utils.export import table_name
+    if analysis == 'node_map':
+        from .utils.node_map_tool import NM_OUTPUT_FORMATS
+        return NM_OUTPUT_FORMATS[output_format][0]
+    if analysis == 'all_analyses':
+        return 'analyses.zip'
+    if analysis == 'dg_scenarios':
+        return table_name('scenarios_dg', table_format)
+    if analysis == 'dg_profiles':
+        return 'hosting_dg.zip'
+    return table_name('allocated_dg', table_format)
+
+
+def analysis_options(analysis, output_format='csv', table_format='csv', engine=None):
+    """
+    :param engine: Name of the engine of the analysis, None for the default engine
+    :return: The keyword arguments of the analysis giving its output formats and its engine
+    """
+    if analysis == 'node_map':
+        options = {'output_format': output_format}
+    elif analysis == 'all_analyses':
+        options = {'output_format': output_format, 'table_format': table_format}
+    else:
+        options = {'output_format': table_format}
+    # only given when asked for, so that the runs of the default engine keep their cache keys
+    if engine is not None and analysis in ENGINE_ANALYSES:
+        options['engine'] = engine
+    return options
+
+
+def is_up_to_date(output, input_files):
+    """
+    :return: True if the output exists and is newer than all the input files
+    """
+    output = Path(output)
+    if not output.exists():
+        return False
+    return output.stat().st_mtime >= max(os.stat(f).st_mtime for f in input_files)
+
+
+def run_study(study, output_dir, analyses=ANALYSES, output_format='csv', force=False, cache_dir=None,
+              table_format='csv', partition_workers=1, engine=None):
+    """
+    Run the analyses of one study, in the calling process.
+
+    :param study: {'name':..., 'network_file': Path, ...}
+    :param output_dir: The outputs are written in output_dir/<study name>
+    :param analyses: Analyses to run, those missing a file of the study are reported as errors
+    :param output_format: Format of the node map, one of NM_OUTPUT_FORMATS
+    :param force: Run the analyses even if the outputs are newer than the input files
+    :param cache_dir: Directory of a result cache shared by the studies, None to disable it
+    :param table_format: Format of the DG allocation and scenario tables, one of TABLE_FORMATS
+    :param partition_workers: Processes traversing the connected parts of a large network
+    :param engine: Engine of the analyses of ENGINE_ANALYSES, None for the default engine
+    :return: One summary row per analysis
+    """
+    study_dir = Path(output_dir) / study['name']
+    study_dir.mkdir(parents=True, exist_ok=True)
+    cache = ResultCache(cache_dir) if cache_dir else None
+
+    results = []
+    for analysis in analyses:
+        row = {'study': study['name'], 'analysis': analysis, 'status': '', 'seconds': 0.0, 'output': '',
+               'message': ''}
+        results.append(row)
+
+        missing = [t for t in ANALYSIS_FILES[analysis] if not study.get(t)]
+        if missing:
+            row.update(status='error', message='missing files: {0}'.format(', '.join(missing)))
+            continue
+
+        files = {t: Path(study[t]) for t in ANALYSIS_FILES[analysis]}
+        options = analysis_options(analysis, output_format, table_format, engine)
+        output = study_dir / output_name(analysis, output_format, table_format)
+        if not force and is_up_to_date(output, files.values()):
+            row.update(status='skipped', output=str(output))
+            continue
+
+        start = time.perf_counter()
+        try:
+            result = run_cached(cache, analysis, get_analysis(analysis), files, study_dir,
+                                workers=partition_workers, **options)
+            row.update(status='done', output=str(result))
+        except Exception as e:
+            row.update(status='error', message="{0}".format(e) or traceback.format_exc(limit=1))
+        row['seconds'] = round(time.perf_counter() - start, 3)
+
+    return results
+
+
+def run_batch(studies, output_dir, workers=None, analyses=ANALYSES, output_format='csv', force=False,
+              cache_dir=None, summary_name='summary.csv', table_format='csv', partition_workers=1, engine=None):
+    """
+    Run the studies across a pool of processes and write a summary of the runs in output_dir.
+
+    :param studies: Output of find_studies or load_manifest
+    :param workers: Number of processes, the number of CPUs when None
+    :param partition_workers: Processes of each study traversing the connected parts of a large network
+    :param engine: Engine of the analyses of ENGINE_ANALYSES, None for the default engine
+    :return: The summary rows, in the order of the studies
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # keyed by position in studies, not by name
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_study, study, output_dir, analyses, output_format, force, cache_dir,
+                                   table_format, partition_workers, engine):
+                   idx for idx, study in enumerate(studies)}
+        for future in as_completed(futures):
+            idx = futures[future]
+            try:
+                results[idx] = future.result()
+            except Exception as e:
+                results[idx] = [{'study': studies[idx]['name'], 'analysis': a, 'status': 'error', 'seconds': 0.0,
+                                 'output': '', 'message': "{0}".format(e)} for a in analyses]
+
+    summary = [row for idx in range(len(studies)) for row in results[idx]]
+    with open(output_dir / summary_name, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=SUMMARY_COLUMNS)
+        writer.writeheader()
+        writer.writerows(summary)
+
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m app.batch',
+                                     description="Analyses d'allocation DG et de node map sur plusieurs études")
+    parser.add_argument('studies', help="répertoire d'études (un sous-répertoire par étude) ou manifeste .csv/.json")
+    parser.add_argument('output', help='répertoire des résultats')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='nombre de processus (défaut : nombre de CPU)')
+    parser.add_argument('-a', '--analysis', choices=ANALYSES + OPTIONAL_ANALYSES, action='append',
+                        help="analyse à lancer, peut être répété (défaut : {0})".format(', '.join(ANALYSES)))
+    parser.add_argument('--format', default='csv',
+                        help='format de sortie du node map (csv, csv.gz, xlsx, edges, bits, csr)')
+    parser.add_argument('--table-format', default='csv',
+                        help="format de sortie de l'allocation DG (csv, csv.gz, xlsx, npz)")
+    parser.add_argument('--force', action='store_true', help='relancer les études déjà à jour')
+    parser.add_argument('--cache', default=None, help='répertoire du cache de résultats partagé')
+    parser.add_argument('-p', '--partition-workers', type=int, default=1,
+                        help="processus parcourant les parties connexes d'un grand réseau, par étude (défaut : 1)")
+    parser.add_argument('--engine', choices=sorted(ENGINES), default=None,
+                        help="moteur des analyses dg_allocation, node_map et all_analyses (défaut : {0})".format(
+                            DEFAULT_ENGINE))
+    args = parser.parse_args(argv)
+
+    source = Path(args.studies)
+    try:
+        studies = find_studies(source) if source.is_dir() else load_manifest(source)
+    except ValueError as e:
+        parser.error("{0}".format(e))
+    summary = run_batch(studies, args.output, workers=args.workers, analyses=tuple(args.analysis or ANALYSES),
+                        output_format=args.format, force=args.force, cache_dir=args.cache,
+                        table_format=args.table_format, partition_workers=args.partition_workers,
+                        engine=args.engine)
+
+    errors = [row for row in summary if row['status'] == 'error']
+    for row in errors:
+        print("{study} / {analysis}: {message}".format(**row), file=sys.stderr)
+    print("{0} analyses, {1} en erreur".format(len(summary), len(errors)))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+// Téléverse les fichiers par fragments : les gros fichiers ne passent pas dans un seul envoi de
+// formulaire, et un envoi interrompu reprend là où il s'était arrêté
+(function () {
+    var inputs = document.querySelectorAll('input[type=file][data-upload-url]');
+    if (!inputs.length || !window.fetch || !window.Blob || !Blob.prototype.slice) {
+        return;
+    }
+    var form = inputs[0].form;
+    var message = document.getElementById('message');
+
+    function show(text) {
+        if (message) {
+            message.textContent = text;
+        }
+    }
+
+    function readJson(response) {
+        return response.json().then(function (body) {
+            body.httpStatus = response.status;
+            return body;
+        });
+    }
+
+    function sendChunks(url, file, state) {
+        if (state.offset >= file.size) {
+            return Promise.resolve(state);
+        }
+        var end = Math.min(state.offset + state.chunk_size, file.size);
+        show(file.name + " : " + Math.round(100 * state.offset / file.size) + " %");
+        return fetch(url, {
+            method: 'PATCH',
+            headers: {'Upload-Offset': String(state.offset), 'Content-Type': 'application/octet-stream'},
+            body: file.slice(state.offset, end)
+        }).then(readJson).then(function (body) {
+            if (body.httpStatus === 409) {
+                // le serveur a reçu une autre quantité : reprise à sa position
+                state.offset = body.offset;
+            } else if (body.httpStatus !== 200) {
+                throw new Error(body.message);
+            } else {
+                state.offset = body.offset;
+            }
+            return sendChunks(url, file, state);
+        });
+    }
+
+    // une fois reçu, le fichier est validé et converti par le serveur : son état est suivi jusqu'à la fin
+    function waitConverted(url, file) {
+        show(file.name + " : vérification");
+        return fetch(url, {cache: 'no-store'}).then(readJson).then(function (body) {
+            if (body.httpStatus !== 200) {
+                throw new Error(body.message);
+            }
+            if (body.complete) {
+                return body;
+            }
+            return new Promise(function (resolve) { setTimeout(resolve, 1000); }).then(function () {
+                return waitConverted(url, file);
+            });
+        });
+    }
+
+    function upload(input) {
+        var file = input.files[0];
+        return fetch(input.dataset.uploadUrl, {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({filename: file.name, size: file.size})
+        }).then(readJson).then(function (state) {
+            if (state.httpStatus !== 200) {
+                throw new Error(state.message);
+            }
+            var url = input.dataset.uploadUrl + '/' + state.id;
+            return sendChunks(url, file, state).then(function () { return waitConverted(url, file); });
+        });
+    }
+
+    form.addEventListener('submit', function (event) {
+        event.preventDefault();
+        var selected = Array.prototype.filter.call(inputs, function (input) { return input.files.length; });
+        var errors = [];
+        // un fichier après l'autre, les erreurs n'arrêtent pas les suivants
+        selected.reduce(function (previous, input) {
+            return previous.then(function () {
+                return upload(input).catch(function (error) { errors.push(error.message); });
+            });
+        }, Promise.resolve()).then(function () {
+            if (errors.length) {
+                show(errors.join("\n"));
+                // les fichiers acceptés apparaîtront au prochain chargement de la page
+                form.reset();
+            } else {
+                window.location.reload();
+            }
+        });
+    });
+})();
@@ -0,0 +1,60 @@
+// Suit l'avancement de l'analyse en cours et recharge la page lorsqu'elle est terminée
+(function () {
+    var statusBlock = document.getElementById('job_status');
+    if (!statusBlock || !statusBlock.dataset.statusUrl) {
+        return;
+    }
+    var labels = {queued: "En attente", running: "En cours"};
+    var stages = {
+        sequence: "séquencement", downstream: "arbre aval", allocate: "allocation",
+        table: "table", write: "écriture", scenarios: "scénarios"
+    };
+
+    // met à jour l'affichage, renvoie false lorsque l'analyse est terminée
+    function show(job) {
+        if (job.state === 'done' || job.state === 'error' || job.state === 'unknown') {
+            window.location.reload();
+            return false;
+        }
+        var text = "Analyse : " + (labels[job.state] || job.state);
+        if (job.stage) {
+            text += " — " + (stages[job.stage] || job.stage) + " " + job.done + " / " + job.total;
+        }
+        text += " (" + Math.round((job.progress || 0) * 100) + " %)";
+        statusBlock.textContent = text;
+        return true;
+    }
+
+    function poll() {
+        fetch(statusBlock.dataset.statusUrl, {cache: 'no-store'})
+            .then(function (response) { return response.json(); })
+            .then(function (job) {
+                if (show(job)) {
+                    setTimeout(poll, 2000);
+                }
+            })
+            .catch(function () { setTimeout(poll, 5000); });
+    }
+
+    // le serveur envoie le statut puis ferme la connexion, EventSource la rouvre après le délai 'retry' ;
+    // sans EventSource, ou s'il échoue, la page interroge le statut
+    if (window.EventSource && statusBlock.dataset.eventsUrl) {
+        var events = new EventSource(statusBlock.dataset.eventsUrl);
+        var received = false;
+        events.onmessage = function (message) {
+            received = true;
+            if (!show(JSON.parse(message.data))) {
+                events.close();
+            }
+        };
+        events.onerror = function () {
+            // une fermeture par le serveur est suivie d'une reconnexion, un refus ferme EventSource
+            if (!received || events.readyState === EventSource.CLOSED) {
+                events.close();
+                poll();
+            }
+        };
+    } else {
+        poll();
+    }
+})();
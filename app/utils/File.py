@@ -1,6 +1,7 @@
+import fcntl
+import io
 import re
-import pandas as pd
-import openpyxl
+from contextlib import contextmanager
 from pathlib import Path
 import os
 import json
@@ -8,10 +9,19 @@ import zipfile
 from pathlib import Path
 
 
+# pandas and openpyxl are imported by the functions reading the tables, the pages listing the files
+# of a workspace do not load them
+EXCEL_EXTENSIONS = ('.xlsx', '.xls')
+PARSED_DIR = '.parsed'
+PARSED_SUFFIX = '.npz'
+# kinds of the values of a column of objects in a converted file
+TEXT, MISSING, INTEGER, REAL, BOOLEAN = range(5)
+
+
 def get_uploads_files(upload_dir=r'.\uploads'):
     upload_dir = Path(upload_dir)
     if upload_dir.exists() and upload_dir.is_dir():
-        return [child for child in upload_dir.iterdir()]
+        return [child for child in upload_dir.iterdir() if child.is_file()]
     else:
         print("Directory ", upload_dir.name, " doesn't exist")
         return []
@@ -30,55 +40,257 @@ def purge_file(dir_name=Path(r'.\uploads')):
             file.unlink()
 
 
+# columns needed in each file of a study
+FILE_COLUMNS = {
+    "network_file": {
+        "section",
+        "start",
+        "end"
+    },
+    "source_file": {"source"},
+    "open_file": {"section"},
+    "limit_file": {
+        "node",
+        "limit",
+        "type",
+        "x",
+        "y",
+        "dg",
+        "c"
+    },
+}
+
+
 def validate_file_dg(file, type):
     """
 
     :param file: Path (pathlib) to the file to validate
     :param type: what file it is (network_file, source_file, open_file, limit_file)
-    :return: The type of file it is for the study, None is not valitated
-    """
-    cols = {
-        "network_file": {
-            "section",
-            "start",
-            "end"
-        },
-        "source_file": {"source"},
-        "open_file": {"section"},
-        "limit_file": {
-            "node",
-            "limit",
-            "type",
-            "x",
-            "y",
-            "dg",
-            "c"
-        },
-    }
+    :return: The type of file it is for the study, raise ValueError if not valitated
+    """
+    return check_columns(read_columns(file), type, file.name)
 
-    try:
-        df = pd.DataFrame(pd.read_csv(file))
-    except:
-        try:
-            df = pd.DataFrame(pd.read_excel(file, engine='openpyxl'))
-        except openpyxl.utils.exceptions.InvalidFileException as notXL:
-            return None
 
-    if cols[type].issubset(df.columns.to_list()) or cols[type].issubset(df.columns.to_list()):
+def check_columns(columns, type, file_name):
+    """
+    :param columns: Column names read from the header of the file
+    :param type: what file it is (network_file, source_file, open_file, limit_file)
+    :param file_name: Name of the file, for the error message
+    :return: The type of file it is for the study, raise ValueError if a column is missing
+    """
+    if FILE_COLUMNS[type].issubset(columns):
         return type
     else:
-        missing_col = cols[type] - set(df.columns.to_list())
+        missing_col = FILE_COLUMNS[type] - set(columns)
         raise ValueError(
             "Les colonnes {0} du fichier '{1}' semblent être manquantes ou mal écrite dans les fichiers "
-            "fournis".format(missing_col, file.name)
+            "fournis".format(missing_col, file_name)
         )
 
 
+def read_csv_header(data):
+    """
+    Read the column names from the beginning of a .csv file
+
+    :param data: First bytes of the file, up to at least the end of the first line
+    :type data: bytes
+    :return: The list of the column names, None if the header cannot be read as csv
+    """
+    import pandas as pd
+    first_line = data.split(b'\n', 1)[0]
+    try:
+        return pd.read_csv(io.BytesIO(first_line), nrows=0).columns.to_list()
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError):
+        return None
+
+
+def read_columns(file):
+    """
+    Read only the header of a .csv or .xlsx file
+
+    :param file: Path (pathlib) to the file
+    :return: The list of the column names
+    """
+    import openpyxl
+    import pandas as pd
+    file = Path(file)
+    if file.suffix not in EXCEL_EXTENSIONS:
+        try:
+            return pd.read_csv(file, nrows=0).columns.to_list()
+        except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError):
+            pass
+
+    try:
+        workbook = openpyxl.load_workbook(file, read_only=True)
+    except (openpyxl.utils.exceptions.InvalidFileException, zipfile.BadZipFile, OSError, KeyError):
+        raise ValueError("Le fichier '{0}' n'est pas un fichier .csv ou .xlsx lisible".format(file.name))
+    try:
+        first_row = next(workbook.active.iter_rows(max_row=1, values_only=True), ())
+    finally:
+        workbook.close()
+    return [c for c in first_row if c is not None]
+
+
+def save_parsed(df, path):
+    """
+    Save a table as the arrays of its columns in a .npz file, readable without pickle: the values of
+    the columns of objects are saved as text along with their kind.
+
+    :param path: Path (pathlib) to the .npz file
+    """
+    import numpy as np
+    import pandas as pd
+    arrays = {'columns': np.array([str(c) for c in df.columns]),
+              'dtypes': np.array([str(dtype) for dtype in df.dtypes])}
+    for i in range(df.shape[1]):
+        column = df.iloc[:, i]
+        if isinstance(column.dtype, np.dtype) and column.dtype.kind in 'biufcmM':
+            arrays['values{0}'.format(i)] = column.to_numpy()
+            continue
+        values = column.to_numpy(dtype=object)
+        kinds = np.full(len(values), TEXT, dtype=np.int8)
+        kinds[pd.isna(values)] = MISSING
+        for j, v in enumerate(values):
+            if kinds[j] != TEXT or isinstance(v, str):
+                continue
+            if isinstance(v, (bool, np.bool_)):
+                kinds[j] = BOOLEAN
+            elif isinstance(v, (int, np.integer)):
+                kinds[j] = INTEGER
+            elif isinstance(v, (float, np.floating)):
+                kinds[j] = REAL
+        arrays['values{0}'.format(i)] = np.array(['' if k == MISSING else str(v) for v, k in zip(values, kinds)],
+                                                 dtype=str)
+        arrays['kinds{0}'.format(i)] = kinds
+    with open(path, 'wb') as file:
+        np.savez(file, **arrays)
+
+
+def load_parsed(path):
+    """
+    :param path: Path (pathlib) to a .npz file written by save_parsed
+    :rtype: DataFrame
+    """
+    import numpy as np
+    import pandas as pd
+    with np.load(path, allow_pickle=False) as arrays:
+        columns = {}
+        for i, (name, dtype) in enumerate(zip(arrays['columns'].tolist(), arrays['dtypes'].tolist())):
+            values = arrays['values{0}'.format(i)]
+            if 'kinds{0}'.format(i) not in arrays.files:
+                columns[i] = values
+                continue
+            kinds = arrays['kinds{0}'.format(i)]
+            values = values.astype(object)
+            values[kinds == MISSING] = np.nan
+            for j in np.flatnonzero(kinds > MISSING):
+                v = values[j]
+                values[j] = int(v) if kinds[j] == INTEGER else float(v) if kinds[j] == REAL else v == 'True'
+            columns[i] = values if dtype == 'object' else pd.array(values, dtype=dtype)
+        names = arrays['columns'].tolist()
+    df = pd.DataFrame(columns)
+    df.columns = names
+    return df
+
+
+def read_table(file):
+    """
+    Read a table from a file converted by convert_upload (.npz in the '.parsed' directory), or from
+    a .csv or .xlsx file
+
+    :param file: Path (pathlib) to the file
+    :rtype: DataFrame
+    """
+    import pandas as pd
+    file = Path(file)
+    if is_parsed(file):
+        return load_parsed(file)
+    if file.suffix in EXCEL_EXTENSIONS:
+        return pd.read_excel(file, engine='openpyxl')
+    try:
+        return pd.read_csv(file)
+    except (pd.errors.ParserError, UnicodeDecodeError):
+        return pd.read_excel(file, engine='openpyxl')
+
+
+def is_parsed(file):
+    """
+    :return: True for a file converted by convert_upload, only those are read as .npz
+    """
+    file = Path(file)
+    return file.suffix == PARSED_SUFFIX and file.parent.name == PARSED_DIR
+
+
+def convert_upload(file):
+    """
+    Parse an uploaded file once and save it in a typed binary form next to it, in the '.parsed'
+    directory. The analyses load this form directly.
+
+    :param file: Path (pathlib) to the uploaded .csv or .xlsx file
+    :return: Path to the converted file
+    """
+    file = Path(file)
+    try:
+        df = read_table(file)
+    except Exception:
+        raise ValueError("Le contenu du fichier '{0}' n'a pas pu être lu".format(file.name))
+
+    parsed = create_dir_if_dont_exist(file.parent / PARSED_DIR) / (file.name + PARSED_SUFFIX)
+    save_parsed(df, parsed)
+    return parsed
+
+
+def run_upload_conversion(files, path_to_save, profile=None, progress=None, workers=1, file_type=None):
+    """
+    Validate and convert a file uploaded in chunks, as a job: a large file takes longer than a
+    request may last.
+
+    :param files: {'upload_file': Path to the uploaded file}
+    :param path_to_save: Not used, the converted file is saved next to the uploaded one
+    :param profile: Records the time of the validation and of the conversion
+    :type profile: Profile
+    :param progress: Not used
+    :param workers: Not used
+    :param file_type: What file it is (network_file, source_file, open_file, limit_file)
+    :return: Path to the converted file
+    """
+    from .metrics import Profile
+    profile = profile if profile is not None else Profile()
+    file = Path(files['upload_file'])
+    with profile.stage('upload_validate'):
+        validate_file_dg(file, file_type)
+    with profile.stage('upload_convert'):
+        return convert_upload(file)
+
+
+def original_upload(file):
+    """
+    :param file: Path to an uploaded file or to its converted form
+    :return: Path to the file as it was uploaded
+    """
+    file = Path(file)
+    if is_parsed(file):
+        return file.parent.parent / file.stem
+    return file
+
 
 def full_paths(upload_dir):
     return upload_dir / "*"
 
 
+@contextmanager
+def locked(path):
+    """
+    Hold an exclusive lock on path, created if needed, shared with the other processes of the host.
+    """
+    with open(path, 'a') as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
 def create_dir_if_dont_exist(dir_name):
     Path(dir_name).mkdir(parents=True, exist_ok=True)
     return Path(dir_name)
@@ -87,32 +299,28 @@ def create_dir_if_dont_exist(dir_name):
 def zip_files(list_of_files, zip_file_name=''):
     """
     Generate a zip file from a list of files in the location of the first file of the list
-    :param list_of_files:
-    :type list_of_files:
-    :param zip_file_name:
-    :type zip_file_name:
-    :return:
-    :rtype:
+    :param list_of_files: Paths of the files, stored at the root of the archive
+    :type list_of_files: list
+    :param zip_file_name: Name of the archive without extension, the name of the directory of the
+     first file when empty
+    :type zip_file_name: str
+    :return: The name of the zip file
+    :rtype: str
     """
-
+    wd = Path(list_of_files[0]).parent
     if zip_file_name == '':
-        file_name = Path(list_of_files[0]).parent
+        zip_file_name = wd.name
 
-    # the current working directory is changed to the directory of the first file in the list
-    # return to the previous directory after saving
-    previous_dir = Path.cwd()
-    wd = Path(list_of_files[0]).parent
-    os.chdir(wd)
-    zip_file_name += '.zip'
-    with zipfile.ZipFile(zip_file_name,
+    # the name in the archive is given explicitly, the working directory is left as is: it is
+    # shared by all the threads of the process
+    zippath = wd / (zip_file_name + '.zip')
+    with zipfile.ZipFile(zippath,
                          "w",
                          zipfile.ZIP_DEFLATED,
                          allowZip64=True) as zf:
         for file in list_of_files:
-            zf.write(Path(file).name)
+            zf.write(file, arcname=Path(file).name)
 
-    zippath = wd.joinpath(zip_file_name)
-    os.chdir(previous_dir)
     return zippath.name
 
 
@@ -0,0 +1,136 @@
+import numpy as np
+
+from .progress import report
+
+
+def depth_levels(index):
+    """
+    :param index: Radial tree of the network
+    :type index: DownstreamIndex
+    :return: The node ids of the tree grouped by depth, from the sources outwards
+    """
+    by_depth = np.argsort(index.depth, kind='stable').astype(np.int32)
+    bounds = np.flatnonzero(np.diff(index.depth[by_depth])) + 1
+    return np.split(by_depth, bounds)
+
+
+def subtree_sums(index, node_values, levels=None):
+    """
+    Sum of the values of every node and of all the nodes downstream of it, accumulated bottom-up
+    in one sweep of the depth levels.
+
+    :param index: Radial tree of the network
+    :type index: DownstreamIndex
+    :param node_values: Value of every node of the tree, or (nodes x scenarios) values
+    :type node_values: ndarray
+    :param levels: Output of depth_levels, computed when not given
+    """
+    if levels is None:
+        levels = depth_levels(index)
+
+    sums = np.array(node_values, dtype=float)
+    for nodes in reversed(levels[1:]):
+        np.add.at(sums, index.parent[nodes], sums[nodes])
+
+    return sums
+
+
+def allocate_dg_arrays(index, row_nodes, dg, limit, levels=None, progress=None):
+    """
+    Allocate the DG of every row of a network so that no node receives more than its limit.
+
+    For a node f with a downstream DG sum S, the DG of every row downstream of f is scaled by
+    limit(f) / S when that reduces it. The result is the same as processing the rows from the
+    highest sequence to the lowest and keeping the first, deepest, limiting node on ties:
+    the ratios are pushed top-down as a running minimum, preferring the deeper node.
+
+    dg and limit may be (rows x scenarios) matrices: every scenario is then allocated in the same
+    sweeps of the tree, as if allocate_dg_arrays was run on each column.
+
+    :param index: Radial tree of the network
+    :type index: DownstreamIndex
+    :param row_nodes: Node id (in index) of the further node of every row, -1 for unreached rows
+    :param dg: DG of every row
+    :param limit: Limit of the further node of every row
+    :param levels: Output of depth_levels, computed when not given
+    :param progress: Follows the three sweeps of the tree, None when not needed
+    :type progress: Progress
+    :return: new DG and limiting node id of every row, with the shape of dg
+    """
+    if levels is None:
+        levels = depth_levels(index)
+
+    n_nodes = len(index.node_labels)
+    row_nodes = np.asarray(row_nodes)
+    dg = np.asarray(dg, dtype=float)
+    limit = np.asarray(limit, dtype=float)
+    single = dg.ndim == 1
+    if single:
+        dg = dg[:, None]
+        limit = limit[:, None]
+    reached = row_nodes >= 0
+    reached_nodes = row_nodes[reached]
+
+    # DG connected at each node (missing values count as 0, as with DataFrame.sum)
+    node_dg = np.zeros((n_nodes, dg.shape[1]))
+    np.add.at(node_dg, reached_nodes, np.nan_to_num(dg[reached]))
+    downstream_dg = subtree_sums(index, node_dg, levels=levels)
+    report(progress, 'allocate', 1, 3)
+
+    # Ratio of every node that limits its downstream DG, NaN when it does not apply
+    with np.errstate(divide='ignore', invalid='ignore'):
+        row_ratio = limit[reached] / downstream_dg[reached_nodes]
+    row_ratio[downstream_dg[reached_nodes] == 0] = np.nan
+    ratio_low = np.full(node_dg.shape, np.nan)
+    ratio_high = np.full(node_dg.shape, np.nan)
+    np.fmin.at(ratio_low, reached_nodes, row_ratio)
+    np.fmax.at(ratio_high, reached_nodes, row_ratio)
+
+    # Running minimum (maximum for negative DG) from the sources outwards, the deeper node wins ties
+    best_low, node_low = _running_extremum(index, levels, ratio_low, np.less_equal, np.inf)
+    report(progress, 'allocate', 2, 3)
+    best_high, node_high = _running_extremum(index, levels, ratio_high, np.greater_equal, -np.inf)
+
+    new_dg = dg.copy()
+    limiting = np.repeat(np.where(reached, row_nodes, -1)[:, None], dg.shape[1], axis=1)
+
+    safe_nodes = np.maximum(row_nodes, 0)
+    with np.errstate(invalid='ignore'):
+        scaled_low = best_low[safe_nodes] * dg
+        scaled_high = best_high[safe_nodes] * dg
+    reduce_positive = reached[:, None] & (dg > 0) & (scaled_low < dg)
+    reduce_negative = reached[:, None] & (dg < 0) & (scaled_high < dg)
+
+    new_dg[reduce_positive] = scaled_low[reduce_positive]
+    limiting[reduce_positive] = node_low[safe_nodes][reduce_positive]
+    new_dg[reduce_negative] = scaled_high[reduce_negative]
+    limiting[reduce_negative] = node_high[safe_nodes][reduce_negative]
+
+    report(progress, 'allocate', 3, 3)
+    if single:
+        return new_dg[:, 0], limiting[:, 0]
+    return new_dg, limiting
+
+
+def _running_extremum(index, levels, node_ratio, prefer, neutral):
+    """
+    :param node_ratio: Ratio of every node, (nodes x scenarios)
+    :return: The best ratio over every node and its upstream nodes, and the node giving it
+    """
+    best = np.full(node_ratio.shape, neutral)
+    best_node = np.full(node_ratio.shape, -1, dtype=np.int32)
+
+    for depth, nodes in enumerate(levels):
+        if depth == 0:
+            inherited = np.full((len(nodes),) + node_ratio.shape[1:], neutral)
+            inherited_node = np.full(inherited.shape, -1, dtype=np.int32)
+        else:
+            parents = index.parent[nodes]
+            inherited = best[parents]
+            inherited_node = best_node[parents]
+        own = node_ratio[nodes]
+        take_own = prefer(own, inherited)
+        best[nodes] = np.where(take_own, own, inherited)
+        best_node[nodes] = np.where(take_own, nodes[:, None], inherited_node)
+
+    return best, best_node
@@ -0,0 +1,117 @@
+import json
+import platform
+import time
+import zipfile
+import zlib
+from pathlib import Path
+
+from .File import original_upload
+from .metrics import profile_path
+
+
+CHUNK_SIZE = 1 << 20
+# the outputs are very repetitive tables, the fastest level already compresses them well
+COMPRESS_LEVEL = 1
+
+
+def iter_file(path, chunk_size=CHUNK_SIZE):
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            yield chunk
+
+
+def gzip_stream(path, level=COMPRESS_LEVEL):
+    """
+    :return: Generator of the gzip compressed content of the file, compressed while it is read
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in iter_file(path):
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class _StreamBuffer:
+    """
+    Write only file object collecting what zipfile writes, emptied after each chunk. It cannot
+    seek, so zipfile writes the sizes after the data of each entry.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = bytes(self.data)
+        self.data.clear()
+        return data
+
+
+def zip_stream(entries, level=COMPRESS_LEVEL):
+    """
+    Build a zip archive while it is sent, without writing it to disk.
+
+    :param entries: (name in the archive, Path of a file or bytes) pairs
+    :return: Generator of the content of the archive
+    """
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED, allowZip64=True, compresslevel=level) as zf:
+        for arcname, content in entries:
+            if isinstance(content, bytes):
+                zf.writestr(arcname, content)
+            else:
+                # the size is unknown when the entry starts, zip64 lets it grow past 4 GB
+                with zf.open(arcname, 'w', force_zip64=True) as dest:
+                    for chunk in iter_file(content):
+                        dest.write(chunk)
+                        yield buffer.take()
+            yield buffer.take()
+    yield buffer.take()
+
+
+def output_entries(result):
+    """
+    :param result: Path of the output of a run
+    :return: Archive entries of the output and of its profile
+    """
+    result = Path(result)
+    entries = [(result.name, result)]
+    if profile_path(result).exists():
+        entries.append((profile_path(result).name, profile_path(result)))
+    return entries
+
+
+def bundle_entries(status):
+    """
+    Archive entries of everything about a run: the uploaded files in inputs/, the outputs in
+    outputs/ and the job status with the versions of the libraries in metadata.json.
+
+    :param status: Status of a finished job
+    :type status: dict
+    """
+    # only for their versions, the web workers do not load them otherwise
+    import numpy as np
+    import pandas as pd
+
+    entries = []
+    for file_type, path in (status.get('files') or {}).items():
+        if path and original_upload(path).exists():
+            entries.append(('inputs/{0}'.format(original_upload(path).name), original_upload(path)))
+    entries += [('outputs/' + name, path) for name, path in output_entries(status['result'])]
+
+    metadata = {
+        'job': {k: v for k, v in status.items() if k != 'traceback'},
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+    }
+    entries.append(('metadata.json', json.dumps(metadata, indent=2, default=str).encode()))
+    return entries
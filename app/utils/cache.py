@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import uuid
+from pathlib import Path
+
+from .metrics import Profile, profile_path
+
+
+# bump when a change of the analyses makes the cached results obsolete
+CACHE_VERSION = 2
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    :return: sha256 of the content of the file
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Content-addressed cache of analysis results on disk. An entry is a directory named by a hash of
+    the input files contents and of the parameters. The least recently used entries are removed
+    once the cache grows over max_bytes.
+
+    :param cache_dir: Directory of the cache
+    :param max_bytes: Size of the cache on disk before eviction
+    """
+
+    OBJECT_FILE = 'object.pkl'
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._digests = {}
+
+    def _digest(self, path):
+        # the same file is often hashed for the topology and for the result
+        stat = os.stat(path)
+        signature = (str(path), stat.st_size, stat.st_mtime_ns)
+        if signature not in self._digests:
+            self._digests[signature] = file_digest(path)
+        return self._digests[signature]
+
+    def key(self, kind, files, file_types=None, **params):
+        """
+        :param kind: What is cached ('dg_allocation', 'node_map', 'topology'...)
+        :param files: Input files {file type: Path}
+        :param file_types: Types of the files the entry depends on, all of them when None
+        :param params: Other parameters of the analysis
+        :return: The key of the entry
+        """
+        file_types = sorted(files) if file_types is None else sorted(file_types)
+        content = {
+            'version': CACHE_VERSION,
+            'kind': kind,
+            'files': {t: self._digest(files[t]) for t in file_types},
+            'params': params,
+        }
+        return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _entry(self, key):
+        return self.cache_dir / key
+
+    def _touch(self, entry):
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            pass
+
+    def get_file(self, key):
+        """
+        :return: Path of the cached file, None if it is not cached
+        """
+        entry = self._entry(key)
+        files = [f for f in entry.iterdir() if f.is_file()] if entry.is_dir() else []
+        if not files:
+            return None
+        self._touch(entry)
+        return files[0]
+
+    def put_file(self, key, path):
+        """
+        Copy a result file into the cache.
+        """
+        return self._put(key, lambda tmp: shutil.copy2(path, tmp / Path(path).name))
+
+    def get_object(self, key):
+        """
+        :return: The cached object, None if it is not cached
+        """
+        entry = self._entry(key)
+        try:
+            with open(entry / self.OBJECT_FILE, 'rb') as file:
+                obj = pickle.load(file)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        self._touch(entry)
+        return obj
+
+    def put_object(self, key, obj):
+        def _dump(tmp):
+            with open(tmp / self.OBJECT_FILE, 'wb') as file:
+                pickle.dump(obj, file, protocol=pickle.HIGHEST_PROTOCOL)
+        return self._put(key, _dump)
+
+    def get_dir(self, key):
+        """
+        :return: Directory of the cached entry, None if it is not cached
+        """
+        entry = self._entry(key)
+        if not entry.is_dir():
+            return None
+        self._touch(entry)
+        return entry
+
+    def put_dir(self, key, write):
+        """
+        :param write: Function writing the files of the entry into the directory it is given
+        :return: Directory of the entry
+        """
+        return self._put(key, write)
+
+    def _put(self, key, write):
+        # the entry is written aside then renamed, readers never see a partial entry
+        tmp = self.cache_dir / '.{0}.tmp'.format(uuid.uuid4().hex)
+        tmp.mkdir()
+        try:
+            write(tmp)
+            os.rename(tmp, self._entry(key))
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+        return self._entry(key)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes.
+        """
+        entries = []
+        for entry in self.cache_dir.iterdir():
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            try:
+                size = sum(f.stat().st_size for f in entry.iterdir())
+                entries.append((entry.stat().st_mtime, size, entry))
+            except FileNotFoundError:
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+def run_cached(cache, app_name, analysis, files, path_to_save, profile=None, progress=None, workers=1, **options):
+    """
+    Run an analysis, or give back its stored output when the same files and options were already
+    analysed.
+
+    :param cache: The cache, None to always run the analysis
+    :type cache: ResultCache
+    :param analysis: run_dg_analysis or run_nm_analysis
+    :param profile: Records the time and memory of each stage
+    :type profile: Profile
+    :param progress: Follows the items done in the stages of the analysis, not called on a hit
+    :type progress: Progress
+    :param workers: Processes of the analysis, which does not change its output
+    :return: Path of the output file in path_to_save
+    """
+    if cache is None:
+        return analysis(files, path_to_save, profile=profile, progress=progress, workers=workers, **options)
+
+    profile = profile if profile is not None else Profile()
+    with profile.stage('result_cache'):
+        key = cache.key(app_name, files, **options)
+        cached = cache.get_file(key)
+        if cached is not None:
+            # a copy, not a link: the next analysis rewrites its output file in place
+            result = Path(shutil.copy2(cached, Path(path_to_save) / cached.name))
+    if cached is not None:
+        profile.save(profile_path(result))
+        return result
+
+    result = analysis(files, path_to_save, cache=cache, profile=profile, progress=progress, workers=workers,
+                      **options)
+    cache.put_file(key, result)
+    return result
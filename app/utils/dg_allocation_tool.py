@@ -1,198 +1,102 @@
 import numpy as np
 import pandas as pd
-from collections import deque
 import csv
 
+from .allocation import allocate_dg_arrays
+from .downstream import DownstreamIndex, build_downstream_index
+from .export import check_table_format, export_table
+from .metrics import Profile, profile_path
+from .pipeline import get_downstream_nodes, prepare_network, section_sequence, set_downstream_dict
 
-def section_sequence(network_df, source_node):
-    # Create a dictionary to store the graph
-    graph = {}
 
-    section = network_df['section'].values
-    start = network_df['start'].values
-    end = network_df['end'].values
-
-    for sec, s, e in zip(section, start, end):
-
-        if s not in graph:
-            graph[s] = []
-        if e not in graph:
-            graph[e] = []
-        graph[s].append((e, sec))
-        graph[e].append((s, sec))
-
-    # Initialize the queue for BFS with the start node
-    queue = deque([(source_node, 0)])
-
-    # Initialize visited nodes set and the result list
-    visited = set()
-    sequence = [0] * len(section)
-    further_node = [''] * len(section)
-
-    while queue:
-        current_node, level = queue.popleft()
-        # Mark the current node as visited
-        if current_node not in visited:
-            visited.add(current_node)
-            for neighbor, section_id in graph.get(current_node, []):
-                # If the neighbor has not been visited and is not an open section
-                if neighbor not in visited :
-                    for idx, sec in enumerate(section):
-                        if sec == section_id:
-                            sequence[idx] = level + 1
-                            further_node[idx] = neighbor
-                    queue.append((neighbor, level + 1))
-
-    sequence = np.array(sequence)
-
-    return sequence, further_node
-
-
-def get_downstream_nodes(network_df, start_node):
-
-    downstream_nodes = [start_node]
-
-    is_connected = ((network_df['start'] == start_node) | (network_df['end'] == start_node))
-    to_process = network_df[is_connected]['section'].tolist()
-    is_in_to_process = network_df['section'].isin(to_process)
-    next_sequence = network_df.loc[is_in_to_process, 'sequence'].max()
-    is_next_sequence = (network_df['sequence'] == next_sequence)
-
-    to_process = network_df[is_connected & is_next_sequence]['section'].tolist()
-
-    while to_process:
-        current_section = to_process[-1]
-
-        sequence = network_df.loc[network_df['section'] == current_section, 'sequence'].values[0]
-        further_node = network_df.loc[network_df['section'] == current_section, 'further_node'].values[0]
-
-        downstream_nodes.append(further_node)
-
-        network_df = network_df[network_df['section'] != current_section]
-
-        is_next = network_df['sequence'] > sequence
-
-        connected_mask = (((network_df['start'] == further_node) |
-                           (network_df['end'] == further_node)) & is_next)
-
-        connected_df = network_df.loc[connected_mask, 'section']
-        connected_list = connected_df.values.tolist()
-
-        to_process += connected_list
-
-        to_process.remove(current_section)
-
-    return downstream_nodes
-
-
-def set_downstream_dict(node_list, network_df):
-    downstream_dict = {}
-
-    for n in node_list:
-        downstream_nodes = get_downstream_nodes(network_df, start_node=n)
-
-        downstream_dict[n] = downstream_nodes
-
-    return downstream_dict
-
-
-def allocate_dg(dg_df, downstream_dict, network_df):
+def allocate_dg(dg_df, downstream_dict, network_df, progress=None):
+    """
+    :param dg_df: Limit table with the 'node', 'limit' and 'dg' columns
+    :type dg_df: DataFrame
+    :param downstream_dict: Radial tree of the network, as returned by set_downstream_dict. Another
+     {node: [downstream nodes]} mapping, such as the one of the reference engine, is rebuilt as a
+     DownstreamIndex from network_df
+    :type downstream_dict: DownstreamIndex or dict
+    :param network_df: Network table with the 'sequence' and 'further_node' columns
+    :type network_df: DataFrame
+    :param progress: Follows the allocation, None when not needed
+    :type progress: Progress
+    :return: network_df merged with dg_df, with the 'new_dg' and 'limiting_node' columns, sorted by
+     sequence (largest to smallest)
+    """
+    if not isinstance(downstream_dict, DownstreamIndex):
+        downstream_dict = build_downstream_index(network_df, progress=progress)
 
     # Merge the dg_df to the network_df
     network_df = pd.merge(network_df, dg_df, left_on='further_node', right_on='node', how='left')
 
-    # Initiate new columns for the allocation and identification of limiting node.
-    network_df['new_dg'] = network_df['dg'].values
-    network_df['temp_dg'] = 0.0
-    network_df['limiting_node'] = network_df['further_node'].values
-
     # Sort the network_data DataFrame according to the sequence number (largest to smallest)
     network_df.sort_values(by='sequence', ascending=False, inplace=True)
 
-    # Iterate over network_data rows
-    for idx, row in network_df.iterrows():
+    row_nodes = pd.Index(downstream_dict.node_labels).get_indexer(network_df['further_node'].values)
+    row_nodes[network_df['sequence'].values <= 0] = -1
 
-        # Set the further node to a variable
-        f_node = row['further_node']
+    new_dg, limiting_ids = allocate_dg_arrays(downstream_dict, row_nodes,
+                                              dg=network_df['dg'].values, limit=network_df['limit'].values,
+                                              progress=progress)
 
-        # Get DG limit at the further_node
-        limit_at_f_node = row['limit']
+    network_df['new_dg'] = new_dg
+    limiting_labels = downstream_dict.node_labels[np.maximum(limiting_ids, 0)]
+    network_df['limiting_node'] = np.where(limiting_ids >= 0, limiting_labels, network_df['further_node'].values)
 
-        downstream_nodes = downstream_dict[f_node]
-        downstream_mask = network_df['further_node'].isin(downstream_nodes)
-        downstream_dg_sum = network_df.loc[downstream_mask, 'dg'].sum()
+    return network_df
 
-        if downstream_dg_sum == 0:
-            continue
 
-        ajus_ratio = limit_at_f_node / downstream_dg_sum
+def write_allocated_dg(prepared, path_to_save, profile, output_format='csv', progress=None):
+    """
+    Consumer of the pipeline: allocate the DG of the prepared network and write allocated_dg.
 
-        network_df.loc[downstream_mask, 'temp_dg'] = ajus_ratio * network_df.loc[downstream_mask, 'dg']
+    :type prepared: PreparedNetwork
+    :type profile: Profile
+    :param output_format: One of TABLE_FORMATS
+    :return: Path to allocated_dg.csv, or to the file of output_format
+    """
+    if prepared.limit_df is None:
+        raise ValueError("Le fichier 'limit' est nécessaire à l'allocation DG")
+    check_table_format(output_format)
 
-        dg_to_reduce_mask = network_df['temp_dg'] < network_df['new_dg']
+    with profile.stage('allocate', rows=len(prepared.network_df)):
+        network_df = prepared.engine.allocate(prepared.limit_df, prepared.downstream_dict, prepared.network_df,
+                                              progress)
 
-        downstream_to_reduce_mask = downstream_mask & dg_to_reduce_mask
+        network_df = network_df.drop(columns=['dg', 'c'])
 
-        network_df.loc[downstream_to_reduce_mask, 'new_dg'] = network_df.loc[downstream_to_reduce_mask, 'temp_dg']
-        network_df.loc[downstream_to_reduce_mask, 'limiting_node'] = f_node
+    with profile.stage('write', rows=len(network_df)):
+        path_to_save = export_table(network_df, path_to_save, 'allocated_dg', output_format)
 
-    return network_df
+    return path_to_save
 
 
-def run_dg_analysis(files, path_to_save):
+def run_dg_analysis(files, path_to_save, output_format='csv', cache=None, profile=None, progress=None,
+                    workers=1, engine=None):
     """
     :param files: Network, Source, limit and open file
     :type files: dict of Path
     :param path_to_save: Path to the generated files directory
     :type files: Path
+    :param output_format: One of TABLE_FORMATS
+    :type output_format: str
+    :param cache: Cache of the sequenced network, shared with the other analyses
+    :type cache: ResultCache
+    :param profile: Records the time and memory of each stage, saved next to the output
+    :type profile: Profile
+    :param progress: Follows the items done in the stages, None when not needed
+    :type progress: Progress
+    :param workers: Processes traversing the connected parts of a large network
+    :param engine: Name of the engine of the analysis, DEFAULT_ENGINE when None
     """
-    network_df = pd.read_csv(files["network_file"])
-    limit_df = pd.read_csv(files["limit_file"])
-    source_nodes = pd.read_csv(files["source_file"])['source'].tolist()
-    open_sections = pd.read_csv(files["open_file"])['section'].tolist()
+    check_table_format(output_format)
+    profile = profile if profile is not None else Profile()
 
-    path_to_save = path_to_save/'allocated_dg.csv'
+    prepared = prepare_network(files, cache=cache, profile=profile, progress=progress, workers=workers,
+                               engine=engine)
+    path_to_save = write_allocated_dg(prepared, path_to_save, profile, output_format, progress)
 
-    network_df = network_df[~network_df['section'].isin(open_sections)]
-
-    # Set a list of the nodes
-    selected_columns = network_df[['start', 'end']]  # Select the desired columns
-    node_list = selected_columns.values.flatten().tolist()  # Flatten the DataFrame and convert to a list
-    node_list = list(set(node_list))
-
-    s_list = []
-    fn_list = []
-    for s in source_nodes:
-        sequence, further_node = section_sequence(network_df, s)
-        s_list.append(sequence)
-        fn_list.append(further_node)
-
-    size = len(sequence)
-
-    sequence = []
-    further_node = []
-
-    for idx in range(size):
-
-        for s, fn in zip(s_list, fn_list):
-            if s[idx] > 0:
-                s_val = s[idx]
-                fn_val = fn[idx]
-                break
-
-        sequence.append(s_val)
-        further_node.append(fn_val)
-
-    # Add "sequence" and "further_node" columns to the network_data DataFrame
-    network_df['sequence'] = sequence
-    network_df['further_node'] = further_node
-
-    downstream_dict = set_downstream_dict(node_list=node_list, network_df=network_df)
-    network_df = allocate_dg(dg_df=limit_df, downstream_dict=downstream_dict, network_df=network_df)
-
-    network_df = network_df.drop(columns=['dg', 'c', 'temp_dg'])
-
-    network_df.to_csv(path_to_save)
+    profile.save(profile_path(path_to_save))
 
     return path_to_save
-
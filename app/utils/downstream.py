@@ -0,0 +1,188 @@
+import numpy as np
+import pandas as pd
+from collections.abc import Mapping
+
+from .progress import CHECK_EVERY, report
+
+
+class DownstreamIndex(Mapping):
+    """
+    Radial tree of a sequenced network, built once, answering "which nodes are downstream of X".
+
+    Every node gets an entry/exit interval of a depth first traversal of the tree: the nodes
+    downstream of a node (itself included) are the contiguous slice ``order[tin[n]:tout[n]]``.
+    The index behaves as a read only dict {node: [downstream nodes]} whose lists are only built
+    when they are read, so all of them are never held in memory at once.
+
+    Nodes are int32 ids into the single node_labels table. The {label: id} dict is only built
+    when a node is looked up by its label, and is not pickled.
+    """
+
+    def __init__(self, node_labels, parent, order, tin, tout, depth, keys=None, node_index=None):
+        self.node_labels = node_labels
+        # parent node id of every node, -1 for the roots (sources and unreached nodes)
+        self.parent = parent
+        self.order = order
+        self.tin = tin
+        self.tout = tout
+        self.depth = depth
+        self._node_index = node_index
+
+        if keys is None:
+            key_ids = np.arange(len(node_labels), dtype=np.int32)
+        else:
+            key_ids = pd.Index(node_labels).get_indexer(list(keys))
+            key_ids = pd.unique(key_ids[key_ids >= 0]).astype(np.int32)
+        # ids of the nodes exposed as keys, in the order they were given
+        self.key_ids = key_ids
+        self.is_key = np.zeros(len(node_labels), dtype=bool)
+        self.is_key[key_ids] = True
+
+    @property
+    def node_index(self):
+        if self._node_index is None:
+            self._node_index = {label: idx for idx, label in enumerate(self.node_labels.tolist())}
+        return self._node_index
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_node_index'] = None
+        return state
+
+    def restrict(self, keys):
+        """
+        :param keys: Node labels exposed by the returned index
+        :return: An index sharing the same tree, limited to the given keys
+        """
+        return DownstreamIndex(self.node_labels, self.parent, self.order, self.tin, self.tout, self.depth,
+                               keys=keys, node_index=self._node_index)
+
+    def node_id(self, label):
+        return self.node_index.get(label, -1)
+
+    def downstream_ids(self, node_id):
+        """
+        :return: The ids of the nodes downstream of the node (itself included), as a view
+        """
+        return self.order[self.tin[node_id]:self.tout[node_id]]
+
+    def __getitem__(self, label):
+        node_id = self.node_id(label)
+        if node_id < 0 or not self.is_key[node_id]:
+            raise KeyError(label)
+        return self.node_labels[self.downstream_ids(node_id)].tolist()
+
+    def __iter__(self):
+        return iter(self.node_labels[self.key_ids].tolist())
+
+    def __len__(self):
+        return len(self.key_ids)
+
+    def __contains__(self, label):
+        node_id = self.node_id(label)
+        return node_id >= 0 and bool(self.is_key[node_id])
+
+
+def build_downstream_index(network_df, progress=None, intervals=None):
+    """
+    Build the radial tree of a network from its 'sequence' and 'further_node' columns: each
+    reached section links its further node to the node at its other end.
+
+    The network is expected to be radial. If a node is the further node of several sections,
+    only the one with the lowest sequence is kept.
+
+    :param network_df: Network table with the 'start', 'end', 'sequence' and 'further_node' columns
+    :type network_df: DataFrame
+    :param progress: Follows the nodes placed in the tree, None when not needed
+    :type progress: Progress
+    :param intervals: Function giving the traversal of the tree from (parent, progress), as
+     _euler_intervals does, which is used when not given
+    :rtype: DownstreamIndex
+    """
+    n_rows = len(network_df)
+    labels = np.concatenate([network_df['start'].values, network_df['end'].values,
+                             network_df['further_node'].values])
+    codes, node_labels = pd.factorize(labels, use_na_sentinel=False)
+    start_ids = codes[:n_rows]
+    end_ids = codes[n_rows:2 * n_rows]
+    further_ids = codes[2 * n_rows:]
+    sequence = network_df['sequence'].values
+
+    reached = sequence > 0
+    child = further_ids[reached]
+    parent_of_child = np.where(start_ids[reached] == child, end_ids[reached], start_ids[reached])
+
+    # keep the closest link to a source when a node is reached more than once
+    by_sequence = np.argsort(sequence[reached], kind='stable')
+    child = child[by_sequence]
+    parent_of_child = parent_of_child[by_sequence]
+    _, first = np.unique(child, return_index=True)
+
+    n_nodes = len(node_labels)
+    parent = np.full(n_nodes, -1, dtype=np.int32)
+    parent[child[first]] = parent_of_child[first]
+    parent[parent == np.arange(n_nodes)] = -1
+
+    order, tin, tout, depth = (intervals or _euler_intervals)(parent, progress)
+
+    # '' marks the unreached rows in 'further_node', only the nodes of the network are exposed
+    node_set = pd.unique(np.concatenate([network_df['start'].values, network_df['end'].values]))
+    return DownstreamIndex(np.asarray(node_labels, dtype=object), parent, order, tin, tout, depth,
+                           keys=node_set.tolist())
+
+
+def _euler_intervals(parent, progress=None):
+    """
+    Iterative depth first traversal of the forest given by the parent array.
+
+    :return: order (node ids in traversal order), tin and tout (interval of every node in order)
+     and depth of every node
+    """
+    n_nodes = len(parent)
+
+    # children of every node, CSR-style
+    has_parent = parent >= 0
+    children = np.nonzero(has_parent)[0]
+    children = children[np.argsort(parent[children], kind='stable')]
+    indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(parent[has_parent], minlength=n_nodes), out=indptr[1:])
+
+    indptr = indptr.tolist()
+    children = children.tolist()
+    order = []
+    tin = [0] * n_nodes
+    tout = [0] * n_nodes
+    depth = [0] * n_nodes
+    seen = bytearray(n_nodes)
+
+    roots = np.nonzero(~has_parent)[0].tolist()
+    for root in roots:
+        # (node, exiting) pairs: a node is pushed again to close its interval once its subtree is done
+        stack = [(root, False)]
+        while stack:
+            node, exiting = stack.pop()
+            if exiting:
+                tout[node] = len(order)
+                continue
+            seen[node] = 1
+            tin[node] = len(order)
+            order.append(node)
+            if len(order) % CHECK_EVERY == 0:
+                report(progress, 'downstream', len(order), n_nodes)
+            stack.append((node, True))
+            d = depth[node] + 1
+            for child in children[indptr[node]:indptr[node + 1]]:
+                if not seen[child]:
+                    depth[child] = d
+                    stack.append((child, False))
+
+    # nodes on a loop of parents are not reachable from a root, they only get themselves
+    for node in range(n_nodes):
+        if not seen[node]:
+            tin[node] = len(order)
+            order.append(node)
+            tout[node] = len(order)
+    report(progress, 'downstream', n_nodes, n_nodes)
+
+    return (np.array(order, dtype=np.int32), np.array(tin, dtype=np.int32), np.array(tout, dtype=np.int32),
+            np.array(depth, dtype=np.int32))
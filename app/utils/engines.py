@@ -0,0 +1,109 @@
+"""
+Engines of the analyses: the functions sequencing a network, building its radial tree, allocating its
+DG and writing its node map. An analysis runs with the default engine unless another one is asked for,
+and benchmarks/differential.py checks that every engine gives the results of the reference engine.
+"""
+from . import reference
+from .downstream import build_downstream_index
+from .topology import build_topology, multi_source_sequence, node_labels_of
+
+DEFAULT_ENGINE = 'fast'
+
+
+class Engine:
+    """
+    :param name: Name of the engine, as given to the analyses
+    :param sequence: (network_df, source_nodes, progress) -> sequence, further node and source of every
+     row, 0 and '' for the rows no source reaches
+    :param downstream: (node_list, network_df, progress) -> mapping {node: [downstream nodes]}, for a
+     network_df with the 'sequence' and 'further_node' columns
+    :param allocate: (dg_df, downstream_dict, network_df, progress) -> network_df merged with dg_df,
+     with the 'new_dg' and 'limiting_node' columns, sorted by sequence (largest to smallest)
+    :param write_node_map: (node_list, downstream_dict, path, output_format, progress) -> path
+    :param node_map_formats: Node map formats written by the engine, None for all of NM_OUTPUT_FORMATS
+    :param description: Shown by the command line
+    """
+
+    def __init__(self, name, sequence, downstream, allocate, write_node_map, node_map_formats=None,
+                 description=''):
+        self.name = name
+        self.sequence = sequence
+        self.downstream = downstream
+        self.allocate = allocate
+        self.write_node_map = write_node_map
+        self.node_map_formats = node_map_formats
+        self.description = description
+
+    def __repr__(self):
+        return 'Engine({0!r})'.format(self.name)
+
+
+ENGINES = {}
+
+
+def register_engine(engine):
+    """
+    Make an engine available to the analyses under its name, replacing any engine of the same name.
+
+    :type engine: Engine
+    """
+    ENGINES[engine.name] = engine
+    return engine
+
+
+def get_engine(name=None):
+    """
+    :param name: Name of a registered engine, DEFAULT_ENGINE when None
+    :rtype: Engine
+    """
+    name = DEFAULT_ENGINE if name is None else name
+    if name not in ENGINES:
+        raise ValueError("Le moteur d'analyse '{0}' n'existe pas".format(name))
+    return ENGINES[name]
+
+
+def _fast_sequence(network_df, source_nodes, progress=None):
+    # every source is traversed in a single pass over the compiled graph
+    topology = build_topology(network_df)
+    sequence, further_ids, source_ids = multi_source_sequence(topology, source_nodes, progress=progress)
+    return sequence, node_labels_of(topology, further_ids), node_labels_of(topology, source_ids)
+
+
+def _fast_downstream(node_list, network_df, progress=None):
+    return build_downstream_index(network_df, progress=progress).restrict(node_list)
+
+
+def _fast_allocate(dg_df, downstream_dict, network_df, progress=None):
+    # imported on use, dg_allocation_tool imports the pipeline which imports this module
+    from .dg_allocation_tool import allocate_dg
+    return allocate_dg(dg_df, downstream_dict, network_df, progress=progress)
+
+
+def _fast_write_node_map(node_list, downstream_dict, path, output_format, progress=None):
+    from .node_map_tool import NM_OUTPUT_FORMATS
+    return NM_OUTPUT_FORMATS[output_format][1](node_list, downstream_dict, path, progress)
+
+
+def _reference_sequence(network_df, source_nodes, progress=None):
+    return reference.sources_sequence(network_df, source_nodes)
+
+
+def _reference_downstream(node_list, network_df, progress=None):
+    return reference.set_downstream_dict(node_list, network_df)
+
+
+def _reference_allocate(dg_df, downstream_dict, network_df, progress=None):
+    return reference.allocate_dg(dg_df, downstream_dict, network_df)
+
+
+def _reference_write_node_map(node_list, downstream_dict, path, output_format, progress=None):
+    # pandas compresses the .csv.gz output from the name of the file
+    reference.dict_to_table(node_list, downstream_dict).to_csv(path)
+    return path
+
+
+register_engine(Engine('fast', _fast_sequence, _fast_downstream, _fast_allocate, _fast_write_node_map,
+                       description='graphe compilé, arbre radial indexé et allocation par niveau'))
+register_engine(Engine('reference', _reference_sequence, _reference_downstream, _reference_allocate,
+                       _reference_write_node_map, ('csv', 'csv.gz'),
+                       description='première implémentation, quadratique, pour les petits réseaux'))
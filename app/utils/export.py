@@ -0,0 +1,130 @@
+import gzip
+import math
+import zipfile
+from pathlib import Path
+
+import numpy as np
+import openpyxl
+
+from .archive import COMPRESS_LEVEL
+
+
+# rows converted and written at a time, the output of a large table is never built in memory
+BATCH_ROWS = 50000
+XLSX_MAX_ROWS = 1048576
+XLSX_MAX_COLUMNS = 16384
+
+
+def open_output(path, mode='wb'):
+    """
+    Open an output file, gzip compressed when its name ends with .gz.
+    """
+    text = {'newline': ''} if 't' in mode else {}
+    if Path(path).suffix == '.gz':
+        return gzip.open(path, mode, compresslevel=COMPRESS_LEVEL, **text)
+    return open(path, mode, **text)
+
+
+def iter_batches(df, batch_rows=BATCH_ROWS):
+    for first in range(0, len(df), batch_rows):
+        yield df.iloc[first:first + batch_rows]
+
+
+def write_csv(df, path, batch_rows=BATCH_ROWS):
+    """
+    Write a table as .csv, or as .csv.gz when the name of path ends with .gz, without its index.
+    """
+    with open_output(path, 'wt') as file:
+        if df.empty:
+            df.to_csv(file, index=False)
+        for first, batch in enumerate(iter_batches(df, batch_rows)):
+            batch.to_csv(file, header=first == 0, index=False)
+    return path
+
+
+def _cell(value):
+    # empty cell for a missing value, Excel has no NaN
+    if value is None or isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def check_xlsx_size(n_rows, n_columns):
+    if n_rows + 1 > XLSX_MAX_ROWS or n_columns > XLSX_MAX_COLUMNS:
+        raise ValueError("Le résultat ({0} lignes, {1} colonnes) dépasse la taille d'une feuille Excel, "
+                         "choisir un autre format de sortie".format(n_rows, n_columns))
+
+
+def write_xlsx(df, path, batch_rows=BATCH_ROWS):
+    """
+    Write a table as .xlsx with the write-only mode of openpyxl: the rows are streamed to the file
+    instead of being kept in the workbook.
+    """
+    check_xlsx_size(len(df), len(df.columns))
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append([str(column) for column in df.columns])
+    for batch in iter_batches(df, batch_rows):
+        for row in batch.itertuples(index=False, name=None):
+            sheet.append([_cell(value) for value in row])
+    workbook.save(path)
+    return path
+
+
+def column_array(values):
+    """
+    :return: The column as an array that can be saved without pickling, object columns (labels
+     mixing numbers and text) as text with '' for the missing values
+    """
+    values = np.asarray(values)
+    if values.dtype.kind != 'O':
+        return values
+    return np.array(['' if _cell(value) is None else str(value) for value in values.tolist()], dtype=str)
+
+
+def write_npz(df, path):
+    """
+    Write a table as a columnar NumPy archive: one <column>.npy array per column, in the order of
+    the table, readable with np.load(path). Only one column is converted at a time.
+    """
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL) as archive:
+        for column in df.columns:
+            with archive.open('{0}.npy'.format(column), 'w', force_zip64=True) as file:
+                np.lib.format.write_array(file, column_array(df[column].values), allow_pickle=False)
+    return path
+
+
+# output format: (extension, writer)
+TABLE_FORMATS = {
+    'csv': ('.csv', write_csv),
+    'csv.gz': ('.csv.gz', write_csv),
+    'xlsx': ('.xlsx', write_xlsx),
+    'npz': ('.npz', write_npz),
+}
+
+
+def check_table_format(output_format):
+    if output_format not in TABLE_FORMATS:
+        raise ValueError("Le format de sortie '{0}' n'est pas supporté".format(output_format))
+
+
+def table_name(base_name, output_format='csv'):
+    """
+    :return: Name of the file of a table written in output_format, 'allocated_dg' -> 'allocated_dg.csv'
+    """
+    check_table_format(output_format)
+    return base_name + TABLE_FORMATS[output_format][0]
+
+
+def export_table(df, path_to_save, base_name, output_format='csv'):
+    """
+    :param df: Table to write
+    :type df: DataFrame
+    :param path_to_save: Directory of the output
+    :type path_to_save: Path
+    :param base_name: Name of the output without extension
+    :param output_format: One of TABLE_FORMATS
+    :return: Path to the output
+    """
+    path = Path(path_to_save) / table_name(base_name, output_format)
+    return TABLE_FORMATS[output_format][1](df, path)
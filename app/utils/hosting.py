@@ -0,0 +1,227 @@
+import shutil
+import tempfile
+import zipfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .File import EXCEL_EXTENSIONS, is_parsed, read_columns, read_table
+from .allocation import allocate_dg_arrays, depth_levels
+from .archive import COMPRESS_LEVEL
+from .export import check_table_format, column_array, export_table
+from .metrics import Profile, profile_path
+from .pipeline import prepare_network
+from .progress import report
+
+PROFILE_COLUMNS = {'scenario', 'node', 'limit', 'dg'}
+# rows x scenarios allocated in one pass, the profiles are split in passes of this size
+MAX_PASS_CELLS = 4 * 10 ** 6
+# rows of the profiles table read at once
+PROFILE_CHUNK_ROWS = 10 ** 6
+# scenarios x sections of a matrix of the analysis, about 8760 hours of a 100 000 sections network
+MAX_PROFILE_CELLS = 10 ** 9
+
+
+def _profile_chunks(file, chunk_rows):
+    """
+    :return: Function giving a new iterator of the chunks of the profiles table, up to chunk_rows
+     rows each: a .csv file is read chunk by chunk, the other formats are read once
+    """
+    file = Path(file)
+    if not is_parsed(file) and file.suffix not in EXCEL_EXTENSIONS:
+        columns = read_columns(file)
+    else:
+        df = read_table(file)
+        columns = df.columns
+    missing = PROFILE_COLUMNS - set(columns)
+    if missing:
+        raise ValueError("Les colonnes {0} du fichier '{1}' semblent être manquantes".format(missing, file.name))
+
+    if not is_parsed(file) and file.suffix not in EXCEL_EXTENSIONS:
+        return lambda: pd.read_csv(file, usecols=sorted(PROFILE_COLUMNS), chunksize=chunk_rows)
+    return lambda: (df.iloc[first:first + chunk_rows] for first in range(0, len(df), chunk_rows))
+
+
+def check_profile_size(file, n_scenarios, n_nodes, n_sections, work_dir, max_cells=MAX_PROFILE_CELLS):
+    """
+    Fail before the analysis fills its matrices on disk when they would be too large.
+
+    :param n_nodes: Nodes of the columns of the limit and dg matrices
+    :param n_sections: Rows of network_df, the columns of the new_dg and limiting matrices
+    :param work_dir: Directory of the matrices
+    """
+    cells = n_scenarios * max(n_nodes, n_sections)
+    if cells > max_cells:
+        raise ValueError("Le fichier '{0}' donne {1} scénarios pour {2} sections, soit {3} valeurs par matrice, "
+                         "au-delà du maximum de {4}: veuillez le découper en plusieurs études"
+                         .format(Path(file).name, n_scenarios, n_sections, cells, max_cells))
+    # limit, dg and their filled mask, then new_dg and limiting written twice: on disk and in the archive
+    needed = n_scenarios * (n_nodes * 17 + n_sections * 24)
+    free = shutil.disk_usage(work_dir).free
+    if needed > free:
+        raise ValueError("L'analyse du fichier '{0}' a besoin de {1:.1f} Go sur le disque, {2:.1f} Go sont libres"
+                         .format(Path(file).name, needed / 1e9, free / 1e9))
+
+
+def read_profiles(file, nodes, n_sections, work_dir, chunk_rows=PROFILE_CHUNK_ROWS, max_cells=MAX_PROFILE_CELLS,
+                  progress=None):
+    """
+    Pivot the profiles into matrices on disk, reading the table chunk by chunk: only the scenario
+    labels and a chunk of rows are held in memory.
+
+    :param file: Table with the 'scenario', 'node', 'limit' and 'dg' columns, one row per node of
+     every scenario (a season, an hour of the year...)
+    :param nodes: Nodes of the columns of the matrices, the rows of the other nodes are ignored
+    :param n_sections: Rows of the network, checked with the scenarios by check_profile_size
+    :param work_dir: Directory of the matrices
+    :type work_dir: Path
+    :return: The scenarios, the number of rows of the table, and the limit and dg (scenarios x nodes)
+     matrices mapped from work_dir, NaN for the nodes a scenario does not give
+    """
+    chunks = _profile_chunks(file, chunk_rows)
+
+    # first pass on the scenario labels only, to size the matrices
+    codes = {}
+    rows = 0
+    for chunk in chunks():
+        rows += len(chunk)
+        for scenario in pd.unique(chunk['scenario']):
+            codes.setdefault(scenario, len(codes))
+    scenarios = pd.Index(list(codes))
+    nodes = pd.Index(nodes)
+    check_profile_size(file, len(scenarios), len(nodes), n_sections, work_dir, max_cells=max_cells)
+
+    shape = (len(scenarios), len(nodes))
+    limit = np.lib.format.open_memmap(work_dir / 'limit.npy', mode='w+', dtype=np.float64, shape=shape)
+    dg = np.lib.format.open_memmap(work_dir / 'dg.npy', mode='w+', dtype=np.float64, shape=shape)
+    filled = np.lib.format.open_memmap(work_dir / 'filled.npy', mode='w+', dtype=np.bool_, shape=shape)
+    pass_size = max(1, MAX_PASS_CELLS // max(len(nodes), 1))
+    for first in range(0, len(scenarios), pass_size):
+        limit[first:first + pass_size] = np.nan
+        dg[first:first + pass_size] = np.nan
+
+    done = 0
+    for chunk in chunks():
+        done += len(chunk)
+        scenario_codes = scenarios.get_indexer(chunk['scenario'])
+        node_codes = nodes.get_indexer(chunk['node'])
+        keep = node_codes >= 0
+        scenario_codes, node_codes = scenario_codes[keep], node_codes[keep]
+        # a node given twice in a scenario keeps its first row, in the chunk then across the chunks
+        first_rows = ~pd.DataFrame({'s': scenario_codes, 'n': node_codes}).duplicated().values
+        first_rows &= ~filled[scenario_codes, node_codes]
+        scenario_codes, node_codes = scenario_codes[first_rows], node_codes[first_rows]
+        limit[scenario_codes, node_codes] = chunk['limit'].values[keep][first_rows]
+        dg[scenario_codes, node_codes] = chunk['dg'].values[keep][first_rows]
+        filled[scenario_codes, node_codes] = True
+        report(progress, 'read_profiles', done, rows)
+
+    return np.asarray(scenarios), rows, limit, dg
+
+
+def allocate_profiles(prepared, nodes, limit, dg, max_pass_cells=MAX_PASS_CELLS):
+    """
+    DG allocation of a prepared network for many limit and dg values of its nodes. The scenarios
+    are allocated together, a pass of the tree for up to max_pass_cells rows x scenarios.
+
+    :type prepared: PreparedNetwork
+    :param nodes: Nodes of the columns of limit and dg
+    :param limit: Limit of the nodes (scenarios x nodes)
+    :param dg: DG of the nodes (scenarios x nodes)
+    :return: Generator of (first scenario, new_dg, limiting node id, dg), each (scenarios x rows of
+     network_df) for the scenarios of a pass; the node ids are those of prepared.downstream_dict
+    """
+    index = prepared.downstream_dict
+    network_df = prepared.network_df
+    levels = depth_levels(index)
+
+    row_nodes = pd.Index(index.node_labels).get_indexer(network_df['further_node'].values)
+    row_nodes[network_df['sequence'].values <= 0] = -1
+    # column of the further node of every row in the matrices, as the merge of allocate_dg
+    row_columns = pd.Index(nodes).get_indexer(network_df['further_node'].values)
+    known = row_columns >= 0
+
+    pass_size = max(1, max_pass_cells // max(len(network_df), 1))
+    for first in range(0, len(limit), pass_size):
+        last = min(first + pass_size, len(limit))
+        row_limit = np.full((len(network_df), last - first), np.nan)
+        row_dg = np.full((len(network_df), last - first), np.nan)
+        row_limit[known] = limit[first:last, row_columns[known]].T
+        row_dg[known] = dg[first:last, row_columns[known]].T
+
+        new_dg, limiting = allocate_dg_arrays(index, row_nodes, row_dg, row_limit, levels=levels)
+        yield first, new_dg.T, limiting.T, row_dg.T
+
+
+def run_profile_analysis(files, path_to_save, output_format='csv', cache=None, profile=None, progress=None,
+                         workers=1):
+    """
+    :param files: Network, source, open and profile file (see read_profiles)
+    :type files: dict of Path
+    :param path_to_save: Path to the generated files directory
+    :type path_to_save: Path
+    :param output_format: Format of the summary table, one of TABLE_FORMATS
+    :param cache: Cache of the sequenced network, shared with the other analyses
+    :type cache: ResultCache
+    :param profile: Records the time and memory of each stage, saved next to the output
+    :type profile: Profile
+    :param progress: Follows the scenarios allocated
+    :type progress: Progress
+    :param workers: Processes traversing the connected parts of a large network
+    :return: Path of hosting_dg.zip, readable with np.load: the 'new_dg' and 'limiting' (index in
+     'nodes') matrices (scenarios x sections), the 'scenarios', 'section' and 'nodes' labels, and
+     the hosting_summary table of every scenario
+    """
+    check_table_format(output_format)
+    profile = profile if profile is not None else Profile()
+    path_to_save = Path(path_to_save)
+
+    prepared = prepare_network(files, cache=cache, profile=profile, progress=progress, workers=workers)
+    network_df = prepared.network_df
+    # columns of the limit and dg matrices: the further nodes of the network
+    nodes = pd.unique(network_df['further_node'])
+
+    work_dir = Path(tempfile.mkdtemp(dir=path_to_save))
+    try:
+        with profile.stage('read_profiles') as stage:
+            scenarios, stage['rows'], limit, dg = read_profiles(files['profile_file'], nodes, len(network_df),
+                                                                work_dir, progress=progress)
+
+        shape = (len(scenarios), len(network_df))
+        summary = pd.DataFrame({'scenario': scenarios, 'dg': 0.0, 'new_dg': 0.0, 'limited_sections': 0})
+        # the profiles and the results are matrices on disk, only a pass of scenarios is held in memory
+        new_dg_file = np.lib.format.open_memmap(work_dir / 'new_dg.npy', mode='w+', dtype=np.float64, shape=shape)
+        limiting_file = np.lib.format.open_memmap(work_dir / 'limiting.npy', mode='w+', dtype=np.int32, shape=shape)
+        with profile.stage('allocate', rows=shape[0] * shape[1]):
+            for first, new_dg, limiting, row_dg in allocate_profiles(prepared, nodes, limit, dg):
+                last = first + len(new_dg)
+                new_dg_file[first:last] = new_dg
+                limiting_file[first:last] = limiting
+                summary.loc[first:last - 1, 'dg'] = np.nansum(row_dg, axis=1)
+                summary.loc[first:last - 1, 'new_dg'] = np.nansum(new_dg, axis=1)
+                with np.errstate(invalid='ignore'):
+                    summary.loc[first:last - 1, 'limited_sections'] = (new_dg < row_dg).sum(axis=1)
+                report(progress, 'allocate', last, len(scenarios))
+        new_dg_file.flush()
+        limiting_file.flush()
+        del new_dg_file, limiting_file, limit, dg
+
+        with profile.stage('write', rows=shape[0] * shape[1]):
+            summary_path = export_table(summary, work_dir, 'hosting_summary', output_format)
+            labels = {'scenarios': scenarios, 'section': network_df['section'].values,
+                      'nodes': prepared.downstream_dict.node_labels}
+            path_to_save = path_to_save / 'hosting_dg.zip'
+            with zipfile.ZipFile(path_to_save, 'w', compression=zipfile.ZIP_DEFLATED,
+                                 compresslevel=COMPRESS_LEVEL, allowZip64=True) as archive:
+                for name, values in labels.items():
+                    with archive.open('{0}.npy'.format(name), 'w', force_zip64=True) as file:
+                        np.lib.format.write_array(file, column_array(values), allow_pickle=False)
+                for path in (work_dir / 'new_dg.npy', work_dir / 'limiting.npy', summary_path):
+                    archive.write(path, arcname=path.name)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    profile.save(profile_path(path_to_save))
+
+    return path_to_save
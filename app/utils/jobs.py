@@ -0,0 +1,308 @@
+import fcntl
+import json
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+from .File import locked
+from .cache import ResultCache, run_cached
+from .metrics import MetricsStore, Profile, profile_path
+from .progress import Progress
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+ERROR = 'error'
+
+# jobs whose output is not kept in the result cache
+UNCACHED_ANALYSES = ('convert_upload',)
+# jobs publishing the index of their network for the queries, at their end
+INDEXED_ANALYSES = ('dg_allocation', 'node_map', 'all_analyses')
+
+# sub-directories of jobs_dir shared by the web workers: a file per accepted job holding the pid of the
+# process in charge of it, and the lock files of the analyses allowed to run at the same time
+ACTIVE_DIR = 'active'
+SLOTS_DIR = 'slots'
+# seconds between two looks for a free slot
+SLOT_WAIT_SECONDS = 0.2
+# lock file of jobs_dir held while a status file is updated
+STATUS_LOCK = 'status.lock'
+
+
+class JobQueueFullError(Exception):
+    pass
+
+
+def get_analysis(app_name):
+    # imported in the worker process only
+    if app_name == 'dg_allocation':
+        from .dg_allocation_tool import run_dg_analysis
+        return run_dg_analysis
+    if app_name == 'node_map':
+        from .node_map_tool import run_nm_analysis
+        return run_nm_analysis
+    if app_name == 'all_analyses':
+        from .pipeline import run_all_analysis
+        return run_all_analysis
+    if app_name == 'dg_scenarios':
+        from .scenarios import run_scenario_analysis
+        return run_scenario_analysis
+    if app_name == 'dg_profiles':
+        from .hosting import run_profile_analysis
+        return run_profile_analysis
+    if app_name == 'convert_upload':
+        from .File import run_upload_conversion
+        return run_upload_conversion
+    raise ValueError("L'analyse '{0}' n'existe pas".format(app_name))
+
+
+def write_status(jobs_dir, job_id, **fields):
+    """
+    Update the status file of a job. The update is made under a lock shared by the processes writing
+    the status files, the web workers and the analyses, and the file is replaced atomically so that
+    any process reading it gets either the previous or the new status. A finished job keeps its
+    outcome: a late update of its progress does not make it running again.
+    """
+    path = Path(jobs_dir) / '{0}.json'.format(job_id)
+    with locked(Path(jobs_dir) / STATUS_LOCK):
+        status = read_status(jobs_dir, job_id) or {'id': job_id}
+        if status.get('state') in (DONE, ERROR):
+            return status
+        status.update(fields)
+        tmp_path = path.with_suffix('.{0}.tmp'.format(os.getpid()))
+        with open(tmp_path, 'w') as file:
+            json.dump(status, file)
+        os.replace(tmp_path, path)
+    return status
+
+
+def read_status(jobs_dir, job_id):
+    """
+    :return: The status of the job as a dict, None if the job does not exist
+    """
+    if not isinstance(job_id, str) or not job_id.isalnum():
+        return None
+    path = Path(jobs_dir) / '{0}.json'.format(job_id)
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def set_active(jobs_dir, job_id, pid=None):
+    """
+    Mark a job as accepted and not finished, in the charge of the process pid (this one when None).
+    """
+    path = Path(jobs_dir) / ACTIVE_DIR / job_id
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.{0}.tmp'.format(os.getpid()))
+    tmp_path.write_text(str(os.getpid() if pid is None else pid))
+    os.replace(tmp_path, path)
+
+
+def clear_active(jobs_dir, job_id):
+    (Path(jobs_dir) / ACTIVE_DIR / job_id).unlink(missing_ok=True)
+
+
+def active_jobs(jobs_dir):
+    """
+    Jobs accepted and not finished, by any web worker. The jobs whose process has died, with the web
+    worker or the server, are recorded as failed and no longer counted.
+
+    :return: The ids of the jobs
+    """
+    active = []
+    for path in (Path(jobs_dir) / ACTIVE_DIR).glob('*'):
+        if path.suffix == '.tmp':
+            continue
+        try:
+            pid = int(path.read_text())
+        except FileNotFoundError:
+            continue
+        except ValueError:
+            pid = None
+        if pid is None or _pid_alive(pid):
+            active.append(path.name)
+            continue
+        status = read_status(jobs_dir, path.name)
+        if status is not None and status.get('state') in (QUEUED, RUNNING):
+            write_status(jobs_dir, path.name, state=ERROR, finished=time.time(),
+                         message="L'analyse a été interrompue, veuillez la relancer")
+        path.unlink(missing_ok=True)
+    return active
+
+
+@contextmanager
+def job_slot(jobs_dir, max_running):
+    """
+    Wait for one of the max_running slots shared by the web workers, and hold it. A slot is a lock
+    on a file, released by the system if the process dies.
+    """
+    slots_dir = Path(jobs_dir) / SLOTS_DIR
+    slots_dir.mkdir(parents=True, exist_ok=True)
+    while True:
+        for slot in range(max(max_running, 1)):
+            file = open(slots_dir / '{0}.lock'.format(slot), 'a')
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                file.close()
+                continue
+            try:
+                yield slot
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+                file.close()
+            return
+        time.sleep(SLOT_WAIT_SECONDS)
+
+
+def run_job(jobs_dir, job_id, app_name, files, path_to_save, options, cache_dir=None, cache_max_bytes=None,
+            metrics_db=None, partition_workers=1, max_running=2):
+    """
+    Run an analysis in the worker process, once one of the max_running slots shared by the web
+    workers is free, and record its outcome in the status file of the job.
+
+    :param metrics_db: SQLite file of the MetricsStore the stages of the run are added to
+    :param partition_workers: Processes of the analysis traversing the connected parts of a large network
+    :param max_running: Analyses running at the same time across all the web workers
+    """
+    try:
+        with job_slot(jobs_dir, max_running):
+            set_active(jobs_dir, job_id)
+            return _run_analysis(jobs_dir, job_id, app_name, files, path_to_save, options, cache_dir,
+                                 cache_max_bytes, metrics_db, partition_workers)
+    finally:
+        clear_active(jobs_dir, job_id)
+
+
+def _run_analysis(jobs_dir, job_id, app_name, files, path_to_save, options, cache_dir, cache_max_bytes,
+                  metrics_db, partition_workers):
+    write_status(jobs_dir, job_id, state=RUNNING, started=time.time(), progress=0.0)
+    profile = Profile()
+    # the stage of the analysis and its items done, at most twice a second in the status file
+    progress = Progress(lambda stage, done, total: write_status(
+        jobs_dir, job_id, stage=stage, done=done, total=total, progress=done / total if total else 1.0))
+    try:
+        cache = ResultCache(cache_dir, max_bytes=cache_max_bytes) \
+            if cache_dir and app_name not in UNCACHED_ANALYSES else None
+        result = run_cached(cache, app_name, get_analysis(app_name), files, Path(path_to_save), profile=profile,
+                            progress=progress, workers=partition_workers, **options)
+        if cache is not None and app_name in INDEXED_ANALYSES:
+            from .query import publish_network_index
+            with profile.stage('network_index'):
+                publish_network_index({k: Path(v) for k, v in files.items() if v}, cache)
+    except Exception as e:
+        write_status(jobs_dir, job_id, state=ERROR, finished=time.time(), message="{0}".format(e),
+                     traceback=traceback.format_exc())
+        return None
+    finally:
+        if metrics_db:
+            MetricsStore(metrics_db).record(app_name, profile)
+
+    result = Path(result).absolute()
+    write_status(jobs_dir, job_id, state=DONE, finished=time.time(), progress=1.0, result=str(result),
+                 profile=str(profile_path(result)))
+    return str(result)
+
+
+class JobManager:
+    """
+    Run the analyses in a pool of worker processes. The status of every job is kept in a JSON file
+    of jobs_dir, so that it can be read from any web worker. The limits are shared by all the
+    JobManager of the same jobs_dir, one per web worker.
+
+    :param jobs_dir: Directory of the job status files
+    :param max_workers: Number of analyses running at the same time, across the web workers
+    :param max_queued: Number of analyses accepted (running or waiting) before new ones are refused,
+     across the web workers
+    :param cache_dir: Directory of the result cache, None to disable it
+    :param cache_max_bytes: Size of the result cache on disk
+    :param metrics_db: SQLite file of the MetricsStore, None to not record the stages of the jobs
+    :param partition_workers: Processes of each analysis traversing the connected parts of a large network
+    """
+
+    def __init__(self, jobs_dir, max_workers=2, max_queued=8, cache_dir=None, cache_max_bytes=2 * 1024 ** 3,
+                 metrics_db=None, partition_workers=1):
+        self.jobs_dir = Path(jobs_dir)
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.cache_dir = str(cache_dir) if cache_dir else None
+        self.cache_max_bytes = cache_max_bytes
+        self.metrics_db = str(metrics_db) if metrics_db else None
+        self.partition_workers = partition_workers
+        self._executor = None
+        self._lock = threading.Lock()
+        (self.jobs_dir / ACTIVE_DIR).mkdir(parents=True, exist_ok=True)
+
+    def _get_executor(self):
+        if self._executor is None:
+            # spawn: the web worker may run threads, which do not survive a fork
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def submit(self, app_name, files, path_to_save, owner=None, **options):
+        """
+        :param app_name: 'dg_allocation' or 'node_map'
+        :param files: Input files of the analysis
+        :type files: dict of Path
+        :param path_to_save: Path to the generated files directory
+        :param owner: Id of the workspace submitting the job
+        :param options: Keyword arguments of the analysis function
+        :return: The id of the job
+        """
+        # the jobs of every web worker are counted, under a lock shared with them
+        with self._lock, locked(self.jobs_dir / 'active.lock'):
+            if len(active_jobs(self.jobs_dir)) >= self.max_queued:
+                raise JobQueueFullError("Trop d'analyses sont en cours, veuillez réessayer plus tard")
+
+            job_id = uuid.uuid4().hex
+            files = {k: str(v) if v else v for k, v in files.items()}
+            write_status(self.jobs_dir, job_id, app_name=app_name, owner=owner, state=QUEUED, progress=0.0,
+                         submitted=time.time(), message='', result=None, files=files, options=options)
+            # in the charge of this web worker until a slot is free
+            set_active(self.jobs_dir, job_id)
+            future = self._get_executor().submit(run_job, str(self.jobs_dir), job_id, app_name, files,
+                                                 str(path_to_save), options, self.cache_dir, self.cache_max_bytes,
+                                                 self.metrics_db, self.partition_workers, self.max_workers)
+            future.add_done_callback(lambda f: self._check_crash(job_id, f))
+
+        return job_id
+
+    def _check_crash(self, job_id, future):
+        # run_job records its own errors, an exception here means the worker process died
+        if future.cancelled() or future.exception() is not None:
+            clear_active(self.jobs_dir, job_id)
+        if not future.cancelled() and future.exception() is not None:
+            if isinstance(future.exception(), BrokenProcessPool):
+                self._executor = None
+            write_status(self.jobs_dir, job_id, state=ERROR, finished=time.time(),
+                         message="{0}".format(future.exception()))
+
+    def status(self, job_id):
+        return read_status(self.jobs_dir, job_id)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,129 @@
+import json
+import sqlite3
+import time
+import tracemalloc
+from contextlib import closing, contextmanager
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+def peak_rss():
+    """
+    :return: The highest resident memory of the process so far in bytes, None when unknown
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Profile:
+    """
+    Wall time, row count and memory of every stage of a run.
+
+    :param trace_memory: Measure the peak of memory allocated during each stage with tracemalloc.
+     It is precise but slows the run down, otherwise the peak resident memory of the process is used.
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages = []
+        self.started = time.time()
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        """
+        Measure a stage. The row count can be set on the yielded dict: stage['rows'] = len(df)
+        """
+        record = {'stage': name, 'rows': rows}
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            if self.trace_memory:
+                record['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            else:
+                record['peak_bytes'] = peak_rss()
+            self.stages.append(record)
+
+    def to_dict(self):
+        return {
+            'started': self.started,
+            'seconds': sum(s['seconds'] for s in self.stages),
+            'stages': self.stages,
+        }
+
+    def save(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file, indent=2)
+        return path
+
+
+def profile_path(output):
+    """
+    :return: Path of the JSON profile saved next to an output file, node_map.csv.gz gives
+     node_map.profile.json
+    """
+    return output.with_name(output.name.partition('.')[0] + '.profile.json')
+
+
+class MetricsStore:
+    """
+    Totals of the stage measures, in a SQLite file so that every process (web workers and analysis
+    workers) adds to the same metrics.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        with closing(self._connect()) as con:
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('CREATE TABLE IF NOT EXISTS stage_metrics ('
+                        'app TEXT NOT NULL, stage TEXT NOT NULL, runs INTEGER NOT NULL, seconds REAL NOT NULL, '
+                        'rows INTEGER NOT NULL, peak_bytes INTEGER NOT NULL, PRIMARY KEY (app, stage))')
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def record(self, app_name, profile):
+        """
+        Add the stages of a profile to the totals.
+        """
+        with closing(self._connect()) as con:
+            con.execute('BEGIN IMMEDIATE')
+            for s in profile.stages:
+                con.execute(
+                    'INSERT INTO stage_metrics (app, stage, runs, seconds, rows, peak_bytes) VALUES (?, ?, 1, ?, ?, ?) '
+                    'ON CONFLICT (app, stage) DO UPDATE SET runs = runs + 1, seconds = seconds + excluded.seconds, '
+                    'rows = rows + excluded.rows, peak_bytes = MAX(peak_bytes, excluded.peak_bytes)',
+                    (app_name, s['stage'], s['seconds'], s['rows'] or 0, s['peak_bytes'] or 0))
+            con.execute('COMMIT')
+
+    def prometheus(self):
+        """
+        :return: The metrics in the Prometheus text format
+        """
+        with closing(self._connect()) as con:
+            rows = con.execute('SELECT app, stage, runs, seconds, rows, peak_bytes FROM stage_metrics '
+                               'ORDER BY app, stage').fetchall()
+
+        metrics = [
+            ('analysis_stage_runs_total', 'counter', 'Number of runs of the stage', 2),
+            ('analysis_stage_seconds_total', 'counter', 'Wall time spent in the stage', 3),
+            ('analysis_stage_rows_total', 'counter', 'Rows processed by the stage', 4),
+            ('analysis_stage_peak_bytes', 'gauge', 'Highest memory peak measured during the stage', 5),
+        ]
+        lines = []
+        for name, kind, help_text, column in metrics:
+            lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for row in rows:
+                lines.append('{0}{{app="{1}",stage="{2}"}} {3}'.format(name, row[0], row[1], row[column]))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,69 @@
+from pathlib import Path
+
+import numpy as np
+
+# label of the '' placeholder of the unreached rows in an integer label table
+MISSING_LABEL = np.iinfo(np.int64).min
+
+
+def _as_integer(v):
+    # a float label without fraction is the integer label of a column read as floats (12.0 is 12)
+    if isinstance(v, (float, np.floating)) and v == v and float(v).is_integer():
+        return int(v)
+    return v
+
+
+def intern_labels(node_labels):
+    """
+    Compact table of node labels that can be saved without pickling and memory-mapped: int64 when
+    all the labels are integers (the '' placeholder of the unreached rows aside, stored as
+    MISSING_LABEL), fixed width text otherwise. Float labels without fraction count as integers,
+    as in a node column read as floats because of a missing value.
+
+    :param node_labels: Labels of the nodes, by node id
+    :return: The labels as an int64 or unicode array
+    """
+    values = [_as_integer(v) for v in node_labels]
+    if all(isinstance(v, (int, np.integer)) and not isinstance(v, bool) or v == '' for v in values):
+        return np.array([MISSING_LABEL if v == '' else v for v in values], dtype=np.int64)
+    return np.array([str(v) for v in values], dtype=str)
+
+
+def label_key(labels, node):
+    """
+    :param labels: Label table, as returned by intern_labels
+    :param node: Label of a node, as given in a query ('12' and '12.0' find the node 12)
+    :return: The label as stored in the table, None if no label of the table can match it
+    """
+    if labels.dtype.kind == 'i':
+        try:
+            return int(str(node))
+        except ValueError:
+            pass
+        try:
+            value = float(str(node))
+        except ValueError:
+            return None
+        return int(value) if value.is_integer() else None
+    return str(_as_integer(node))
+
+
+def save_arrays(directory, arrays):
+    """
+    Save arrays as .npy files of a directory, one per name.
+
+    :param arrays: {name: ndarray}, no object arrays
+    """
+    for name, array in arrays.items():
+        np.save(Path(directory) / '{0}.npy'.format(name), np.ascontiguousarray(array), allow_pickle=False)
+
+
+def load_arrays(directory, mmap=True):
+    """
+    Load the arrays saved by save_arrays. Memory-mapped, the processes attached to the same files
+    share their pages instead of each holding a copy.
+
+    :return: {name: ndarray}, read only when memory-mapped
+    """
+    return {path.stem: np.load(path, mmap_mode='r' if mmap else None, allow_pickle=False)
+            for path in sorted(Path(directory).glob('*.npy'))}
@@ -1,163 +1,278 @@
 import numpy as np
+import openpyxl
 import pandas as pd
-from collections import deque
 
+from .engines import get_engine
+from .export import check_xlsx_size, open_output
+from .metrics import Profile, profile_path
+from .pipeline import get_downstream_nodes, prepare_network, section_sequence, set_downstream_dict
+from .progress import CHECK_EVERY, report
 
-def section_sequence(network_df, source_node):
-    # Create a dictionary to store the graph
-    graph = {}
 
-    section = network_df['section'].values
-    start = network_df['start'].values
-    end = network_df['end'].values
+def dict_to_table(node_list, downstream_dict, progress=None):
 
-    for sec, s, e in zip(section, start, end):
-
-        if s not in graph:
-            graph[s] = []
-        if e not in graph:
-            graph[e] = []
-        graph[s].append((e, sec))
-        graph[e].append((s, sec))
-
-    # Initialize the queue for BFS with the start node
-    queue = deque([(source_node, 0)])
+    downstream_nodes_table = pd.DataFrame(0, index=node_list, columns=node_list)
 
-    # Initialize visited nodes set and the result list
-    visited = set()
-    sequence = [0] * len(section)
-    further_node = [''] * len(section)
+    total = len(downstream_dict)
+    for done, (node, dowstream_nodes) in enumerate(downstream_dict.items()):
+        if done % CHECK_EVERY == 0:
+            report(progress, 'table', done, total)
+        for dn in dowstream_nodes:
+            if dn in downstream_nodes_table.index:
+                downstream_nodes_table.at[dn, node] = 1
+    report(progress, 'table', total, total)
 
-    while queue:
-        current_node, level = queue.popleft()
-        # Mark the current node as visited
-        if current_node not in visited:
-            visited.add(current_node)
-            for neighbor, section_id in graph.get(current_node, []):
-                # If the neighbor has not been visited and is not an open section
-                if neighbor not in visited :
-                    for idx, sec in enumerate(section):
-                        if sec == section_id:
-                            sequence[idx] = level + 1
-                            further_node[idx] = neighbor
-                    queue.append((neighbor, level + 1))
+    return downstream_nodes_table
 
-    sequence = np.array(sequence)
 
-    return sequence, further_node
+# cells of the node map table built at a time by _table_cells, about 40 MB of arrays
+BATCH_CELLS = 1 << 20
 
 
-def get_downstream_nodes(network_df, start_node):
+def _csv_field(label):
+    field = str(label)
+    if any(c in field for c in ',"\r\n'):
+        field = '"' + field.replace('"', '""') + '"'
+    return field
 
-    downstream_nodes = [start_node]
 
-    is_connected = ((network_df['start'] == start_node) | (network_df['end'] == start_node))
-    to_process = network_df[is_connected]['section'].tolist()
-    is_in_to_process = network_df['section'].isin(to_process)
-    next_sequence = network_df.loc[is_in_to_process, 'sequence'].max()
-    is_next_sequence = (network_df['sequence'] == next_sequence)
+def _table_positions(node_list, downstream_dict):
+    """
+    :return: The position in node_list of every node id of the index, -1 when it is not in the list
+    """
+    positions = np.full(len(downstream_dict.node_labels), -1, dtype=np.int64)
+    node_ids = pd.Index(downstream_dict.node_labels).get_indexer(node_list)
+    positions[node_ids[node_ids >= 0]] = np.flatnonzero(node_ids >= 0)
+    return positions, node_ids
 
-    to_process = network_df[is_connected & is_next_sequence]['section'].tolist()
 
-    while to_process:
-        current_section = to_process[-1]
+def _table_cells(node_list, downstream_dict, batch_cells=BATCH_CELLS, progress=None):
+    """
+    Cells set to 1 in the node map table, as (row, column) positions in node_list, column by column.
+    The row is a node downstream of the node of the column. The batches are cut on the number of
+    cells, not of columns: a column of a source node holds the whole feeder. progress follows the
+    columns done.
 
-        sequence = network_df.loc[network_df['section'] == current_section, 'sequence'].values[0]
-        further_node = network_df.loc[network_df['section'] == current_section, 'further_node'].values[0]
+    :param batch_cells: Cells per batch, which bounds the memory of a batch
+    :return: Generator of (rows, columns) arrays, one pair per batch of cells
+    """
+    positions, node_ids = _table_positions(node_list, downstream_dict)
+    in_index = np.flatnonzero(node_ids >= 0)
+    ids = node_ids[in_index]
+    tin = downstream_dict.tin[ids].astype(np.int64)
+    lengths = downstream_dict.tout[ids].astype(np.int64) - tin
+    # the cells of the columns, one after the other, are the concatenation of their order[tin:tout]
+    ends = np.cumsum(lengths)
+    total = int(ends[-1]) if len(ends) else 0
+
+    for first in range(0, total, batch_cells):
+        cells = np.arange(first, min(first + batch_cells, total), dtype=np.int64)
+        column = np.searchsorted(ends, cells, side='right')
+        rows = positions[downstream_dict.order[tin[column] + cells - ends[column] + lengths[column]]]
+        columns = in_index[column]
+        in_table = rows >= 0
+        yield rows[in_table], columns[in_table]
+        report(progress, 'write', int(columns[-1]) + 1, len(node_list))
+    report(progress, 'write', len(node_list), len(node_list))
+
+
+def _dense_rows(node_list, downstream_dict, progress=None):
+    """
+    Rows of the node map table, one at a time: the row of a node holds a 1 in the column of the
+    node itself and of all its upstream nodes. progress follows the rows done.
 
-        downstream_nodes.append(further_node)
+    :return: Generator of (node, positions in node_list of the columns set to 1)
+    """
+    positions, node_ids = _table_positions(node_list, downstream_dict)
+    parent = downstream_dict.parent.tolist()
+    tin = downstream_dict.tin.tolist()
+    tout = downstream_dict.tout.tolist()
+    positions = positions.tolist()
+
+    total = len(node_list)
+    for done, (node, node_id) in enumerate(zip(node_list, node_ids.tolist())):
+        if done % CHECK_EVERY == 0:
+            report(progress, 'write', done, total)
+        set_cells = []
+        current = node_id
+        # walk up while the node stays inside the interval of the upstream node
+        while current >= 0 and (current == node_id or tin[current] <= tin[node_id] < tout[current]):
+            if positions[current] >= 0:
+                set_cells.append(positions[current])
+            current = parent[current]
+        yield node, set_cells
+    report(progress, 'write', total, total)
+
+
+def write_dense_csv(node_list, downstream_dict, path, progress=None):
+    """
+    Write the node map table with the layout of dict_to_table(...).to_csv(path), one row at a
+    time, without building the table in memory. The file is gzip compressed when its name ends
+    with .gz.
+    """
+    # one '0,' per column, the last comma is replaced by the end of line
+    cells = bytearray(b'0,' * len(node_list))
+    if cells:
+        cells[-1] = ord('\n')
+    else:
+        cells = bytearray(b'\n')
+
+    with open_output(path) as file:
+        file.write(','.join([''] + [_csv_field(n) for n in node_list]).encode() + b'\n')
+        for node, set_cells in _dense_rows(node_list, downstream_dict, progress):
+            for cell in set_cells:
+                cells[2 * cell] = ord('1')
+            file.write(_csv_field(node).encode() + b',' + cells)
+            for cell in set_cells:
+                cells[2 * cell] = ord('0')
+
+    return path
+
+
+def write_dense_xlsx(node_list, downstream_dict, path, progress=None):
+    """
+    Write the node map table as .xlsx, streamed one row at a time with the write-only mode of
+    openpyxl. Only for networks fitting in the columns of a sheet.
+    """
+    check_xlsx_size(len(node_list), len(node_list) + 1)
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append([None] + list(node_list))
 
-        network_df = network_df[network_df['section'] != current_section]
+    cells = [0] * len(node_list)
+    for node, set_cells in _dense_rows(node_list, downstream_dict, progress):
+        for cell in set_cells:
+            cells[cell] = 1
+        sheet.append([node] + cells)
+        for cell in set_cells:
+            cells[cell] = 0
 
-        is_next = network_df['sequence'] > sequence
+    workbook.save(path)
+    return path
 
-        connected_mask = (((network_df['start'] == further_node) |
-                           (network_df['end'] == further_node)) & is_next)
 
-        connected_df = network_df.loc[connected_mask, 'section']
-        connected_list = connected_df.values.tolist()
+def write_edge_list(node_list, downstream_dict, path, progress=None):
+    """
+    Write the node map as an edge list: one (node, downstream_node) line per 1 of the table.
+    """
+    labels = [_csv_field(n) for n in node_list]
 
-        to_process += connected_list
+    with open(path, 'w', newline='') as file:
+        file.write('node,downstream_node\n')
+        for rows, columns in _table_cells(node_list, downstream_dict, progress=progress):
+            file.writelines(labels[c] + ',' + labels[r] + '\n' for r, c in zip(rows.tolist(), columns.tolist()))
 
-        to_process.remove(current_section)
+    return path
 
-    return downstream_nodes
 
+def write_packed_matrix(node_list, downstream_dict, path, progress=None):
+    """
+    Write the node map table as a bit-packed NumPy matrix (np.savez_compressed): 'bits' holds the
+    rows of the table packed with np.packbits along the columns, 'labels' the nodes of the rows and
+    columns. np.unpackbits(bits, axis=1, count=len(labels)) gives back the table.
+    """
+    n_nodes = len(node_list)
+    bits = np.zeros((n_nodes, (n_nodes + 7) // 8), dtype=np.uint8)
+    for rows, columns in _table_cells(node_list, downstream_dict, progress=progress):
+        np.bitwise_or.at(bits, (rows, columns >> 3), (0x80 >> (columns & 7)).astype(np.uint8))
 
-def set_downstream_dict(node_list, network_df):
-    downstream_dict = {}
+    with open(path, 'wb') as file:
+        np.savez_compressed(file, bits=bits, labels=np.array([str(n) for n in node_list]))
 
-    for n in node_list:
-        downstream_nodes = get_downstream_nodes(network_df, start_node=n)
+    return path
 
-        downstream_dict[n] = downstream_nodes
 
-    return downstream_dict
+def write_csr(node_list, downstream_dict, path, progress=None):
+    """
+    Write the node map table in compressed sparse row form (np.savez_compressed): the columns set to
+    1 in row i are indices[indptr[i]:indptr[i + 1]], 'labels' holds the nodes of the rows and
+    columns. The arrays can be given to scipy.sparse.csr_matrix with a data array of ones.
+    """
+    n_nodes = len(node_list)
+    cells = list(_table_cells(node_list, downstream_dict, progress=progress))
+    rows = np.concatenate([r for r, _ in cells]) if cells else np.empty(0, dtype=np.int64)
+    columns = np.concatenate([c for _, c in cells]) if cells else np.empty(0, dtype=np.int64)
 
+    by_row = np.lexsort((columns, rows))
+    indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_nodes), out=indptr[1:])
+    indices = columns[by_row].astype(np.int32)
 
-def dict_to_table(node_list, downstream_dict):
+    with open(path, 'wb') as file:
+        np.savez_compressed(file, indptr=indptr, indices=indices, shape=np.array([n_nodes, n_nodes]),
+                            labels=np.array([str(n) for n in node_list]))
 
-    downstream_nodes_table = pd.DataFrame(0, index=node_list, columns=node_list)
+    return path
 
-    for node, dowstream_nodes in downstream_dict.items():
-        for dn in dowstream_nodes:
-            if dn in downstream_nodes_table.index:
-                downstream_nodes_table.at[dn, node] = 1
 
-    return downstream_nodes_table
+# output format: (file name, writer)
+NM_OUTPUT_FORMATS = {
+    'csv': ('node_map.csv', write_dense_csv),
+    'csv.gz': ('node_map.csv.gz', write_dense_csv),
+    'xlsx': ('node_map.xlsx', write_dense_xlsx),
+    'edges': ('node_map_edges.csv', write_edge_list),
+    'bits': ('node_map_bits.npz', write_packed_matrix),
+    'csr': ('node_map_csr.npz', write_csr),
+}
 
 
-def run_nm_analysis(files, path_to_save):
+def check_node_map_format(output_format, engine=None):
     """
-    :param files: Network, Source, limit and open file
-    :type files: dict of Path
-    :param path_to_save: Path to the generated files directory
-    :type files: Path
+    :param engine: Name of the engine writing the node map, DEFAULT_ENGINE when None
     """
-    path_to_save = path_to_save/'node_map.csv'
-
-    network_df = pd.read_csv(files["network_file"])
-    source_nodes = pd.read_csv(files["source_file"])['source'].tolist()
-    open_sections = pd.read_csv(files["open_file"])['section'].tolist()
-
-    network_df = network_df[~network_df['section'].isin(open_sections)]
-
-    # Set a list of the nodes
-    selected_columns = network_df[['start', 'end']]  # Select the desired columns
-    node_list = selected_columns.values.flatten().tolist() # Flatten the DataFrame and convert to a list
-    node_list = list(set(node_list))
+    if output_format not in NM_OUTPUT_FORMATS:
+        raise ValueError("Le format de sortie '{0}' n'est pas supporté".format(output_format))
+    engine = get_engine(engine)
+    if engine.node_map_formats is not None and output_format not in engine.node_map_formats:
+        raise ValueError("Le format de sortie '{0}' n'est pas supporté par le moteur '{1}'".format(
+            output_format, engine.name))
 
-    s_list = []
-    fn_list = []
-    for s in source_nodes:
-        sequence, further_node = section_sequence(network_df, s)
-        s_list.append(sequence)
-        fn_list.append(further_node)
 
-    size = len(sequence)
+def write_node_map(prepared, path_to_save, output_format, profile, progress=None):
+    """
+    Consumer of the pipeline: write the node map of the prepared network.
 
-    sequence = []
-    further_node = []
+    :type prepared: PreparedNetwork
+    :param output_format: One of NM_OUTPUT_FORMATS
+    :type profile: Profile
+    :type progress: Progress
+    :return: Path to the node map
+    """
+    check_node_map_format(output_format, prepared.engine.name)
+    path_to_save = path_to_save/NM_OUTPUT_FORMATS[output_format][0]
 
-    for idx in range(size):
+    with profile.stage('write', rows=len(prepared.node_list)):
+        prepared.engine.write_node_map(prepared.node_list, prepared.downstream_dict, path_to_save, output_format,
+                                       progress)
 
-        for s, fn in zip(s_list, fn_list):
-            if s[idx] > 0 :
-                s_val = s[idx]
-                fn_val = fn[idx]
-                break
+    return path_to_save
 
-        sequence.append(s_val)
-        further_node.append(fn_val)
 
-    network_df['sequence'] = sequence
-    network_df['further_node'] = further_node
+def run_nm_analysis(files, path_to_save, output_format='csv', cache=None, profile=None, progress=None,
+                    workers=1, engine=None):
+    """
+    :param files: Network, Source, limit and open file
+    :type files: dict of Path
+    :param path_to_save: Path to the generated files directory
+    :type files: Path
+    :param cache: Cache of the sequenced network, shared with the other analyses
+    :type cache: ResultCache
+    :param output_format: One of NM_OUTPUT_FORMATS
+    :type output_format: str
+    :param profile: Records the time and memory of each stage, saved next to the output
+    :type profile: Profile
+    :param progress: Follows the items done in the stages, None when not needed
+    :type progress: Progress
+    :param workers: Processes traversing the connected parts of a large network
+    :param engine: Name of the engine of the analysis, DEFAULT_ENGINE when None
+    """
+    check_node_map_format(output_format, engine)
+    profile = profile if profile is not None else Profile()
 
-    downstream_dict = set_downstream_dict(node_list=node_list, network_df=network_df)
+    prepared = prepare_network(files, cache=cache, profile=profile, progress=progress, workers=workers,
+                               engine=engine)
+    path_to_save = write_node_map(prepared, path_to_save, output_format, profile, progress)
 
-    downstream_nodes_table = dict_to_table(node_list=node_list, downstream_dict=downstream_dict)
-    downstream_nodes_table.to_csv(path_to_save)
+    profile.save(profile_path(path_to_save))
 
     return path_to_save
-
-
@@ -0,0 +1,201 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from .downstream import _euler_intervals
+from .progress import report
+from .topology import build_topology, multi_source_sequence, node_labels_of
+
+# below this number of sections, starting the processes costs more than the traversals they share
+PARTITION_MIN_ROWS = 200000
+# groups of components per process, so that a process done early takes another group
+GROUPS_PER_WORKER = 4
+
+
+def connected_components(n_nodes, links):
+    """
+    Connected components of a graph, by hooking the root of every link to the lowest of its two
+    roots and then pointing every node at its root, until the two ends of every link share a root.
+
+    :param n_nodes: Number of nodes, ids 0 to n_nodes - 1
+    :param links: (a, b) node ids of every link
+    :return: Component of every node, as the lowest node id of the component
+    """
+    labels = np.arange(n_nodes, dtype=np.int64)
+    a, b = links[:, 0], links[:, 1]
+    while True:
+        label_a, label_b = labels[a], labels[b]
+        differ = label_a != label_b
+        if not differ.any():
+            return labels
+        # a label never exceeds its node id, so the pointers have no cycle
+        np.minimum.at(labels, np.maximum(label_a[differ], label_b[differ]),
+                      np.minimum(label_a[differ], label_b[differ]))
+        while True:
+            root = labels[labels]
+            if np.array_equal(root, labels):
+                break
+            labels = root
+
+
+def _sequence_group(section, start, end, source_nodes):
+    network_df = pd.DataFrame({'section': section, 'start': start, 'end': end})
+    topology = build_topology(network_df)
+    sequence, further_ids, source_ids = multi_source_sequence(topology, source_nodes)
+    return sequence, node_labels_of(topology, further_ids), node_labels_of(topology, source_ids)
+
+
+class NetworkPartition:
+    """
+    The connected components of a network (without its open sections), in groups processed in
+    parallel by a pool of processes. The sequencing and the radial tree of every group are computed
+    by a process, then merged into the results of the whole network: they are the same as those
+    computed in a single process.
+
+    A section label shared by rows of several components joins them, as the sequencing tags every
+    row of a section at once.
+
+    :param network_df: Network table
+    :type network_df: DataFrame
+    :param executor: Pool running the groups
+    :type executor: Executor
+    :param n_groups: Number of groups of components
+    """
+
+    def __init__(self, network_df, executor, n_groups):
+        self.executor = executor
+        n_rows = len(network_df)
+        codes, self.node_labels = pd.factorize(np.concatenate([network_df['start'].values, network_df['end'].values]),
+                                               use_na_sentinel=False)
+        row_nodes = np.stack([codes[:n_rows], codes[n_rows:]], axis=1)
+
+        section_codes = pd.factorize(network_df['section'].values, use_na_sentinel=False)[0]
+        _, first_rows = np.unique(section_codes, return_index=True)
+        shared = np.stack([row_nodes[first_rows[section_codes], 0], row_nodes[:, 0]], axis=1)
+        components = connected_components(len(self.node_labels), np.concatenate([row_nodes, shared]))
+
+        # the components, largest first, are cut into groups of about the same number of nodes
+        component_ids, component_of_node, sizes = np.unique(components, return_inverse=True, return_counts=True)
+        n_groups = max(1, min(n_groups, len(component_ids)))
+        by_size = np.argsort(-sizes, kind='stable')
+        nodes_before = np.cumsum(sizes[by_size]) - sizes[by_size]
+        group_of_component = np.empty(len(component_ids), dtype=np.int64)
+        group_of_component[by_size] = np.minimum(nodes_before * n_groups // len(components), n_groups - 1)
+
+        self.n_groups = n_groups
+        self.node_group = group_of_component[component_of_node]
+        self.row_group = self.node_group[row_nodes[:, 0]]
+
+    def _groups(self, group_of_items):
+        """
+        :return: The positions of the items of every non empty group, in increasing order
+        """
+        order = np.argsort(group_of_items, kind='stable')
+        bounds = np.searchsorted(group_of_items[order], np.arange(self.n_groups + 1))
+        return [order[bounds[g]:bounds[g + 1]] for g in range(self.n_groups) if bounds[g + 1] > bounds[g]]
+
+    def sequence(self, network_df, source_nodes, progress=None):
+        """
+        multi_source_sequence of every group, merged.
+
+        :param source_nodes: Source nodes, by priority
+        :return: The sequence, further node and source of every row of network_df, '' for the rows
+         that were not reached
+        """
+        source_ids = pd.Index(self.node_labels).get_indexer(source_nodes)
+        source_groups = np.where(source_ids >= 0, self.node_group[np.maximum(source_ids, 0)], -1)
+
+        sequence = np.zeros(len(network_df), dtype=np.int32)
+        further_node = np.full(len(network_df), '', dtype=object)
+        source = np.full(len(network_df), '', dtype=object)
+        futures = {}
+        for rows in self._groups(self.row_group):
+            group = self.row_group[rows[0]]
+            group_sources = [s for s, g in zip(source_nodes, source_groups.tolist()) if g == group]
+            future = self.executor.submit(_sequence_group, network_df['section'].values[rows],
+                                          network_df['start'].values[rows], network_df['end'].values[rows],
+                                          group_sources)
+            futures[future] = rows
+
+        done = 0
+        for future in as_completed(futures):
+            rows = futures[future]
+            sequence[rows], further_node[rows], source[rows] = future.result()
+            done += len(rows)
+            report(progress, 'sequence', done, len(network_df))
+
+        return sequence, further_node.tolist(), source.tolist()
+
+    def intervals(self, parent, progress=None):
+        """
+        _euler_intervals of every group, merged: a drop-in for the intervals of build_downstream_index.
+
+        :param parent: Parent node id of every node of the tree, whose ids start with the node ids of
+         the partition (build_downstream_index labels the network nodes first)
+        """
+        n_nodes = len(parent)
+        # nodes of the tree not in the network ('' for the unreached rows) have no parent and no child
+        node_group = np.zeros(n_nodes, dtype=np.int64)
+        node_group[:len(self.node_group)] = self.node_group
+        local_ids = np.empty(n_nodes, dtype=np.int64)
+
+        futures = []
+        for ids in self._groups(node_group):
+            local_ids[ids] = np.arange(len(ids))
+            group_parent = parent[ids]
+            # the ids keep their order within a group, the children are traversed in the same order
+            group_parent = np.where(group_parent >= 0, local_ids[np.maximum(group_parent, 0)], -1).astype(np.int32)
+            futures.append((ids, group_parent >= 0, self.executor.submit(_euler_intervals, group_parent)))
+
+        # a group lays out its trees by root id then the nodes no root reaches: every tree and every such
+        # node is a block, and the blocks of all the groups are laid out in that order, as in one process
+        results = []
+        block_keys = []
+        done = 0
+        for ids, has_parent, future in futures:
+            group_order, group_tin, group_tout, group_depth = future.result()
+            roots = np.flatnonzero(~has_parent)
+            in_trees = int((group_tout[roots] - group_tin[roots]).sum())
+            starts = np.concatenate([group_tin[roots], np.arange(in_trees, len(ids))]).astype(np.int64)
+            lengths = np.concatenate([group_tout[roots] - group_tin[roots], np.ones(len(ids) - in_trees)])
+            block_keys.append(np.stack([np.repeat([0, 1], [len(roots), len(ids) - in_trees]),
+                                        np.concatenate([ids[roots], ids[group_order[in_trees:]]])], axis=1))
+            results.append((ids, group_order, group_tin, group_tout, group_depth, starts, lengths.astype(np.int64)))
+            done += len(ids)
+            report(progress, 'downstream', done, n_nodes)
+
+        block_keys = np.concatenate(block_keys)
+        block_order = np.lexsort((block_keys[:, 1], block_keys[:, 0]))
+        all_lengths = np.concatenate([r[6] for r in results])
+        new_starts = np.empty(len(block_order), dtype=np.int64)
+        new_starts[block_order] = np.cumsum(all_lengths[block_order]) - all_lengths[block_order]
+
+        order = np.empty(n_nodes, dtype=np.int32)
+        tin = np.empty(n_nodes, dtype=np.int32)
+        tout = np.empty(n_nodes, dtype=np.int32)
+        depth = np.empty(n_nodes, dtype=np.int32)
+        first_block = 0
+        for ids, group_order, group_tin, group_tout, group_depth, starts, lengths in results:
+            # blocks of a group are sorted by their start, the shift of a position is that of its block
+            by_start = np.argsort(starts, kind='stable')
+            shift = np.repeat(new_starts[first_block:first_block + len(starts)][by_start] - starts[by_start],
+                              lengths[by_start])
+            first_block += len(starts)
+            order[np.arange(len(ids)) + shift] = ids[group_order]
+            tin[ids] = group_tin + shift[group_tin]
+            tout[ids] = group_tout + shift[group_tin]
+            depth[ids] = group_depth
+
+        return order, tin, tout, depth
+
+
+def partition_pool(max_workers):
+    """
+    :return: The pool of processes of a NetworkPartition. The analyses run in single threaded
+     processes where fork is safe, and spares the import of the engines by every process
+    :rtype: ProcessPoolExecutor
+    """
+    method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(method))
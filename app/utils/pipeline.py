@@ -0,0 +1,276 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .File import read_table, zip_files
+from .downstream import build_downstream_index
+from .engines import DEFAULT_ENGINE, get_engine
+from .metrics import Profile, profile_path
+from .partition import GROUPS_PER_WORKER, PARTITION_MIN_ROWS, NetworkPartition, partition_pool
+from .topology import build_topology, bfs_sequence, node_labels_of
+
+# files the sequencing and downstream nodes depend on
+TOPOLOGY_FILES = ('network_file', 'source_file', 'open_file')
+
+
+def section_sequence(network_df, source_node, topology=None, progress=None):
+    """
+    :param network_df: Network table
+    :type network_df: DataFrame
+    :param source_node: Node from which the network is traversed
+    :param topology: Compiled network, built from network_df when not given
+    :type topology: NetworkTopology
+    :param progress: Follows the traversal, None when not needed
+    :type progress: Progress
+    :return: The sequence and the further node of every section of network_df
+    """
+    if topology is None:
+        topology = build_topology(network_df)
+
+    sequence, further_ids = bfs_sequence(topology, source_node, progress=progress)
+    further_node = node_labels_of(topology, further_ids)
+
+    return sequence, further_node
+
+
+def get_downstream_nodes(network_df, start_node):
+    """
+    Nodes downstream of a node, itself included. To query many nodes, use set_downstream_dict which
+    builds the radial tree only once.
+
+    :param network_df: Network table with the 'sequence' and 'further_node' columns
+    :type network_df: DataFrame
+    :param start_node: Label of the node
+    :return: The list of the downstream nodes
+    """
+    return build_downstream_index(network_df)[start_node]
+
+
+def set_downstream_dict(node_list, network_df, progress=None):
+    """
+    :param node_list: Nodes for which the downstream nodes are needed
+    :type node_list: list
+    :param network_df: Network table with the 'sequence' and 'further_node' columns
+    :type network_df: DataFrame
+    :param progress: Follows the construction of the tree, None when not needed
+    :type progress: Progress
+    :return: Mapping {node: [downstream nodes]}, the lists are computed when read
+    :rtype: DownstreamIndex
+    """
+    return build_downstream_index(network_df, progress=progress).restrict(node_list)
+
+
+class PreparedNetwork:
+    """
+    Network sequenced from its sources with its radial tree, shared by the analyses.
+
+    :param network_df: Network table without the open sections, with the 'sequence', 'further_node'
+     and 'source' columns
+    :param node_list: Nodes of network_df
+    :param downstream_dict: Radial tree, as returned by set_downstream_dict
+    :param limit_df: Limit table, None when the limit file was not given
+    :param engine: Engine which prepared the network, and allocates and writes its results
+    :type engine: Engine
+    """
+
+    def __init__(self, network_df, node_list, downstream_dict, limit_df=None, engine=None):
+        self.network_df = network_df
+        self.node_list = node_list
+        self.downstream_dict = downstream_dict
+        self.limit_df = limit_df
+        self.engine = engine if engine is not None else get_engine()
+
+
+def load_tables(files, profile):
+    """
+    Stage 1: read the input files.
+
+    :return: network_df, source nodes, open sections and limit_df (None without limit file)
+    """
+    with profile.stage('read') as stage:
+        network_df = read_table(files["network_file"])
+        limit_df = read_table(files["limit_file"]) if files.get("limit_file") else None
+        source_nodes = read_table(files["source_file"])['source'].tolist()
+        open_sections = read_table(files["open_file"])['section'].tolist()
+        stage['rows'] = len(network_df) + len(source_nodes) + len(open_sections) + \
+            (len(limit_df) if limit_df is not None else 0)
+
+    return network_df, source_nodes, open_sections, limit_df
+
+
+def filter_open(network_df, open_sections, profile):
+    """
+    Stage 2: remove the open sections.
+
+    :return: The network without the open sections and the list of its nodes
+    """
+    with profile.stage('filter_open') as stage:
+        network_df = network_df[~network_df['section'].isin(open_sections)]
+
+        # Set a list of the nodes
+        selected_columns = network_df[['start', 'end']]  # Select the desired columns
+        node_list = selected_columns.values.flatten().tolist()  # Flatten the DataFrame and convert to a list
+        node_list = list(set(node_list))
+        stage['rows'] = len(network_df)
+
+    return network_df, node_list
+
+
+def sequence_network(network_df, source_nodes, profile, progress=None, partition=None, engine=None):
+    """
+    Stage 3: add the 'sequence', 'further_node' and 'source' columns, with the engine, or over each
+    connected part of the network when partition is given.
+
+    :type partition: NetworkPartition
+    :type engine: Engine
+    """
+    engine = engine if engine is not None else get_engine()
+    with profile.stage('sequence', rows=len(network_df)):
+        if partition is not None:
+            sequence, further_node, source = partition.sequence(network_df, source_nodes, progress)
+        else:
+            sequence, further_node, source = engine.sequence(network_df, source_nodes, progress)
+
+        network_df['sequence'] = sequence
+        network_df['further_node'] = further_node
+        network_df['source'] = source
+
+    return network_df
+
+
+def downstream_tree(network_df, node_list, profile, progress=None, partition=None, engine=None):
+    """
+    Stage 4: radial tree of the sequenced network, built by the engine, or traversed by connected
+    part when partition is given.
+
+    :type partition: NetworkPartition
+    :type engine: Engine
+    :return: A DownstreamIndex, or the mapping of the engine
+    """
+    engine = engine if engine is not None else get_engine()
+    with profile.stage('downstream', rows=len(node_list)):
+        if partition is not None:
+            return build_downstream_index(network_df, progress, intervals=partition.intervals).restrict(node_list)
+        return engine.downstream(node_list, network_df, progress)
+
+
+def sequence_and_tree(network_df, node_list, source_nodes, profile, progress=None, workers=1, engine=None):
+    """
+    Stages 3 and 4. With more than one worker, a large network is split into its connected parts
+    (its feeders once the open sections are removed), traversed in parallel by a pool of processes.
+    Only the default engine is partitioned.
+
+    :type engine: Engine
+    :return: The sequenced network_df and its radial tree
+    """
+    engine = engine if engine is not None else get_engine()
+    if workers <= 1 or len(network_df) < PARTITION_MIN_ROWS or engine.name != DEFAULT_ENGINE:
+        network_df = sequence_network(network_df, source_nodes, profile, progress, engine=engine)
+        return network_df, downstream_tree(network_df, node_list, profile, progress, engine=engine)
+
+    with partition_pool(workers) as executor:
+        with profile.stage('partition', rows=len(network_df)):
+            partition = NetworkPartition(network_df, executor, workers * GROUPS_PER_WORKER)
+        network_df = sequence_network(network_df, source_nodes, profile, progress, partition)
+        return network_df, downstream_tree(network_df, node_list, profile, progress, partition)
+
+
+def prepare_network(files, cache=None, profile=None, progress=None, workers=1, engine=None):
+    """
+    Run the stages shared by the analyses: load, filter the open sections, sequence and build the
+    radial tree.
+
+    :param files: Network, source and open file, and the limit file if any
+    :type files: dict of Path
+    :param cache: Cache of the sequenced network, shared with the other analyses
+    :type cache: ResultCache
+    :param profile: Records the time and memory of each stage
+    :type profile: Profile
+    :param progress: Follows the items done in the stages, None when not needed
+    :type progress: Progress
+    :param workers: Processes traversing the connected parts of a large network
+    :param engine: Name of the engine of the analyses, DEFAULT_ENGINE when None
+    :rtype: PreparedNetwork
+    """
+    profile = profile if profile is not None else Profile()
+    engine = get_engine(engine)
+    network_df, source_nodes, open_sections, limit_df = load_tables(files, profile)
+    network_df, node_list = filter_open(network_df, open_sections, profile)
+
+    if engine.name != DEFAULT_ENGINE:
+        # the cached topology is the radial tree of the default engine
+        network_df, downstream_dict = sequence_and_tree(network_df, node_list, source_nodes, profile, progress,
+                                                        engine=engine)
+        return PreparedNetwork(network_df, node_list, downstream_dict, limit_df, engine)
+
+    # The topology only depends on the network, source and open files: it is shared with the
+    # other analyses of the same network through the cache
+    with profile.stage('topology_cache') as stage:
+        key = cache.key('topology', files, file_types=TOPOLOGY_FILES) if cache is not None else None
+        cached = cache.get_object(key) if cache is not None else None
+        stage['rows'] = 0 if cached is None else len(network_df)
+
+    if cached is None:
+        network_df, downstream_dict = sequence_and_tree(network_df, node_list, source_nodes, profile, progress,
+                                                        workers)
+        if cache is not None:
+            # the node columns are kept as int32 ids into the labels of the tree
+            labels = pd.Index(downstream_dict.node_labels)
+            cached = {
+                'sequence': network_df['sequence'].values,
+                'further_node': labels.get_indexer(network_df['further_node'].values).astype(np.int32),
+                'source': labels.get_indexer(network_df['source'].values).astype(np.int32),
+                'downstream': downstream_dict,
+            }
+            cache.put_object(key, cached)
+    else:
+        downstream_dict = cached['downstream'].restrict(node_list)
+        network_df['sequence'] = cached['sequence']
+        for column in ('further_node', 'source'):
+            ids = cached[column]
+            network_df[column] = np.where(ids >= 0, downstream_dict.node_labels[np.maximum(ids, 0)], '')
+
+    return PreparedNetwork(network_df, node_list, downstream_dict, limit_df, engine)
+
+
+def run_all_analysis(files, path_to_save, output_format='csv', table_format='csv', cache=None, profile=None,
+                     progress=None, workers=1, engine=None):
+    """
+    DG allocation and node map of a network from a single preparation of its topology.
+
+    :param files: Network, source, limit and open file
+    :type files: dict of Path
+    :param path_to_save: Path to the generated files directory
+    :type path_to_save: Path
+    :param output_format: Format of the node map, one of NM_OUTPUT_FORMATS
+    :param table_format: Format of the DG allocation, one of TABLE_FORMATS
+    :param cache: Cache of the sequenced network, shared with the other analyses
+    :type cache: ResultCache
+    :param profile: Records the time and memory of each stage, saved next to the output
+    :type profile: Profile
+    :param progress: Follows the items done in the stages, None when not needed
+    :type progress: Progress
+    :param workers: Processes traversing the connected parts of a large network
+    :param engine: Name of the engine of the analyses, DEFAULT_ENGINE when None
+    :return: Path of analyses.zip, holding the DG allocation and the node map
+    """
+    from .dg_allocation_tool import write_allocated_dg
+    from .node_map_tool import write_node_map
+
+    profile = profile if profile is not None else Profile()
+    path_to_save = Path(path_to_save)
+
+    prepared = prepare_network(files, cache=cache, profile=profile, progress=progress, workers=workers,
+                               engine=engine)
+    outputs = [
+        write_allocated_dg(prepared, path_to_save, profile, table_format, progress),
+        write_node_map(prepared, path_to_save, output_format, profile, progress),
+    ]
+
+    with profile.stage('archive'):
+        archive = path_to_save / zip_files(outputs, 'analyses')
+
+    profile.save(profile_path(archive))
+
+    return archive
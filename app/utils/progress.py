@@ -0,0 +1,36 @@
+import time
+
+# items processed between two looks at the clock in the tight loops of the engines
+CHECK_EVERY = 4096
+
+
+class Progress:
+    """
+    Progress of an analysis, reported by the engines as (stage, items done, items total).
+
+    The callback is called at most once per interval seconds, and always at the end of a stage:
+    the engines can report as often as they like, most reports only cost a clock read.
+
+    :param callback: Function called with (stage, done, total)
+    :param interval: Seconds between two calls of the callback
+    """
+
+    def __init__(self, callback, interval=0.5):
+        self.callback = callback
+        self.interval = interval
+        self._last = 0.0
+
+    def update(self, stage, done, total):
+        now = time.monotonic()
+        if done < total and now - self._last < self.interval:
+            return
+        self._last = now
+        self.callback(stage, done, total)
+
+
+def report(progress, stage, done, total):
+    """
+    Report to progress, which may be None when the caller does not follow the progress.
+    """
+    if progress is not None:
+        progress.update(stage, done, total)
@@ -0,0 +1,203 @@
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from .dg_allocation_tool import allocate_dg
+from .netstore import intern_labels, label_key, load_arrays, save_arrays
+from .pipeline import prepare_network
+
+QUERIES = ('downstream', 'upstream', 'limiting')
+
+
+class NetworkIndex:
+    """
+    Index of a prepared network answering queries on single nodes: the nodes downstream of it,
+    its path up to its source and the node limiting its DG.
+
+    The index only holds flat arrays (see index_arrays), so that it can be memory-mapped from the
+    cache and shared by the web workers. Nodes are looked up by their label as text, so that '12'
+    finds the node 12 of a network read from a .csv.
+
+    :param arrays: Arrays of the index, as returned by index_arrays or load_arrays
+    :type arrays: dict of ndarray
+    """
+
+    def __init__(self, arrays):
+        self.labels = arrays['labels']
+        self.sorted_labels = arrays['sorted_labels']
+        self.sorted_ids = arrays['sorted_ids']
+        self.parent = arrays['parent']
+        self.order = arrays['order']
+        self.tin = arrays['tin']
+        self.tout = arrays['tout']
+        # limiting node id and allocated DG of every node, absent when the network has no limit file
+        self.limiting_ids = arrays.get('limiting_ids')
+        self.new_dg = arrays.get('new_dg')
+
+    def __len__(self):
+        return len(self.labels)
+
+    def node_id(self, node):
+        key = label_key(self.labels, node)
+        if key is not None:
+            pos = int(np.searchsorted(self.sorted_labels, key))
+            if pos < len(self.sorted_labels) and self.sorted_labels[pos] == key:
+                return int(self.sorted_ids[pos])
+        raise KeyError("Le nœud '{0}' n'est pas dans le réseau".format(node))
+
+    def downstream(self, node):
+        """
+        :return: The nodes downstream of the node, itself included
+        """
+        node_id = self.node_id(node)
+        return self.labels[self.order[self.tin[node_id]:self.tout[node_id]]].tolist()
+
+    def upstream(self, node):
+        """
+        :return: The nodes from the node up to its source, both included
+        """
+        path = [self.node_id(node)]
+        parent = self.parent
+        while parent[path[-1]] >= 0 and len(path) <= len(parent):
+            path.append(int(parent[path[-1]]))
+        return self.labels[path].tolist()
+
+    def limiting(self, node):
+        """
+        :return: The node limiting the DG of the node and the allocated DG, as a dict
+        """
+        if self.limiting_ids is None:
+            raise ValueError("Le fichier 'limit' est nécessaire pour connaître le nœud limitant")
+        node_id = self.node_id(node)
+        limiting_id = int(self.limiting_ids[node_id])
+        new_dg = float(self.new_dg[node_id])
+        return {'limiting_node': self.labels[limiting_id].item() if limiting_id >= 0 else None,
+                'new_dg': None if math.isnan(new_dg) else new_dg}
+
+    def query(self, kind, nodes):
+        """
+        Answer the same query for many nodes.
+
+        :param kind: One of QUERIES
+        :param nodes: Node labels
+        :return: {node: answer} and {node: error message} for the nodes that are not in the network
+        """
+        if kind not in QUERIES:
+            raise ValueError("La requête '{0}' n'existe pas".format(kind))
+        answer = getattr(self, kind)
+        results = {}
+        errors = {}
+        for node in nodes:
+            try:
+                results[str(node)] = answer(node)
+            except KeyError as e:
+                errors[str(node)] = e.args[0]
+        return results, errors
+
+
+def index_arrays(downstream_dict, allocated_df=None):
+    """
+    :param downstream_dict: Radial tree of the network
+    :type downstream_dict: DownstreamIndex
+    :param allocated_df: Output of allocate_dg, None when the network has no limit file
+    :type allocated_df: DataFrame
+    :return: The arrays of a NetworkIndex {name: ndarray}, the nodes are int32 ids into 'labels'
+    """
+    labels = intern_labels(downstream_dict.node_labels)
+    sorted_ids = np.argsort(labels, kind='stable').astype(np.int32)
+    arrays = {
+        'labels': labels,
+        'sorted_labels': labels[sorted_ids],
+        'sorted_ids': sorted_ids,
+        'parent': downstream_dict.parent,
+        'order': downstream_dict.order,
+        'tin': downstream_dict.tin,
+        'tout': downstream_dict.tout,
+    }
+
+    if allocated_df is not None:
+        node_index = pd.Index(downstream_dict.node_labels)
+        further_ids = node_index.get_indexer(allocated_df['further_node'].values)
+        limiting = node_index.get_indexer(allocated_df['limiting_node'].values)
+        # the first row of a further node is the one with the highest sequence, as in the output
+        further_ids, first = np.unique(further_ids, return_index=True)
+        first = first[further_ids >= 0]
+        further_ids = further_ids[further_ids >= 0]
+
+        arrays['limiting_ids'] = np.full(len(labels), -1, dtype=np.int32)
+        arrays['limiting_ids'][further_ids] = limiting[first]
+        arrays['new_dg'] = np.full(len(labels), np.nan)
+        arrays['new_dg'][further_ids] = allocated_df['new_dg'].values[first]
+
+    return arrays
+
+
+def publish_network_index(files, cache):
+    """
+    Build the index of a network and publish it in the cache, for the queries of any web worker.
+    It is built at the end of the analysis job, the network is then in the cache.
+
+    :param files: Input files of an analysis, the limit file is optional
+    :type files: dict of Path
+    :param cache: Cache of the sequenced network and of the indexes, shared with the analyses
+    :type cache: ResultCache
+    :return: Directory of the published index
+    """
+    key = cache.key('network_index', files)
+    entry = cache.get_dir(key)
+    if entry is not None:
+        return entry
+
+    prepared = prepare_network(files, cache=cache)
+    allocated_df = None
+    if prepared.limit_df is not None:
+        allocated_df = allocate_dg(dg_df=prepared.limit_df, downstream_dict=prepared.downstream_dict,
+                                   network_df=prepared.network_df)
+    arrays = index_arrays(prepared.downstream_dict, allocated_df)
+    return cache.put_dir(key, lambda tmp: save_arrays(tmp, arrays))
+
+
+def load_network_index(files, cache):
+    """
+    Attach to the index published by publish_network_index: its arrays are memory-mapped and not copied.
+
+    :type files: dict of Path
+    :type cache: ResultCache
+    :return: The NetworkIndex, None when it is not in the cache
+    """
+    entry = cache.get_dir(cache.key('network_index', files))
+    return NetworkIndex(load_arrays(entry)) if entry is not None else None
+
+
+class IndexCache:
+    """
+    The network indexes of a web worker, the least recently used are dropped past max_networks.
+    """
+
+    def __init__(self, max_networks=4):
+        self.max_networks = max_networks
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        """
+        :param key: Key of the network, the job id
+        :param build: Function loading the NetworkIndex when it is not loaded, None is not kept
+        :rtype: NetworkIndex
+        """
+        with self._lock:
+            if key in self._indexes:
+                self._indexes.move_to_end(key)
+                return self._indexes[key]
+
+        index = build()
+        if index is None:
+            return None
+        with self._lock:
+            self._indexes[key] = index
+            while len(self._indexes) > self.max_networks:
+                self._indexes.popitem(last=False)
+        return index
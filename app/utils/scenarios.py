@@ -0,0 +1,201 @@
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from .File import read_table
+from .dg_allocation_tool import allocate_dg
+from .export import check_table_format, export_table
+from .metrics import Profile, profile_path
+from .pipeline import set_downstream_dict
+from .progress import report
+from .topology import build_topology, multi_source_sequence, node_labels_of
+
+BASE_SCENARIO = 'base'
+
+
+def read_scenarios(file):
+    """
+    :param file: Table with the 'scenario' and 'section' columns, one row per open section of a scenario
+    :return: {scenario name: set of open sections}, in the order of the table
+    """
+    df = read_table(file)
+    missing = {'scenario', 'section'} - set(df.columns)
+    if missing:
+        raise ValueError("Les colonnes {0} du fichier '{1}' semblent être manquantes".format(missing, Path(file).name))
+    return {str(name): set(group['section'].tolist()) for name, group in df.groupby('scenario', sort=False)}
+
+
+def _find(links, x):
+    root = x
+    while links[root] != root:
+        root = links[root]
+    while links[x] != root:
+        links[x], x = root, links[x]
+    return root
+
+
+def _components(n_nodes, row_nodes, rows):
+    """
+    :param row_nodes: (start, end) node id of every row of the network
+    :param rows: Positions of the rows linking the nodes
+    :return: Component label of every node
+    """
+    links = list(range(n_nodes))
+    for start, end in row_nodes[rows].tolist():
+        a, b = _find(links, start), _find(links, end)
+        if a != b:
+            links[a] = b
+    return np.array([_find(links, node) for node in range(n_nodes)], dtype=np.int64)
+
+
+def _allocate_rows(network_df, rows, source_nodes, limit_df):
+    """
+    Run the DG allocation on some rows of the network, as run_dg_analysis does on a whole network.
+
+    :return: rows, new_dg and limiting_node of the allocated rows
+    """
+    sub_df = network_df.iloc[rows].copy()
+    sub_df['_row'] = rows
+    node_list = pd.unique(sub_df[['start', 'end']].values.ravel()).tolist()
+
+    topology = build_topology(sub_df)
+    sequence, further_ids, source_ids = multi_source_sequence(topology, source_nodes)
+    sub_df['sequence'] = sequence
+    sub_df['further_node'] = node_labels_of(topology, further_ids)
+    sub_df['source'] = node_labels_of(topology, source_ids)
+
+    downstream_dict = set_downstream_dict(node_list=node_list, network_df=sub_df)
+    result = allocate_dg(dg_df=limit_df, downstream_dict=downstream_dict, network_df=sub_df)
+    # a node listed twice in the limit file doubles its rows, the first one is kept
+    result = result.drop_duplicates('_row')
+
+    return result['_row'].values, result['new_dg'].values, result['limiting_node'].values
+
+
+def sweep_scenarios(network_df, source_nodes, limit_df, base_open, scenarios, profile=None, progress=None):
+    """
+    DG allocation of a network for many sets of open sections.
+
+    The base scenario is allocated on the whole network. For every other scenario, only the
+    connected parts of the network holding a section whose state differs from the base are
+    allocated again: the parts that do not change keep the results of the base.
+
+    :param network_df: Network table, open sections included
+    :type network_df: DataFrame
+    :param source_nodes: Source nodes, by priority
+    :param limit_df: Limit table with the 'node', 'limit' and 'dg' columns
+    :type limit_df: DataFrame
+    :param base_open: Open sections of the base scenario
+    :param scenarios: {scenario name: open sections}
+    :type scenarios: dict
+    :param profile: Records the time of each scenario
+    :type profile: Profile
+    :param progress: Follows the scenarios done
+    :type progress: Progress
+    :return: {scenario name: (new_dg, limiting_node)} with one value per row of network_df, NaN and
+     '' for the open or unreached rows
+    """
+    profile = profile if profile is not None else Profile()
+    base_open = set(base_open)
+    n_rows = len(network_df)
+    sections = network_df['section'].values
+
+    with profile.stage('base', rows=n_rows):
+        topology = build_topology(network_df)
+        base_rows = np.flatnonzero(~network_df['section'].isin(base_open).values)
+        base_dg = np.full(n_rows, np.nan)
+        base_limiting = np.full(n_rows, '', dtype=object)
+        rows, new_dg, limiting_node = _allocate_rows(network_df, base_rows, source_nodes, limit_df)
+        base_dg[rows] = new_dg
+        base_limiting[rows] = limiting_node
+
+    results = {BASE_SCENARIO: (base_dg, base_limiting)}
+    report(progress, 'scenarios', 1, len(scenarios) + 1)
+
+    with profile.stage('components', rows=n_rows):
+        # parts of the network closed in every scenario, joined below by the sections of each scenario
+        switched = base_open.union(*scenarios.values())
+        switched_rows = np.isin(sections, list(switched))
+        node_component = _components(topology.n_nodes, topology.row_nodes, np.flatnonzero(~switched_rows))
+        row_component = node_component[topology.row_nodes]
+
+    for name, open_sections in scenarios.items():
+        with profile.stage('scenario') as stage:
+            open_sections = set(open_sections)
+            scenario_open = np.isin(sections, list(open_sections))
+            changed_rows = np.flatnonzero(np.isin(sections, list(open_sections ^ base_open)))
+
+            # join the closed parts through the switched sections closed in this scenario
+            links = {}
+            for a, b in row_component[np.flatnonzero(switched_rows & ~scenario_open)].tolist():
+                a, b = _find(links, links.setdefault(a, a)), _find(links, links.setdefault(b, b))
+                if a != b:
+                    links[a] = b
+            roots = {_find(links, links.setdefault(c, c)) for c in row_component[changed_rows].ravel().tolist()}
+            affected = [c for c in links if _find(links, c) in roots]
+
+            new_dg = base_dg.copy()
+            limiting = base_limiting.copy()
+            affected_rows = np.isin(row_component, affected).any(axis=1)
+            new_dg[affected_rows] = np.nan
+            limiting[affected_rows] = ''
+            rows = np.flatnonzero(affected_rows & ~scenario_open)
+            if len(rows):
+                rows, dg, limiting_node = _allocate_rows(network_df, rows, source_nodes, limit_df)
+                new_dg[rows] = dg
+                limiting[rows] = limiting_node
+            stage['rows'] = len(rows)
+
+        results[name] = (new_dg, limiting)
+        report(progress, 'scenarios', len(results), len(scenarios) + 1)
+
+    return results
+
+
+def run_scenario_analysis(files, path_to_save, output_format='csv', cache=None, profile=None, progress=None,
+                          workers=1):
+    """
+    :param files: Network, source, limit, open and scenario file. The open file gives the base
+     scenario, the scenario file the open sections of the other scenarios (see read_scenarios)
+    :type files: dict of Path
+    :param path_to_save: Path to the generated files directory
+    :type path_to_save: Path
+    :param output_format: One of TABLE_FORMATS
+    :param cache: Not used, the scenarios share the topology of the network within the run
+    :param profile: Records the time and memory of each stage, saved next to the output
+    :type profile: Profile
+    :param progress: Follows the scenarios done
+    :type progress: Progress
+    :param workers: Not used, the scenarios only traverse the parts of the network they change
+    :return: Path of the comparison table: the sections with the new_dg and limiting_node of every
+     scenario, as new_dg_<scenario> and limiting_node_<scenario> columns
+    """
+    check_table_format(output_format)
+    profile = profile if profile is not None else Profile()
+
+    with profile.stage('read') as stage:
+        network_df = read_table(files["network_file"])
+        limit_df = read_table(files["limit_file"])
+        source_nodes = read_table(files["source_file"])['source'].tolist()
+        base_open = read_table(files["open_file"])['section'].tolist()
+        scenarios = read_scenarios(files["scenario_file"])
+        stage['rows'] = len(network_df)
+
+    if BASE_SCENARIO in scenarios:
+        raise ValueError("Le nom de scénario '{0}' est réservé au fichier d'ouverture".format(BASE_SCENARIO))
+
+    results = sweep_scenarios(network_df, source_nodes, limit_df, base_open, scenarios, profile=profile,
+                              progress=progress)
+
+    with profile.stage('write', rows=len(network_df)):
+        columns = {}
+        for name, (new_dg, limiting_node) in results.items():
+            columns['new_dg_{0}'.format(name)] = new_dg
+            columns['limiting_node_{0}'.format(name)] = limiting_node
+        comparison = pd.concat([network_df[['section', 'start', 'end']],
+                                pd.DataFrame(columns, index=network_df.index)], axis=1)
+        path_to_save = export_table(comparison, path_to_save, 'scenarios_dg', output_format)
+
+    profile.save(profile_path(path_to_save))
+
+    return path_to_save
@@ -0,0 +1,183 @@
+import numpy as np
+import pandas as pd
+from collections import deque
+
+from .progress import CHECK_EVERY, report
+
+
+class NetworkTopology:
+    """
+    Compiled, integer-indexed view of a network table.
+
+    Node and section labels are mapped to dense int32 ids and the adjacency is stored CSR-style:
+    the neighbours of node ``n`` are ``neighbors[indptr[n]:indptr[n + 1]]`` and the row of
+    ``network_df`` carrying each of those edges is at the same position in ``edge_rows``.
+    Neighbours are kept in the order the rows appear in the table, so traversals visit them in
+    the same order as the former dict-of-tuples graph.
+    """
+
+    def __init__(self, node_labels, section_labels, row_nodes, row_sections, indptr, neighbors, edge_rows):
+        self.node_labels = node_labels
+        self.section_labels = section_labels
+        # (start, end) node id of every row
+        self.row_nodes = row_nodes
+        # section id of every row
+        self.row_sections = row_sections
+        self.indptr = indptr
+        self.neighbors = neighbors
+        self.edge_rows = edge_rows
+        self.node_index = {label: idx for idx, label in enumerate(node_labels.tolist())}
+
+    @property
+    def n_nodes(self):
+        return len(self.node_labels)
+
+    @property
+    def n_sections(self):
+        return len(self.section_labels)
+
+    @property
+    def n_rows(self):
+        return len(self.row_sections)
+
+    def node_id(self, label):
+        """
+        :param label: Node label as found in the network file
+        :return: The dense id of the node, -1 if the node is not in the network
+        """
+        return self.node_index.get(label, -1)
+
+
+def build_topology(network_df):
+    """
+    Compile the network table into a NetworkTopology. Build it once per analysis and share it
+    with every traversal.
+
+    :param network_df: Network table with the 'section', 'start' and 'end' columns
+    :type network_df: DataFrame
+    :rtype: NetworkTopology
+    """
+    n_rows = len(network_df)
+
+    section_codes, section_labels = pd.factorize(network_df['section'].values, use_na_sentinel=False)
+    ends = np.concatenate([network_df['start'].values, network_df['end'].values])
+    node_codes, node_labels = pd.factorize(ends, use_na_sentinel=False)
+
+    start_ids = node_codes[:n_rows].astype(np.int32)
+    end_ids = node_codes[n_rows:].astype(np.int32)
+    n_nodes = len(node_labels)
+
+    # Every row gives two directed edges, start -> end then end -> start. Interleaving them and
+    # sorting stably by origin keeps the neighbours of a node in row order.
+    origin = np.empty(2 * n_rows, dtype=np.int32)
+    origin[0::2] = start_ids
+    origin[1::2] = end_ids
+    target = np.empty(2 * n_rows, dtype=np.int32)
+    target[0::2] = end_ids
+    target[1::2] = start_ids
+    rows = np.repeat(np.arange(n_rows, dtype=np.int32), 2)
+
+    order = np.argsort(origin, kind='stable')
+    indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(origin, minlength=n_nodes), out=indptr[1:])
+
+    return NetworkTopology(
+        node_labels=np.asarray(node_labels, dtype=object),
+        section_labels=np.asarray(section_labels, dtype=object),
+        row_nodes=np.stack([start_ids, end_ids], axis=1),
+        row_sections=section_codes.astype(np.int32),
+        indptr=indptr,
+        neighbors=target[order],
+        edge_rows=rows[order],
+    )
+
+
+def bfs_sequence(topology, source_node, progress=None):
+    """
+    Breadth first traversal of the topology from a source node.
+
+    :param topology: Compiled network
+    :type topology: NetworkTopology
+    :param source_node: Label of the source node
+    :param progress: Follows the nodes visited, None when not needed
+    :type progress: Progress
+    :return: sequence (int32 array, 0 when not reached) and further node id (int32 array, -1 when
+     not reached) of every row of the network table
+    """
+    sequence, further_ids, _ = multi_source_sequence(topology, [source_node], progress=progress)
+
+    return sequence, further_ids
+
+
+def multi_source_sequence(topology, source_nodes, progress=None):
+    """
+    Label every section with its sequence, its further node and the source that energises it in
+    a single traversal of the topology.
+
+    A section reached from several sources keeps the values from the first source of the list,
+    as when each source was traversed separately and the results merged in order.
+
+    :param topology: Compiled network
+    :type topology: NetworkTopology
+    :param source_nodes: Labels of the source nodes, by priority
+    :type source_nodes: list
+    :param progress: Follows the nodes visited, None when not needed
+    :type progress: Progress
+    :return: sequence (0 when not reached), further node id and source node id (-1 when not
+     reached) of every row of the network table, as int32 arrays
+    """
+    # plain lists are much faster than numpy scalars inside the Python loop
+    indptr = topology.indptr.tolist()
+    neighbors = topology.neighbors.tolist()
+    edge_sections = topology.row_sections[topology.edge_rows].tolist()
+
+    section_sequence = [0] * topology.n_sections
+    section_further = [-1] * topology.n_sections
+    section_source = [-1] * topology.n_sections
+
+    # Nodes are never visited twice: a source already reached from a previous source is in the
+    # same connected part of the network and would yield the same sections.
+    visited = bytearray(topology.n_nodes)
+    n_visited = 0
+
+    for source_node in source_nodes:
+        source_id = topology.node_id(source_node)
+        if source_id < 0 or visited[source_id]:
+            continue
+
+        queue = deque([(source_id, 0)])
+        while queue:
+            current_node, level = queue.popleft()
+            if visited[current_node]:
+                continue
+            visited[current_node] = 1
+            n_visited += 1
+            if n_visited % CHECK_EVERY == 0:
+                report(progress, 'sequence', n_visited, topology.n_nodes)
+            for k in range(indptr[current_node], indptr[current_node + 1]):
+                neighbor = neighbors[k]
+                if not visited[neighbor]:
+                    # a section label shared by several rows tags all of them
+                    section_id = edge_sections[k]
+                    if section_source[section_id] in (-1, source_id):
+                        section_sequence[section_id] = level + 1
+                        section_further[section_id] = neighbor
+                        section_source[section_id] = source_id
+                    queue.append((neighbor, level + 1))
+
+    report(progress, 'sequence', topology.n_nodes, topology.n_nodes)
+
+    row_sections = topology.row_sections
+    sequence = np.array(section_sequence, dtype=np.int32)[row_sections]
+    further_ids = np.array(section_further, dtype=np.int32)[row_sections]
+    source_ids = np.array(section_source, dtype=np.int32)[row_sections]
+
+    return sequence, further_ids, source_ids
+
+
+def node_labels_of(topology, node_ids):
+    """
+    :return: The list of node labels, '' for the rows that were not reached (id -1)
+    """
+    labels = topology.node_labels[np.maximum(node_ids, 0)]
+    return np.where(node_ids >= 0, labels, '').tolist()
@@ -0,0 +1,234 @@
+import json
+import os
+import uuid
+from pathlib import Path
+
+from .File import EXCEL_EXTENSIONS, FILE_COLUMNS, check_columns, create_dir_if_dont_exist, locked, read_csv_header
+
+
+# uploads in progress, in the upload directory of the workspace
+PARTIAL_DIR = '.partial'
+# a .csv header longer than this is refused
+HEADER_MAX_BYTES = 1 << 20
+COPY_CHUNK_SIZE = 1 << 20
+ZIP_MAGIC = b'PK\x03\x04'
+
+
+class UploadOffsetError(Exception):
+    """
+    A chunk does not start where the upload stands, offset is the size received so far.
+    """
+
+    def __init__(self, offset):
+        super().__init__("Le fragment ne commence pas à la position attendue ({0})".format(offset))
+        self.offset = offset
+
+
+def _partial_dir(upload_dir):
+    return create_dir_if_dont_exist(Path(upload_dir) / PARTIAL_DIR)
+
+
+def _state_path(upload_dir, upload_id):
+    if not isinstance(upload_id, str) or not upload_id.isalnum():
+        raise ValueError("Identifiant de téléversement invalide")
+    return _partial_dir(upload_dir) / '{0}.json'.format(upload_id)
+
+
+def _data_path(upload_dir, upload_id):
+    return _partial_dir(upload_dir) / '{0}.part'.format(upload_id)
+
+
+def _lock_path(upload_dir, upload_id):
+    return _partial_dir(upload_dir) / '{0}.lock'.format(upload_id)
+
+
+def upload_lock(upload_dir, upload_id):
+    """
+    Lock of an upload, shared by the web workers: write_chunk, finish_upload and set_upload_job are
+    called under it so that two requests on the same upload do not interleave.
+    """
+    # an invalid or unknown id is refused before a file is named after it
+    if not _state_path(upload_dir, upload_id).exists():
+        raise ValueError("Ce téléversement n'existe pas ou a expiré")
+    return locked(_lock_path(upload_dir, upload_id))
+
+
+def _save_state(upload_dir, state):
+    path = _state_path(upload_dir, state['id'])
+    state = {k: v for k, v in state.items() if k != 'offset'}
+    tmp_path = path.with_suffix('.{0}.tmp'.format(os.getpid()))
+    with open(tmp_path, 'w') as file:
+        json.dump(state, file)
+    os.replace(tmp_path, path)
+    return state
+
+
+def upload_status(upload_dir, upload_id):
+    """
+    :return: The state of the upload, with the number of bytes received as 'offset', None if
+     there is no such upload. Once complete, 'path' is the uploaded file and 'job' the job converting it
+    """
+    try:
+        with open(_state_path(upload_dir, upload_id)) as file:
+            state = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    data_path = _data_path(upload_dir, upload_id)
+    if state.get('path'):
+        state['offset'] = state['size']
+    else:
+        state['offset'] = data_path.stat().st_size if data_path.exists() else 0
+    return state
+
+
+def list_uploads(upload_dir):
+    """
+    :return: The states of the uploads of the upload directory, complete or not
+    """
+    states = (upload_status(upload_dir, path.stem) for path in _partial_dir(upload_dir).glob('*.json'))
+    return [state for state in states if state is not None]
+
+
+def start_upload(upload_dir, file_type, filename, size, max_bytes, extensions):
+    """
+    Start the upload of a file sent in chunks, or give back the upload of the same file that was
+    interrupted, to resume it from its offset.
+
+    :param upload_dir: Upload directory of the workspace
+    :param file_type: What file it is (network_file, source_file, open_file, limit_file)
+    :param filename: Name of the file, already made safe
+    :param size: Size of the file in bytes
+    :param max_bytes: Largest file accepted
+    :param extensions: Extensions accepted
+    :return: The state of the upload
+    """
+    if file_type not in FILE_COLUMNS:
+        raise ValueError("Le type de fichier '{0}' n'existe pas".format(file_type))
+    if not filename or Path(filename).suffix not in extensions:
+        raise ValueError("Les fichiers reçus ne sont des fichiers .csv ou .xlsx")
+    if size <= 0:
+        raise ValueError("Le fichier '{0}' est vide".format(filename))
+    if size > max_bytes:
+        raise ValueError("Le fichier '{0}' dépasse la taille maximale de {1} Mo".format(
+            filename, max_bytes // 2 ** 20))
+
+    for state in list_uploads(upload_dir):
+        if (state['file_type'], state['filename'], state['size']) == (file_type, filename, size):
+            return state
+
+    state = {'id': uuid.uuid4().hex, 'file_type': file_type, 'filename': filename, 'size': size,
+             'header_checked': False}
+    _data_path(upload_dir, state['id']).touch()
+    _save_state(upload_dir, state)
+    state['offset'] = 0
+    return state
+
+
+def _check_header(upload_dir, state):
+    """
+    Validate the beginning of the file as soon as it is received: the columns of a .csv once its
+    first line is there, the signature of a .xlsx. Raise ValueError if the file is refused.
+    """
+    with open(_data_path(upload_dir, state['id']), 'rb') as file:
+        head = file.read(HEADER_MAX_BYTES)
+
+    if Path(state['filename']).suffix in EXCEL_EXTENSIONS:
+        if len(head) < len(ZIP_MAGIC):
+            return False
+        if not head.startswith(ZIP_MAGIC):
+            raise ValueError("Le fichier '{0}' n'est pas un fichier .xlsx lisible".format(state['filename']))
+        # the columns of a workbook are only readable once it is complete
+        return True
+
+    if b'\n' not in head and len(head) < state['size']:
+        if len(head) >= HEADER_MAX_BYTES:
+            raise ValueError("L'entête du fichier '{0}' n'a pas pu être lue".format(state['filename']))
+        return False
+    columns = read_csv_header(head)
+    if columns is not None:
+        check_columns(columns, state['file_type'], state['filename'])
+    # a header that is not csv may still be an Excel file named .csv, checked once complete
+    return True
+
+
+def write_chunk(upload_dir, upload_id, offset, stream):
+    """
+    Append a chunk to an upload, under upload_lock.
+
+    :param offset: Position of the chunk in the file, it must be the number of bytes received so far
+    :param stream: File-like object giving the chunk
+    :return: The state of the upload, raise ValueError (the upload is then removed) if the file is
+     refused, UploadOffsetError if the chunk is not at the right position
+    """
+    state = upload_status(upload_dir, upload_id)
+    if state is None:
+        raise ValueError("Ce téléversement n'existe pas ou a expiré")
+    # a complete upload takes no more chunks
+    if offset != state['offset'] or state.get('path'):
+        raise UploadOffsetError(state['offset'])
+
+    received = state['offset']
+    with open(_data_path(upload_dir, upload_id), 'ab') as file:
+        for chunk in iter(lambda: stream.read(COPY_CHUNK_SIZE), b''):
+            received += len(chunk)
+            if received > state['size']:
+                file.truncate(state['offset'])
+                raise ValueError("Le fragment dépasse la taille annoncée du fichier")
+            file.write(chunk)
+    state['offset'] = received
+
+    if not state['header_checked']:
+        try:
+            state['header_checked'] = _check_header(upload_dir, state)
+        except ValueError:
+            cancel_upload(upload_dir, upload_id)
+            raise
+        _save_state(upload_dir, state)
+
+    return state
+
+
+def finish_upload(upload_dir, upload_id):
+    """
+    Move a complete upload to the upload directory, under upload_lock. The state is kept until the
+    file is converted, see set_upload_job; a finished upload is not moved again.
+
+    :return: Path to the uploaded file
+    """
+    state = upload_status(upload_dir, upload_id)
+    if state is None or state['offset'] != state['size']:
+        raise ValueError("Le téléversement n'est pas terminé")
+    if state.get('path'):
+        return Path(state['path'])
+    path = Path(upload_dir) / state['filename']
+    os.replace(_data_path(upload_dir, upload_id), path)
+    state['path'] = str(path)
+    _save_state(upload_dir, state)
+    return path
+
+
+def set_upload_job(upload_dir, upload_id, job_id):
+    """
+    Record the job converting a finished upload, under upload_lock.
+
+    :return: The state of the upload
+    """
+    state = upload_status(upload_dir, upload_id)
+    if state is None:
+        raise ValueError("Ce téléversement n'existe pas ou a expiré")
+    state['job'] = job_id
+    _save_state(upload_dir, state)
+    return state
+
+
+def cancel_upload(upload_dir, upload_id):
+    """
+    Forget an upload, once its file is converted or refused.
+    """
+    for path in (_data_path(upload_dir, upload_id), _state_path(upload_dir, upload_id),
+                 _lock_path(upload_dir, upload_id)):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
@@ -0,0 +1,151 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .File import check_columns, read_table
+from .metrics import Profile
+from .topology import build_topology, multi_source_sequence
+
+# nodes or sections listed in a message, the others are counted
+MAX_LISTED = 10
+# files check_study cannot do without
+REQUIRED_FILES = ('network_file', 'source_file', 'open_file')
+
+
+def _listing(values):
+    values = [str(v) for v in values]
+    listed = ', '.join(values[:MAX_LISTED])
+    if len(values) > MAX_LISTED:
+        listed += " (et {0} autres)".format(len(values) - MAX_LISTED)
+    return listed
+
+
+def _read_checked(file_type, file):
+    df = read_table(file)
+    check_columns(df.columns, file_type, Path(file).name)
+    return df
+
+
+def read_study(files, max_workers=None):
+    """
+    Read the files of a study concurrently, each in a thread.
+
+    :param files: {file type: Path}
+    :param max_workers: Number of threads, one per file when None
+    :return: The tables {file type: DataFrame} that could be read, and the error messages of the
+     others
+    """
+    files = {file_type: file for file_type, file in files.items() if file}
+    tables = {}
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers or max(len(files), 1)) as executor:
+        futures = {file_type: executor.submit(_read_checked, file_type, file) for file_type, file in files.items()}
+        for file_type, future in futures.items():
+            try:
+                tables[file_type] = future.result()
+            except ValueError as e:
+                errors.append("{0}".format(e))
+            except Exception:
+                errors.append("Le contenu du fichier '{0}' n'a pas pu être lu".format(Path(files[file_type]).name))
+    return tables, errors
+
+
+def check_study(tables):
+    """
+    Check the files of a study against each other: the sources and open sections must be in the
+    network, the network must be radial and energised from its sources, and every node fed by a
+    section must have a row in the limit file.
+
+    :param tables: {file type: DataFrame}, as returned by read_study. The limit file is optional
+    :return: The errors, which make the analysis wrong, and the warnings
+    """
+    errors = []
+    warnings = []
+    network_df = tables['network_file']
+    nodes = pd.Index(pd.unique(np.concatenate([network_df['start'].values, network_df['end'].values])))
+
+    open_sections = tables['open_file']['section']
+    unknown = open_sections[~open_sections.isin(network_df['section'])].unique()
+    if len(unknown):
+        warnings.append("Sections ouvertes absentes du réseau : {0}".format(_listing(unknown)))
+    network_df = network_df[~network_df['section'].isin(open_sections)]
+
+    sources = tables['source_file']['source']
+    unknown = sources[~sources.isin(nodes)].unique()
+    if len(unknown) == len(sources.unique()):
+        errors.append("Aucune source n'est un nœud du réseau : {0}".format(_listing(unknown)))
+        return errors, warnings
+    if len(unknown):
+        warnings.append("Sources absentes du réseau : {0}".format(_listing(unknown)))
+
+    topology = build_topology(network_df)
+    sequence, further_ids, _ = multi_source_sequence(topology, sources.tolist())
+    row_nodes = topology.row_nodes
+
+    # nodes of the traversal: the sources of the network and the further nodes of the reached sections
+    source_ids = pd.Index(topology.node_labels).get_indexer(sources)
+    source_ids = source_ids[source_ids >= 0]
+    fed = np.zeros(topology.n_nodes, dtype=bool)
+    fed[further_ids[sequence > 0]] = True
+    reached = fed.copy()
+    reached[source_ids] = True
+
+    # a radial network links its reached nodes with one section each: the section of a node is the
+    # one with the lowest sequence, any other section between reached nodes closes a loop
+    tree_rows = np.flatnonzero(sequence > 0)
+    tree_rows = tree_rows[np.argsort(sequence[tree_rows], kind='stable')]
+    _, first = np.unique(further_ids[tree_rows], return_index=True)
+    tree_sections = topology.row_sections[tree_rows[first]]
+    is_loop = reached[row_nodes[:, 0]] & reached[row_nodes[:, 1]] & ~np.isin(topology.row_sections, tree_sections)
+    if is_loop.any():
+        errors.append("Le réseau est bouclé, sections fermant une boucle : {0}".format(
+            _listing(pd.unique(network_df['section'].values[is_loop]))))
+
+    fed_sources = pd.unique(source_ids[fed[source_ids]])
+    if len(fed_sources):
+        warnings.append("Sources alimentées par une autre source : {0}".format(
+            _listing(topology.node_labels[fed_sources])))
+
+    unreached = topology.node_labels[~reached]
+    if len(unreached):
+        warnings.append("Nœuds non alimentés par une source : {0}".format(_listing(unreached)))
+
+    limit_df = tables.get('limit_file')
+    if limit_df is not None:
+        limit_nodes = limit_df['node']
+        duplicated = limit_nodes[limit_nodes.duplicated()].unique()
+        if len(duplicated):
+            errors.append("Nœuds en double dans le fichier 'limit' : {0}".format(_listing(duplicated)))
+        further_nodes = topology.node_labels[fed]
+        missing = further_nodes[~pd.Index(further_nodes).isin(limit_nodes)]
+        if len(missing):
+            errors.append("Nœuds du réseau absents du fichier 'limit' : {0}".format(_listing(missing)))
+
+    return errors, warnings
+
+
+def validate_study(files, profile=None, required=REQUIRED_FILES):
+    """
+    Validate the files of a study together before an analysis is queued.
+
+    :param files: {file type: Path}, False or None for a file not uploaded
+    :param profile: Records the time of the reading and of the checks
+    :type profile: Profile
+    :param required: File types the analysis needs, REQUIRED_FILES are always needed
+    :return: The errors, which must be fixed before the analysis, and the warnings
+    """
+    profile = profile if profile is not None else Profile()
+    missing = [t for t in dict.fromkeys(tuple(REQUIRED_FILES) + tuple(required)) if not files.get(t)]
+    errors = ["Le fichier '{0}' est nécessaire à l'analyse".format(t[:-len('_file')]) for t in missing]
+
+    with profile.stage('validate_read') as stage:
+        tables, read_errors = read_study(files)
+        stage['rows'] = sum(len(df) for df in tables.values())
+    errors += read_errors
+    if errors:
+        return errors, []
+
+    with profile.stage('validate_check', rows=len(tables['network_file'])):
+        return check_study(tables)
@@ -0,0 +1,149 @@
+import json
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+from contextlib import closing
+from pathlib import Path
+
+
+class WorkspaceStore:
+    """
+    State of the workspaces (validated files, current job...) in a SQLite file, shared by every
+    web worker process. A connection is opened for each operation so the store is safe to use
+    after a fork.
+
+    :param db_path: Path of the SQLite file
+    """
+
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        with closing(self._connect()) as con:
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('CREATE TABLE IF NOT EXISTS workspaces '
+                        '(id TEXT PRIMARY KEY, state TEXT NOT NULL, updated REAL NOT NULL)')
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def load(self, workspace_id):
+        with closing(self._connect()) as con:
+            row = con.execute('SELECT state FROM workspaces WHERE id = ?', (workspace_id,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def update(self, workspace_id, func):
+        """
+        Read, modify and write the state of a workspace in one transaction.
+
+        :param func: Function modifying the state dict in place
+        :return: The new state
+        """
+        con = self._connect()
+        try:
+            con.execute('BEGIN IMMEDIATE')
+            row = con.execute('SELECT state FROM workspaces WHERE id = ?', (workspace_id,)).fetchone()
+            state = json.loads(row[0]) if row else {}
+            func(state)
+            con.execute('INSERT OR REPLACE INTO workspaces (id, state, updated) VALUES (?, ?, ?)',
+                        (workspace_id, json.dumps(state), time.time()))
+            con.execute('COMMIT')
+        except Exception:
+            con.execute('ROLLBACK')
+            raise
+        finally:
+            con.close()
+        return state
+
+    def delete(self, workspace_id):
+        with closing(self._connect()) as con:
+            con.execute('DELETE FROM workspaces WHERE id = ?', (workspace_id,))
+
+
+def shared_secret_key(path):
+    """
+    Key signing the session cookies. Every web worker must use the same key, it is taken from the
+    SECRET_KEY environment variable or created once in the given file.
+    """
+    if os.environ.get('SECRET_KEY'):
+        return os.environ['SECRET_KEY'].encode()
+
+    path = Path(path)
+    if not path.exists():
+        tmp_path = path.with_name('{0}.{1}.tmp'.format(path.name, os.getpid()))
+        tmp_path.write_bytes(os.urandom(32))
+        try:
+            # the first worker to link its key wins, the others read it
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            tmp_path.unlink()
+    return path.read_bytes()
+
+
+def new_workspace_id():
+    return uuid.uuid4().hex
+
+
+class Workspace:
+    """
+    Files and state of one user session: every application gets its own upload and output
+    directories, <upload_root>/<workspace id>/<app_name> and <generated_root>/<workspace id>/<app_name>.
+
+    :param store: Where the state is kept
+    :type store: WorkspaceStore
+    :param workspace_id: Id of the workspace, kept in the session
+    """
+
+    def __init__(self, store, workspace_id, upload_root, generated_root):
+        if not workspace_id.isalnum():
+            raise ValueError("Identifiant d'espace de travail invalide")
+        self.store = store
+        self.id = workspace_id
+        self.upload_root = Path(upload_root) / workspace_id
+        self.generated_root = Path(generated_root) / workspace_id
+
+    def upload_dir(self, app_name):
+        path = self.upload_root / app_name
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def generated_dir(self, app_name):
+        path = self.generated_root / app_name
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def files(self, app_name, expected):
+        """
+        :param expected: The files needed by the application, {file type: False}
+        :return: {file type: Path of the validated file or False}
+        """
+        saved = self.store.load(self.id).get('files', {}).get(app_name, {})
+        return {k: Path(saved[k]) if saved.get(k) else False for k in expected}
+
+    def set_file(self, app_name, file_type, path):
+        def _set(state):
+            state.setdefault('files', {}).setdefault(app_name, {})[file_type] = str(path)
+        self.store.update(self.id, _set)
+
+    def current_job(self, app_name):
+        return self.store.load(self.id).get('jobs', {}).get(app_name)
+
+    def set_current_job(self, app_name, job_id):
+        def _set(state):
+            state.setdefault('jobs', {})[app_name] = job_id
+        self.store.update(self.id, _set)
+
+    def purge(self, app_name):
+        """
+        Remove the uploaded and generated files of an application and forget its state.
+        """
+        for path in (self.upload_root / app_name, self.generated_root / app_name):
+            shutil.rmtree(path, ignore_errors=True)
+
+        def _clear(state):
+            state.get('files', {}).pop(app_name, None)
+            state.get('jobs', {}).pop(app_name, None)
+        self.store.update(self.id, _clear)
+
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Run an engine and the reference engine on randomised generated networks, report their differences and speedup.
+
+Every case is a network of the generator with random sources, branching, laterals, node labels and an
+island of sections no source reaches. Both engines sequence it, build its radial tree, allocate its DG
+and write its node map; the results are compared row by row, node by node and byte by byte. The
+reference engine is quadratic in the size of the network: keep the sizes small.
+
+Usage:
+    python -m benchmarks.differential [--engine fast] [--sizes 100 300] [--cases 10] [--output differential.json]
+"""
+import argparse
+import json
+import math
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from app.utils.engines import DEFAULT_ENGINE, ENGINES, get_engine
+
+from .generator import generate_network
+from .run import metadata
+
+
+DEFAULT_SIZES = (100, 300)
+# differences kept as examples in the report, per kind and case
+MAX_EXAMPLES = 5
+# relative and absolute tolerance on the allocated DG
+DG_TOLERANCE = 1e-9
+
+
+def random_case(n_sections, seed):
+    """
+    :return: The generated tables of a network with random parameters, and those parameters
+    """
+    rng = np.random.default_rng(seed)
+    params = {
+        'n_sections': n_sections,
+        'n_sources': int(rng.integers(1, max(2, n_sections // 50) + 1)),
+        'branching': int(rng.integers(2, 6)),
+        'lateral_ratio': round(float(rng.uniform(0.0, 1.0)), 3),
+        'n_open': int(rng.integers(0, n_sections // 10 + 1)),
+        'dg_share': round(float(rng.uniform(0.1, 0.9)), 3),
+        'labels': 'str' if rng.random() < 0.5 else 'int',
+        'n_unreached': int(rng.integers(1, n_sections // 20 + 2)) if rng.random() < 0.5 else 0,
+        'seed': seed,
+    }
+    tables = generate_network(n_sections, branching=params['branching'], n_sources=params['n_sources'],
+                              n_open=params['n_open'], lateral_ratio=params['lateral_ratio'],
+                              dg_share=params['dg_share'], n_unreached=params['n_unreached'], seed=seed)
+
+    if params['labels'] == 'str':
+        def label(nodes):
+            return np.array(['N{0}'.format(n) for n in nodes], dtype=object)
+        tables['network']['start'] = label(tables['network']['start'])
+        tables['network']['end'] = label(tables['network']['end'])
+        tables['source']['source'] = label(tables['source']['source'])
+        tables['limit']['node'] = label(tables['limit']['node'])
+
+    return tables, params
+
+
+def run_engine(engine, tables, workdir):
+    """
+    Run every stage of an engine on the tables, with the open sections removed.
+
+    :type engine: Engine
+    :return: Its results and the seconds taken by each stage
+    """
+    network_df = tables['network']
+    network_df = network_df[~network_df['section'].isin(tables['open']['section'])].copy()
+    node_list = list(set(network_df[['start', 'end']].values.flatten().tolist()))
+    sources = tables['source']['source'].tolist()
+    seconds = {}
+
+    start = time.perf_counter()
+    sequence, further_node, source = engine.sequence(network_df, sources)
+    network_df['sequence'] = sequence
+    network_df['further_node'] = further_node
+    network_df['source'] = source
+    seconds['sequence'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    downstream_dict = engine.downstream(node_list, network_df)
+    downstream = {n: set(downstream_dict[n]) for n in node_list}
+    seconds['downstream'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    allocated_df = engine.allocate(tables['limit'], downstream_dict, network_df)
+    seconds['allocate'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    path = engine.write_node_map(node_list, downstream_dict, Path(workdir) / '{0}.csv'.format(engine.name), 'csv')
+    seconds['node_map'] = time.perf_counter() - start
+
+    return {
+        'network': network_df,
+        'downstream': downstream,
+        'allocated': allocated_df.set_index('section'),
+        'node_map': Path(path).read_bytes(),
+    }, seconds
+
+
+def _same_dg(a, b):
+    if isinstance(a, float) and isinstance(b, float) and math.isnan(a) and math.isnan(b):
+        return True
+    return math.isclose(a, b, rel_tol=DG_TOLERANCE, abs_tol=DG_TOLERANCE)
+
+
+def differences(expected, actual):
+    """
+    :return: {kind: [difference, ...]} between the results of the reference and of another engine
+    """
+    found = {'sequence': [], 'downstream': [], 'new_dg': [], 'limiting_node': [], 'node_map': []}
+
+    columns = ('sequence', 'further_node', 'source')
+    rows = zip(expected['network']['section'].tolist(),
+               *(expected['network'][c].tolist() for c in columns),
+               *(actual['network'][c].tolist() for c in columns))
+    for section, *values in rows:
+        if values[:3] != values[3:]:
+            found['sequence'].append({'section': section, 'expected': values[:3], 'actual': values[3:]})
+
+    for node, nodes in expected['downstream'].items():
+        if actual['downstream'].get(node) != nodes:
+            found['downstream'].append({'node': node, 'missing': sorted(map(str, nodes - actual['downstream'][node])),
+                                        'extra': sorted(map(str, actual['downstream'][node] - nodes))})
+
+    allocated = actual['allocated'].reindex(expected['allocated'].index)
+    for section, exp_dg, act_dg, exp_node, act_node in zip(
+            expected['allocated'].index.tolist(),
+            expected['allocated']['new_dg'].tolist(), allocated['new_dg'].tolist(),
+            expected['allocated']['limiting_node'].tolist(), allocated['limiting_node'].tolist()):
+        if not _same_dg(exp_dg, act_dg):
+            found['new_dg'].append({'section': section, 'expected': exp_dg, 'actual': act_dg})
+        if exp_node != act_node:
+            found['limiting_node'].append({'section': section, 'expected': exp_node, 'actual': act_node})
+
+    if expected['node_map'] != actual['node_map']:
+        found['node_map'].append({'expected_bytes': len(expected['node_map']), 'actual_bytes': len(actual['node_map'])})
+
+    return found
+
+
+def run_case(engine, n_sections, seed, workdir):
+    tables, params = random_case(n_sections, seed)
+    expected, reference_seconds = run_engine(get_engine('reference'), tables, workdir)
+    actual, engine_seconds = run_engine(engine, tables, workdir)
+    found = differences(expected, actual)
+
+    reference_total = sum(reference_seconds.values())
+    engine_total = sum(engine_seconds.values())
+    return {
+        'params': params,
+        'differences': {kind: len(items) for kind, items in found.items()},
+        'examples': {kind: items[:MAX_EXAMPLES] for kind, items in found.items() if items},
+        'reference_seconds': {k: round(v, 6) for k, v in reference_seconds.items()},
+        'engine_seconds': {k: round(v, 6) for k, v in engine_seconds.items()},
+        'speedup': reference_total / engine_total if engine_total else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.differential',
+                                     description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--engine', choices=sorted(ENGINES), default=DEFAULT_ENGINE, help='engine checked')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help='numbers of sections')
+    parser.add_argument('--cases', type=int, default=10, help='random networks per size')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first case')
+    parser.add_argument('--output', default=None, help='JSON file of the results')
+    args = parser.parse_args(argv)
+
+    engine = get_engine(args.engine)
+    cases = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in args.sizes:
+            for seed in range(args.seed, args.seed + args.cases):
+                case = run_case(engine, size, seed, workdir)
+                cases.append(case)
+                n_differences = sum(case['differences'].values())
+                print("{0:>6} sections seed {1:<4} {2:>4} differences, speedup {3:>8.1f}".format(
+                    size, seed, n_differences, case['speedup'] or 0.0), flush=True)
+                for kind, items in case['examples'].items():
+                    print("       {0}: {1}".format(kind, items[0]))
+
+    failed = [c for c in cases if any(c['differences'].values())]
+    speedups = [c['speedup'] for c in cases if c['speedup']]
+    summary = {
+        'engine': engine.name,
+        'cases': len(cases),
+        'failed_cases': len(failed),
+        'median_speedup': float(np.median(speedups)) if speedups else None,
+    }
+    print("\n{engine}: {failed_cases} / {cases} cases with differences, median speedup {0:.1f}".format(
+        summary['median_speedup'] or 0.0, **summary))
+
+    report = {'meta': metadata(), 'summary': summary, 'cases': cases}
+    output = Path(args.output) if args.output else \
+        Path(__file__).parent / 'results' / 'differential-{0}.json'.format(time.strftime('%Y%m%d-%H%M%S'))
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2, default=str)
+    print('results saved in {0}'.format(output))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Seeded generator of radial distribution networks in the format of the analyses input files.
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+def generate_network(n_sections, branching=3, n_sources=1, n_open=0, lateral_ratio=0.3,
+                     limit_range=(50.0, 500.0), dg_share=0.3, dg_range=(1.0, 50.0), n_unreached=0, seed=0):
+    """
+    Generate a radial network: one tree per source, plus tie sections between random nodes which
+    are listed in the open file so that the network is radial once they are removed, and an island
+    of sections no source reaches.
+
+    :param n_sections: Number of sections of the radial network (the tie sections come on top)
+    :param branching: Maximum number of sections leaving a node
+    :param n_sources: Number of sources, the sections are spread evenly across them
+    :param n_open: Number of tie sections, all of them open
+    :param lateral_ratio: Probability that a new section starts a lateral on a random node instead of
+     extending the last one
+    :param limit_range: Range of the limit of the nodes
+    :param dg_share: Share of the nodes with DG
+    :param dg_range: Range of the DG of those nodes
+    :param n_unreached: Number of sections of the island, a tree of nodes of its own
+    :param seed: Seed of the random generator
+    :return: {'network': DataFrame, 'source': DataFrame, 'open': DataFrame, 'limit': DataFrame}
+    """
+    rng = np.random.default_rng(seed)
+
+    sources = list(range(n_sources))
+    n_nodes = n_sources + n_sections
+    children = [0] * n_nodes
+    starts = np.empty(n_sections, dtype=np.int64)
+    ends = np.empty(n_sections, dtype=np.int64)
+
+    # nodes of every feeder that can still take a section
+    open_nodes = [[s] for s in sources]
+    position = [0] * n_nodes
+    last_node = list(sources)
+    laterals = rng.random(n_sections) < lateral_ratio
+    for idx in range(n_sections):
+        feeder = idx % n_sources
+        node = n_sources + idx
+        candidates = open_nodes[feeder]
+        if laterals[idx] or children[last_node[feeder]] >= branching:
+            parent = candidates[rng.integers(len(candidates))]
+        else:
+            parent = last_node[feeder]
+
+        starts[idx] = parent
+        ends[idx] = node
+        children[parent] += 1
+        if children[parent] >= branching:
+            # swap-remove the full node from the candidates
+            moved = candidates[-1]
+            candidates[position[parent]] = moved
+            position[moved] = position[parent]
+            candidates.pop()
+        position[node] = len(candidates)
+        candidates.append(node)
+        last_node[feeder] = node
+
+    tie_starts = rng.integers(n_nodes, size=n_open)
+    tie_ends = rng.integers(n_nodes, size=n_open)
+    starts = np.concatenate([starts, tie_starts])
+    ends = np.concatenate([ends, tie_ends])
+
+    # every node of the island hangs from one of the island nodes before it
+    island_ends = np.arange(n_nodes + 1, n_nodes + 1 + n_unreached)
+    island_starts = n_nodes + (rng.integers(np.arange(1, n_unreached + 1)) if n_unreached else island_ends[:0])
+    starts = np.concatenate([starts, island_starts])
+    ends = np.concatenate([ends, island_ends])
+    n_nodes += n_unreached + 1 if n_unreached else 0
+
+    # sections are exported in no particular order nor direction
+    flip = rng.random(len(starts)) < 0.5
+    starts, ends = np.where(flip, ends, starts), np.where(flip, starts, ends)
+    section_ids = rng.permutation(len(starts)) + 1
+    order = rng.permutation(len(starts))
+
+    network = pd.DataFrame({'section': section_ids[order], 'start': starts[order], 'end': ends[order]})
+    open_sections = pd.DataFrame({'section': section_ids[n_sections:n_sections + n_open]})
+
+    has_dg = rng.random(n_nodes) < dg_share
+    limit = pd.DataFrame({
+        'node': np.arange(n_nodes),
+        'limit': np.round(rng.uniform(*limit_range, size=n_nodes), 1),
+        'type': rng.choice(['thermique', 'tension', 'protection'], size=n_nodes),
+        'x': np.round(rng.uniform(-80.0, -60.0, size=n_nodes), 5),
+        'y': np.round(rng.uniform(45.0, 50.0, size=n_nodes), 5),
+        'dg': np.where(has_dg, np.round(rng.uniform(*dg_range, size=n_nodes), 1), 0.0),
+        'c': 0,
+    })
+
+    return {
+        'network': network,
+        'source': pd.DataFrame({'source': sources}),
+        'open': open_sections,
+        'limit': limit,
+    }
+
+
+def write_network(tables, directory):
+    """
+    Write the generated tables as network.csv, source.csv, open.csv and limit.csv
+
+    :return: {file type: Path} as expected by run_dg_analysis and run_nm_analysis
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    files = {}
+    for name, df in tables.items():
+        path = directory / '{0}.csv'.format(name)
+        df.to_csv(path, index=False)
+        files['{0}_file'.format(name)] = path
+    return files
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Time every stage of the analyses on generated networks and save the results as JSON.
+
+Usage:
+    python -m benchmarks.run [--sizes 1000 10000 100000] [--output results.json] [--compare previous.json]
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from app.utils import dg_allocation_tool, export, node_map_tool
+from app.utils.downstream import build_downstream_index
+from app.utils.hosting import allocate_profiles
+from app.utils.partition import GROUPS_PER_WORKER, NetworkPartition, partition_pool
+from app.utils.pipeline import PreparedNetwork
+from app.utils.topology import build_topology, multi_source_sequence, node_labels_of
+
+from .generator import generate_network
+
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+# the dense node map table takes n_nodes² cells, it is skipped above this size
+DENSE_TABLE_MAX_NODES = 20000
+# openpyxl writes about 100 000 cells per second
+XLSX_MAX_CELLS = 2 * 10 ** 6
+# limit and DG scenarios allocated together by allocate_profiles
+PROFILE_SCENARIOS = 24
+# processes of the partitioned sequencing and radial tree
+PARTITION_WORKERS = min(4, os.cpu_count() or 1)
+
+
+def measure(func, memory=True):
+    """
+    :return: The result of func(), its wall time in seconds and its peak of allocated memory in bytes
+     (None when memory is False). The peak is measured in a second run so that tracing does not
+     slow the timed one.
+    """
+    gc.collect()
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        del result
+        gc.collect()
+        tracemalloc.start()
+        result = func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return result, seconds, peak
+
+
+def prepare(n_sections, seed):
+    tables = generate_network(n_sections, n_sources=max(1, n_sections // 5000), n_open=max(1, n_sections // 1000),
+                              seed=seed)
+    network_df = tables['network']
+    network_df = network_df[~network_df['section'].isin(tables['open']['section'])].copy()
+    node_list = list(set(network_df[['start', 'end']].values.flatten().tolist()))
+    return tables, network_df, node_list, tables['source']['source'].tolist()
+
+
+def run_size(n_sections, seed=0, memory=True, workdir=None):
+    """
+    Run every stage on a generated network of n_sections sections.
+
+    :return: One result dict per stage
+    """
+    tables, network_df, node_list, sources = prepare(n_sections, seed)
+    results = []
+
+    def record(stage, func, rows):
+        result, seconds, peak = measure(func, memory=memory)
+        results.append({'sections': n_sections, 'stage': stage, 'rows': rows, 'seconds': round(seconds, 6),
+                        'peak_bytes': peak})
+        print("{0:>8} {1:<22} {2:>10.3f} s {3:>12}".format(
+            n_sections, stage, seconds, '' if peak is None else '{0:.1f} MB'.format(peak / 1e6)), flush=True)
+        return result
+
+    record('section_sequence', lambda: dg_allocation_tool.section_sequence(network_df, sources[0]), len(network_df))
+
+    def sequence_all():
+        topology = build_topology(network_df)
+        sequence, further_ids, source_ids = multi_source_sequence(topology, sources)
+        return sequence, node_labels_of(topology, further_ids), node_labels_of(topology, source_ids)
+
+    sequence, further_node, source = record('multi_source_sequence', sequence_all, len(network_df))
+    network_df['sequence'] = sequence
+    network_df['further_node'] = further_node
+    network_df['source'] = source
+
+    record('get_downstream_nodes', lambda: dg_allocation_tool.get_downstream_nodes(network_df, sources[0]),
+           len(network_df))
+
+    def downstream_all():
+        downstream_dict = dg_allocation_tool.set_downstream_dict(node_list, network_df)
+        # the lists are lazy, read them all
+        for nodes in downstream_dict.values():
+            pass
+        return downstream_dict
+
+    downstream_dict = record('set_downstream_dict', downstream_all, len(node_list))
+
+    def sequence_tree():
+        sequence_all()
+        return build_downstream_index(network_df)
+
+    def partitioned_sequence_tree():
+        # the pool is started in the measure, as prepare_network does
+        with partition_pool(PARTITION_WORKERS) as executor:
+            partition = NetworkPartition(network_df, executor, PARTITION_WORKERS * GROUPS_PER_WORKER)
+            partition.sequence(network_df, sources)
+            return build_downstream_index(network_df, intervals=partition.intervals)
+
+    record('sequence_tree', sequence_tree, len(network_df))
+    record('sequence_tree_x{0}'.format(PARTITION_WORKERS), partitioned_sequence_tree, len(network_df))
+
+    allocated_df = record('allocate_dg',
+                          lambda: dg_allocation_tool.allocate_dg(tables['limit'], downstream_dict, network_df),
+                          len(network_df))
+
+    def allocate_all_profiles():
+        limit_df = tables['limit']
+        scale = np.random.default_rng(seed).uniform(0.5, 1.5, (PROFILE_SCENARIOS, len(limit_df)))
+        prepared = PreparedNetwork(network_df, node_list, downstream_dict)
+        return list(allocate_profiles(prepared, limit_df['node'].values, limit_df['limit'].values * scale,
+                                      limit_df['dg'].values * scale))
+
+    record('allocate_profiles_x{0}'.format(PROFILE_SCENARIOS), allocate_all_profiles,
+           len(network_df) * PROFILE_SCENARIOS)
+
+    if len(node_list) <= DENSE_TABLE_MAX_NODES:
+        record('dict_to_table', lambda: node_map_tool.dict_to_table(node_list, downstream_dict), len(node_list))
+
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        for output_format in export.TABLE_FORMATS:
+            if output_format == 'xlsx' and allocated_df.size > XLSX_MAX_CELLS:
+                continue
+            record('export_{0}'.format(output_format),
+                   lambda: export.export_table(allocated_df, tmp, 'allocated_dg', output_format), len(allocated_df))
+
+        for output_format, (file_name, writer) in node_map_tool.NM_OUTPUT_FORMATS.items():
+            if output_format in ('csv', 'csv.gz') and len(node_list) > 10 * DENSE_TABLE_MAX_NODES:
+                continue
+            if output_format == 'xlsx' and len(node_list) ** 2 > XLSX_MAX_CELLS:
+                continue
+            record('node_map_{0}'.format(output_format),
+                   lambda: writer(node_list, downstream_dict, Path(tmp) / file_name), len(node_list))
+
+    return results
+
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+    }
+
+
+def compare(previous, current):
+    """
+    Print the time ratio current / previous of every stage found in both results.
+    """
+    before = {(r['sections'], r['stage']): r for r in previous['results']}
+    print("\n{0:>8} {1:<22} {2:>10} {3:>10} {4:>8}".format('sections', 'stage', 'before', 'now', 'ratio'))
+    for r in current['results']:
+        old = before.get((r['sections'], r['stage']))
+        if old is None or not old['seconds']:
+            continue
+        print("{0:>8} {1:<22} {2:>10.3f} {3:>10.3f} {4:>8.2f}".format(
+            r['sections'], r['stage'], old['seconds'], r['seconds'], r['seconds'] / old['seconds']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help='numbers of sections')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory measurement')
+    parser.add_argument('--output', default=None, help='JSON file of the results')
+    parser.add_argument('--compare', default=None, help='JSON file of previous results to compare with')
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in args.sizes:
+        results += run_size(size, seed=args.seed, memory=not args.no_memory)
+
+    report = {'meta': metadata(), 'results': results}
+    output = Path(args.output) if args.output else \
+        Path(__file__).parent / 'results' / '{0}.json'.format(time.strftime('%Y%m%d-%H%M%S'))
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print('\nresults saved in {0}'.format(output))
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), report)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
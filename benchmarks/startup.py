@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the cold start of a web worker, with and without preload_engines, and save the results as JSON.
+
+Every run is a new interpreter: the import of the application, create_app, the first page and the
+import of the engines by the first analysis are timed. The memory of a worker is the private memory
+(not shared with its master) of a process forked after create_app, as gunicorn does, once it has
+served a page and loaded the engines.
+
+Usage:
+    python -m benchmarks.startup [--repeat 5] [--output startup.json]
+"""
+import argparse
+import importlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+MODES = ('lazy', 'preload')
+
+
+def private_bytes():
+    """
+    :return: Memory of the process not shared with other processes, None when /proc is not available
+    """
+    try:
+        with open('/proc/self/smaps_rollup') as file:
+            fields = dict(line.split(':', 1) for line in file if ':' in line)
+    except OSError:
+        return None
+    return sum(int(fields[k].split()[0]) * 1024 for k in ('Private_Clean', 'Private_Dirty') if k in fields)
+
+
+def max_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # kilobytes on Linux, bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def load_engines():
+    from app.app import ENGINE_MODULES
+    for name in ENGINE_MODULES:
+        importlib.import_module(name)
+
+
+def forked_worker(app):
+    """
+    :return: The private memory of a process forked from this one once it has served a page and loaded
+     the engines, as a web worker on its first analysis. None when fork or /proc are not available
+    """
+    if not hasattr(os, 'fork'):
+        return None
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        app.test_client().get('/dg_allocation')
+        load_engines()
+        os.write(write_end, json.dumps(private_bytes()).encode())
+        os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end) as pipe:
+        result = json.loads(pipe.read() or 'null')
+    os.waitpid(pid, 0)
+    return result
+
+
+def child(mode):
+    """
+    One cold start, run in a new interpreter: print its timings as JSON.
+    """
+    start = time.perf_counter()
+    from app.app import create_app
+    imported = time.perf_counter()
+    app = create_app({'PRELOAD_ENGINES': mode == 'preload'})
+    created = time.perf_counter()
+    worker_private = forked_worker(app)
+
+    start_page = time.perf_counter()
+    app.test_client().get('/dg_allocation')
+    first_page = time.perf_counter()
+    # already loaded by create_app in preload mode
+    load_engines()
+    engines = time.perf_counter()
+
+    print(json.dumps({
+        'import_seconds': imported - start,
+        'create_app_seconds': created - imported,
+        'first_page_seconds': first_page - start_page,
+        'engines_seconds': engines - first_page,
+        'master_rss_bytes': max_rss_bytes(),
+        'worker_private_bytes': worker_private,
+    }))
+
+
+def cold_start(mode, workdir):
+    """
+    :return: The timings of a cold start in a new interpreter, run in workdir
+    """
+    root = Path(__file__).absolute().parent.parent
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [str(root), os.environ.get('PYTHONPATH')])))
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.startup', '--child', mode], cwd=workdir, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.startup', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='cold starts per mode, the median is kept')
+    parser.add_argument('--output', default=None, help='JSON file of the results')
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        child(args.child)
+        return 0
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in MODES:
+            runs = [cold_start(mode, workdir) for _ in range(args.repeat)]
+            result = {'mode': mode}
+            for key in runs[0]:
+                values = [r[key] for r in runs if r[key] is not None]
+                result[key] = statistics.median(values) if values else None
+            results.append(result)
+
+            print("{0:<8} import {1:.3f} s, create_app {2:.3f} s, first page {3:.3f} s, engines {4:.3f} s".format(
+                mode, result['import_seconds'], result['create_app_seconds'], result['first_page_seconds'],
+                result['engines_seconds']))
+            if result['worker_private_bytes'] is not None:
+                print("{0:<8} worker private memory {1:.1f} MB".format(mode, result['worker_private_bytes'] / 1e6))
+
+    report = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0], 'results': results}
+    output = Path(args.output) if args.output else \
+        Path(__file__).parent / 'results' / 'startup-{0}.json'.format(time.strftime('%Y%m%d-%H%M%S'))
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print('\nresults saved in {0}'.format(output))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
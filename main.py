@@ -1,9 +1,8 @@
-from app import app
+from app.app import create_app
 
 
-external_app = app.app
+external_app = create_app()
 
 
 if __name__ == "__main__":
     external_app.run()
-